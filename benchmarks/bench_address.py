@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+    Micro-benchmark of the 'From' address parsing used for routing.
+
+    Compares :func:`email.utils.parseaddr` with
+    :func:`mailproc.mailproc_email.parse_address`. Run it from the project
+    root::
+
+        python benchmarks/bench_address.py
+"""
+import email.utils
+import timeit
+
+from mailproc.mailproc_email import parse_address
+
+
+ADDRESSES = [
+    'user@example.com',
+    '<user@example.com>',
+    'John Doe <john.doe@Example.COM>',
+    '"Doe, John" <john.doe@example.com>',
+    '=?UTF-8?Q?Carlos_Cesar_Caballero_D=c3=adaz?=\n <test@test.com>',
+]
+
+NUMBER = 20000
+
+
+def main():
+    print('{0:<45} {1:>12} {2:>12} {3:>8}'.format('address', 'parseaddr', 'fast', 'speedup'))
+    for address in ADDRESSES:
+        parseaddr_time = timeit.timeit(lambda: email.utils.parseaddr(address), number=NUMBER)
+        fast_time = timeit.timeit(lambda: parse_address(address), number=NUMBER)
+        print('{0:<45} {1:>10.2f}us {2:>10.2f}us {3:>7.1f}x'.format(
+            repr(address)[:45], parseaddr_time / NUMBER * 1e6, fast_time / NUMBER * 1e6,
+            parseaddr_time / fast_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+    Size and speed of the JSON attachments compression codecs.
+
+    Compresses a synthetic JSON payload with every registered codec of
+    :mod:`mailproc.compression` and prints a table. Run it from the project
+    root::
+
+        python benchmarks/bench_compression.py
+"""
+import json
+import random
+import time
+
+from mailproc.compression import CODECS
+from mailproc.streams import iter_chunks
+
+
+LEVELS = {
+    'gzip': (1, 6, 9),
+    'zlib': (1, 6, 9),
+    'bz2': (1, 9),
+    'lzma': (0, 6),
+    'zstd': (1, 3, 19),
+}
+
+RECORDS = 100000
+
+
+def make_payload():
+    rng = random.Random(0)
+    records = [{
+        'id': i,
+        'sender': 'user{0}@example{1}.com'.format(rng.randint(0, 5000), rng.randint(0, 50)),
+        'amount': round(rng.uniform(0, 10000), 2),
+        'status': rng.choice(['new', 'processed', 'failed']),
+        'tags': rng.sample(['a', 'b', 'c', 'd', 'e', 'f'], 3),
+    } for i in range(RECORDS)]
+    return json.dumps(records).encode('utf-8')
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    payload = make_payload()
+    size = len(payload)
+    print('payload: {0:.1f} MB of JSON\n'.format(size / 1e6))
+    print('{0:<6} {1:>5} {2:>12} {3:>7} {4:>14} {5:>16}'.format(
+        'codec', 'level', 'size', 'ratio', 'compress MB/s', 'decompress MB/s'))
+    for name, codec in CODECS.items():
+        for level in LEVELS.get(name, (codec.default_level,)):
+            compressed, compress_time = timed(
+                lambda: b''.join(codec.iter_compressed(iter_chunks(payload), level)))
+            decompressed, decompress_time = timed(
+                lambda: b''.join(codec.iter_decompressed(iter_chunks(compressed))))
+            assert decompressed == payload
+            print('{0:<6} {1:>5} {2:>12} {3:>6.1f}x {4:>14.1f} {5:>16.1f}'.format(
+                name, level, len(compressed), size / len(compressed),
+                size / compress_time / 1e6, size / decompress_time / 1e6))
+
+
+if __name__ == '__main__':
+    main()
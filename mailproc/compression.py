@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+    mailproc.compression
+    ~~~~~~~~~~~~~~~~~~~~
+    This module implements the mailProc attachments compression codecs.
+
+    :copyright: (c) 2018 Daxslab.
+    :license: LGPL, see LICENSE for more details.
+"""
+import bz2
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .exceptions import DecompressionSizeError
+from .streams import STREAM_CHUNK_SIZE
+
+
+# size of the compressed slices fed at once to zstd decompressors
+ZSTD_INPUT_SIZE = 1024
+
+
+class Codec:
+    """
+    Compression codec for attachments. The codec of a received attachment
+    is detected from its content type or its filename extension.
+
+    :param name: Codec name, as 'gzip'
+    :param content_types: Attachment content types, the first one is used
+                          for sent attachments
+    :param extensions: Attachment filename extensions, as '.gz'
+    :param compressor: Function returning a compressor object, with
+                       `compress` and `flush` methods, for a compression
+                       level
+    :param decompress: Function decompressing an iterator over compressed
+                       bytes, with a `chunk_size` argument limiting the size
+                       of the returned decompressed chunks
+    :param default_level: Default compression level
+    """
+
+    def __init__(self, name, content_types, extensions, compressor, decompress, default_level=None):
+        self.name = name
+        self.content_types = tuple(content_types)
+        self.extensions = tuple(extensions)
+        self.compressor = compressor
+        self.decompress = decompress
+        self.default_level = default_level
+
+    @property
+    def content_type(self):
+        return self.content_types[0]
+
+    def iter_compressed(self, chunks, level=None):
+        """
+        Compress data incrementally
+
+        :param chunks: Iterator over bytes
+        :param level: Compression level. Default: the codec default level
+        :return: Iterator over compressed bytes
+        """
+        compressor = self.compressor(self.default_level if level is None else level)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def iter_decompressed(self, chunks, max_size=None, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Decompress data incrementally, including concatenated streams
+
+        :param chunks: Iterator over compressed bytes
+        :param max_size: Maximum decompressed size in bytes, exceeding it
+                         raises :class:`~mailproc.exceptions.DecompressionSizeError`.
+                         Default: None (unlimited)
+        :param chunk_size: Maximum size of the decompressed chunks
+        :return: Iterator over decompressed bytes
+        """
+        size = 0
+        for chunk in self.decompress(chunks, chunk_size):
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise DecompressionSizeError('decompressed data exceeds {0} bytes'.format(max_size))
+            yield chunk
+
+    def __repr__(self):
+        return '<Codec {0}>'.format(self.name)
+
+
+def _zlib_decompress(wbits):
+    def decompress(chunks, chunk_size):
+        decompressor = zlib.decompressobj(wbits)
+        pending = False
+        for data in chunks:
+            pending = pending or bool(data)
+            while pending:
+                try:
+                    chunk = decompressor.decompress(data, chunk_size)
+                except zlib.error as e:
+                    raise ValueError('invalid compressed data: {0}'.format(e))
+                if chunk:
+                    yield chunk
+                if decompressor.eof:
+                    # next concatenated stream
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits)
+                    pending = bool(data)
+                else:
+                    data = decompressor.unconsumed_tail
+                    if not data and len(chunk) < chunk_size:
+                        break
+        if pending:
+            raise ValueError('compressed data ended before the end-of-stream marker was reached')
+    return decompress
+
+
+def _decompressor_decompress(decompressor_class, errors):
+    # bz2 and lzma decompressors buffer the unconsumed input
+    def decompress(chunks, chunk_size):
+        decompressor = decompressor_class()
+        pending = False
+        for data in chunks:
+            pending = pending or bool(data)
+            while pending:
+                try:
+                    chunk = decompressor.decompress(data, chunk_size)
+                except errors as e:
+                    raise ValueError('invalid compressed data: {0}'.format(e))
+                data = b''
+                if chunk:
+                    yield chunk
+                if decompressor.eof:
+                    # next concatenated stream
+                    data = decompressor.unused_data
+                    decompressor = decompressor_class()
+                    pending = bool(data)
+                elif decompressor.needs_input:
+                    break
+        if pending:
+            raise ValueError('compressed data ended before the end-of-stream marker was reached')
+    return decompress
+
+
+def _zstd_compressor(level):
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def _zstd_decompress(chunks, chunk_size):
+    # zstd decompression objects have no output limit, the input is fed in
+    # small slices to bound the output of each call
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    pending = False
+    for data in chunks:
+        for start in range(0, len(data), ZSTD_INPUT_SIZE):
+            data_slice = data[start:start + ZSTD_INPUT_SIZE]
+            while data_slice:
+                pending = True
+                try:
+                    chunk = decompressor.decompress(data_slice)
+                except zstandard.ZstdError as e:
+                    raise ValueError('invalid compressed data: {0}'.format(e))
+                data_slice = b''
+                for i in range(0, len(chunk), chunk_size):
+                    yield chunk[i:i + chunk_size]
+                if decompressor.eof:
+                    # next concatenated frame
+                    data_slice = decompressor.unused_data
+                    decompressor = zstandard.ZstdDecompressor().decompressobj()
+                    pending = False
+    if pending:
+        raise ValueError('compressed data ended before the end-of-stream marker was reached')
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """
+    Register a compression codec, replacing any codec with the same name
+
+    :param codec: :class:`Codec` object
+    """
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    """
+    Return a registered compression codec
+
+    :param name: Codec name
+    :return: :class:`Codec` object
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown compression codec "{0}", use one of: {1}'.format(name, ', '.join(CODECS)))
+
+
+def detect_codec(content_type=None, filename=None):
+    """
+    Return the compression codec of an attachment, detected from its
+    content type or, for generic content types, from its filename
+    extension
+
+    :param content_type: Attachment content type
+    :param filename: Attachment filename
+    :return: :class:`Codec` object or None for uncompressed attachments
+    """
+    content_type = (content_type or '').lower()
+    filename = (filename or '').lower()
+    for codec in CODECS.values():
+        if content_type in codec.content_types:
+            return codec
+    for codec in CODECS.values():
+        if filename.endswith(codec.extensions):
+            return codec
+    return None
+
+
+register_codec(Codec('gzip', ('application/x-gzip', 'application/gzip'), ('.gz', '.gzip'),
+                     lambda level: zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+                     _zlib_decompress(16 + zlib.MAX_WBITS), default_level=9))
+register_codec(Codec('zlib', ('application/zlib',), ('.zz', '.zlib'),
+                     lambda level: zlib.compressobj(level),
+                     _zlib_decompress(zlib.MAX_WBITS), default_level=6))
+register_codec(Codec('bz2', ('application/x-bzip2',), ('.bz2',),
+                     lambda level: bz2.BZ2Compressor(level),
+                     _decompressor_decompress(bz2.BZ2Decompressor, OSError), default_level=9))
+register_codec(Codec('lzma', ('application/x-xz',), ('.xz',),
+                     lambda level: lzma.LZMACompressor(preset=level),
+                     _decompressor_decompress(lzma.LZMADecompressor, lzma.LZMAError), default_level=6))
+if zstandard is not None:
+    register_codec(Codec('zstd', ('application/zstd',), ('.zst', '.zstd'),
+                         _zstd_compressor, _zstd_decompress, default_level=3))
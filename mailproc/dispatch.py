@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+    mailproc.dispatch
+    ~~~~~~~~~~~~~~~~~
+    This module implements the parallel dispatch of mails to actions.
+
+    :copyright: (c) 2018 Daxslab.
+    :license: LGPL, see LICENSE for more details.
+"""
+from collections import namedtuple
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import zlib
+
+from .metrics import Metrics
+
+
+DispatchResult = namedtuple('DispatchResult', ['index', 'message_id', 'sender', 'results', 'error'])
+DispatchResult.__doc__ = """
+Result of dispatching a mail to the registered actions
+
+:param index: Position of the mail in the dispatched sequence
+:param message_id: Mail 'Message-ID' header
+:param sender: Mail 'From' address
+:param results: Dict of action return values by routes target. Targets
+                without matching routes are missing
+:param error: Exception raised by an action or None
+"""
+
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+# application and batch collector used by process pool workers
+_worker_app = None
+_worker_batches = None
+
+# end of the prefetched items
+_PREFETCH_DONE = object()
+
+
+def _init_process_worker(app):
+    global _worker_app, _worker_batches
+    _worker_app = app
+    # workers report metrics collected since they started
+    _worker_app.metrics = Metrics(app.metrics.buckets)
+    _worker_batches = BatchCollector(capture_errors=True)
+
+
+def _process_dispatch(mail, index):
+    return _worker_app.dispatch_mail(mail, index, capture_errors=True, batches=_worker_batches)
+
+
+def _process_flush_batches():
+    batch_errors = _worker_app.flush_batches(_worker_batches)
+    return batch_errors, _worker_app.metrics.dump()
+
+
+class BatchCollector:
+    """
+    Collects the mails matching batch routes during a run, until a batch
+    is full or the run ends.
+
+    :param capture_errors: If True, exceptions raised by batch actions are
+                           stored in `errors` instead of raised
+    """
+
+    def __init__(self, capture_errors=False):
+        self.capture_errors = capture_errors
+        self.errors = []
+        self._batches = OrderedDict()
+
+    def add(self, route, item, index):
+        """
+        Add a mail to the batch of a route
+
+        :param route: :class:`~mailproc.routing.Route` object
+        :param item: (kwargs, mail) pair
+        :param index: Position of the mail in the dispatched sequence
+        :return: List of (index, item) pairs when the batch is full, else None
+        """
+        batch = self._batches.setdefault(route, [])
+        batch.append((index, item))
+        if len(batch) >= route.max_batch:
+            del self._batches[route]
+            return batch
+        return None
+
+    def pop_all(self):
+        """
+        Remove and return all pending batches
+
+        :return: List of (route, batch) pairs
+        """
+        batches = list(self._batches.items())
+        self._batches.clear()
+        return batches
+
+
+def _prefetch_put(items, stop, item):
+    """
+    Put an item in the prefetch queue, waiting for room until the consumer stops
+
+    :return: False if the consumer stopped before the item was queued
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _prefetch_produce(iterable, items, stop):
+    """
+    Prefetch thread body, queuing (item, None) pairs and a final
+    (_PREFETCH_DONE, error) pair
+    """
+    try:
+        for item in iterable:
+            if not _prefetch_put(items, stop, (item, None)):
+                return
+    except BaseException as e:
+        _prefetch_put(items, stop, (_PREFETCH_DONE, e))
+    else:
+        _prefetch_put(items, stop, (_PREFETCH_DONE, None))
+
+
+def _prefetch_get(items):
+    """
+    Return the next prefetched item, raising the iterable exception if any
+    """
+    item, error = items.get()
+    if error is not None:
+        raise error
+    return item
+
+
+def prefetch(iterable, size):
+    """
+    Iterate over an iterable consuming it from a background thread, which
+    keeps up to `size` items fetched ahead of the caller. Exceptions raised
+    by the iterable are raised to the caller.
+
+    :param iterable: Iterable to consume
+    :param size: Maximum number of items fetched ahead
+    :return: Iterator over the iterable items
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    producer = threading.Thread(target=_prefetch_produce, args=(iterable, items, stop))
+    producer.daemon = True
+    producer.start()
+
+    try:
+        item = _prefetch_get(items)
+        while item is not _PREFETCH_DONE:
+            yield item
+            item = _prefetch_get(items)
+    finally:
+        stop.set()
+
+
+class ShardedExecutor:
+    """
+    Run tasks on a set of single worker executors. Tasks are assigned to a
+    shard by hashing a key, so tasks sharing a key run in submission order.
+    The number of pending tasks is bounded, blocking :meth:`submit` when the
+    limit is reached.
+
+    :param workers: Number of shards (threads or processes)
+    :param executor: Executor type, can be 'thread' or 'process'. Default: 'thread'
+    :param window: Maximum number of pending tasks. Default: 16 per worker
+    :param initializer: Function called when a worker starts
+    :param initargs: Arguments for `initializer`
+    """
+
+    def __init__(self, workers, executor='thread', window=None, initializer=None, initargs=()):
+        try:
+            executor_class = EXECUTORS[executor]
+        except KeyError:
+            raise ValueError('Unknown executor "{0}", use one of: {1}'.format(executor, ', '.join(EXECUTORS)))
+        self.shards = [executor_class(max_workers=1, initializer=initializer, initargs=initargs)
+                       for _ in range(workers)]
+        self._pending = threading.BoundedSemaphore(window or workers * 16)
+
+    def get_shard_index(self, key):
+        """
+        Return the shard index for a key
+
+        :param key: Shard key string
+        :return: Shard index
+        """
+        return zlib.crc32(key.encode('utf-8', 'surrogateescape')) % len(self.shards)
+
+    def submit(self, key, fn, *args):
+        """
+        Schedule a task in the shard for a key
+
+        :param key: Shard key string
+        :param fn: Task function
+        :param args: Task function arguments
+        :return: :class:`~concurrent.futures.Future` object
+        """
+        return self.submit_to(self.get_shard_index(key), fn, *args)
+
+    def submit_to(self, shard_index, fn, *args):
+        """
+        Schedule a task in a given shard
+
+        :param shard_index: Shard index
+        :param fn: Task function
+        :param args: Task function arguments
+        :return: :class:`~concurrent.futures.Future` object
+        """
+        self._pending.acquire()
+        try:
+            future = self.shards[shard_index].submit(fn, *args)
+        except Exception:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda f: self._pending.release())
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Shutdown all shard executors
+
+        :param wait: Wait for pending tasks. Default: True
+        """
+        for shard in self.shards:
+            shard.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
@@ -15,3 +15,11 @@ class RouteError(Exception):
 
 class MessageInstanceError(Exception):
     pass
+
+
+class AsyncActionError(TypeError):
+    pass
+
+
+class DecompressionSizeError(ValueError):
+    pass
@@ -7,18 +7,36 @@
     :copyright: (c) 2018 Daxslab.
     :license: LGPL, see LICENSE for more details.
 """
+import asyncio
 import atexit
-import copy
+import contextvars
 from email.message import Message
+import functools
+import inspect
 import logging
 import os
-import re
 import sys
 import tempfile
-
+import time
+
+from .dispatch import _init_process_worker
+from .dispatch import _process_dispatch
+from .dispatch import _process_flush_batches
+from .dispatch import BatchCollector
+from .dispatch import prefetch as prefetch_mails
+from .dispatch import ShardedExecutor
+from .dispatch import DispatchResult
 from .mailproc_email import Email
+from .metrics import Metrics
+from .tracing import tracer
+from .exceptions import AsyncActionError
 from .exceptions import MessageInstanceError
 from .exceptions import RouteError
+from .routing import AddressRouteMap
+from .routing import CONVERTERS
+from .routing import Route
+from .routing import RouteCache
+from .routing import RouteMap
 
 
 APP_NAME = "mailproc"
@@ -33,13 +51,23 @@ class Mailproc:
 
     :param name: The name of the mailProc application. This name will be
                  used for identify the current running application.
+    :param match_all: If True, run every action matching a route target
+                      instead of only the first registered one. Default: False
+    :param route_cache_size: Maximum number of route resolutions kept in the
+                             LRU route cache, 0 disables it. Default: 1024
     """
-    def __init__(self, name):
+    def __init__(self, name, match_all=False, route_cache_size=1024):
         self.name = name
+        self.match_all = match_all
         self.routes_actions = {
             'from': [],
             'subject': []
         }
+        self._route_maps = {}
+        self.route_cache = RouteCache(route_cache_size)
+        self.metrics = Metrics()
+        self.tracer = tracer
+        self.converters = dict(CONVERTERS)
         self.set_proc_name(APP_NAME)
         self._at_process_run()
 
@@ -112,38 +140,53 @@ class Mailproc:
         :param route: Route pattern string
         :return: Compiled regular expression
         """
-        route_regex = re.sub(r'(<\w+>)', r'(?P\1.+)', route)
-        return re.compile("^{0}$".format(route_regex))
+        return Route(route, None, None).pattern
 
-    def route(self, rule, routes_target):
+    def route(self, rule, routes_target, max_length=None, batch=False, max_batch=500):
         """
-        A decorator that is used to register an action for a given rule and target
+        A decorator that is used to register an action for a given rule and target.
+        Rule placeholders can be typed using one of the application `converters`,
+        as in ``'order <int:order_id>'``; matched values are converted before
+        being passed to the action.
+
+        Batch actions are called once with a list of (kwargs, mail) pairs
+        for all the mails of a run matching the rule, instead of once per
+        mail.
 
         :param rule: Match rule as string
         :param routes_target: Target to be applied the given rule, can be 'from'
                             or 'subject'
+        :param max_length: Skip the rule for paths longer than this number of
+                           characters. Default: None (no limit)
+        :param batch: Register a batch action. Default: False
+        :param max_batch: Maximum number of mails in a batch. Default: 500
         """
         def decorator(f):
-            route_pattern = self.build_route_pattern(rule)
-            self.routes_actions[routes_target].append((route_pattern, f))
+            route = Route(rule, routes_target, f, converters=self.converters, max_length=max_length,
+                          batch=batch, max_batch=max_batch)
+            self.routes_actions[routes_target].append(route)
+            self._route_maps.pop(routes_target, None)
+            self.route_cache.clear()
             return f
         return decorator
 
-    def route_from(self, route_str):
+    def route_from(self, route_str, **options):
         """
         A decorator that is used to register an action for an email "From" address
 
         :param route_str: Match rule as string
+        :param options: Additional route options, see :meth:`route`
         """
-        return self.route(route_str, 'from')
+        return self.route(route_str, 'from', **options)
 
-    def route_subject(self, route_str):
+    def route_subject(self, route_str, **options):
         """
         A decorator that is used to register an action for an email subject
 
         :param route_str: Match rule as string
+        :param options: Additional route options, see :meth:`route`
         """
-        return self.route(route_str, 'subject')
+        return self.route(route_str, 'subject', **options)
 
     def get_route_match(self, path, in_target):
         """
@@ -155,12 +198,64 @@ class Mailproc:
         :return: Returns function arguments and action function pair or
                  None if there is no matching actions.
         """
-        for route_pattern, action_function in self.routes_actions[in_target]:
-            m = route_pattern.match(path)
-            if m:
-                return m.groupdict(), action_function
+        route_matches = self._find_routes(path, in_target, False)
+        if route_matches:
+            kwargs, route = route_matches[0]
+            return dict(kwargs), route.action
         return None
 
+    def get_route_matches(self, path, in_target):
+        """
+        Find all matching registered action functions
+
+        :param path: Route string
+        :param in_target: Routes target to find the actions. Can be 'from'
+                          or 'subject'
+        :return: List of function arguments and action function pairs, in
+                 registration order
+        """
+        return [(dict(kwargs), route.action) for kwargs, route in self._find_routes(path, in_target, True)]
+
+    def _find_routes(self, path, in_target, match_all):
+        """
+        Resolve a route path through the route cache
+
+        :return: Tuple of (kwargs, route) pairs, empty if there is no match
+        """
+        def resolve():
+            route_map = self.get_route_map(in_target)
+            if match_all:
+                return tuple(route_map.match_all(path))
+            route_match = route_map.match(path)
+            return (route_match,) if route_match else ()
+
+        return self.route_cache.get((in_target, path, match_all), resolve)
+
+    def route_cache_info(self):
+        """
+        Return route cache statistics, useful for sizing the cache
+
+        :return: :class:`~mailproc.routing.RouteCacheInfo` named tuple with
+                 hits, misses, maxsize and currsize fields
+        """
+        return self.route_cache.info()
+
+    def get_route_map(self, in_target):
+        """
+        Return the compiled dispatch table for a routes target. The table is
+        built on first use and rebuilt after new routes are registered.
+        'from' routes are indexed by their literal domain and local parts.
+
+        :param in_target: Routes target. Can be 'from' or 'subject'
+        :return: :class:`~mailproc.routing.RouteMap` object
+        """
+        route_map = self._route_maps.get(in_target)
+        if route_map is None:
+            route_map_class = AddressRouteMap if in_target == 'from' else RouteMap
+            route_map = route_map_class(self.routes_actions[in_target])
+            self._route_maps[in_target] = route_map
+        return route_map
+
     def serve_route(self, path, target, **kwargs):
         """
         Run action functions matching a route path pattern and target
@@ -169,61 +264,474 @@ class Mailproc:
         :param target: Routes target to find the action. Can be 'from'
                        or 'subject'
         :param kwargs: Additional arguments to pass to the action
-        :return: Action function return value
+        :return: Action function return value, or a list of return values
+                 when the application runs in `match_all` mode
+        """
+        route_matches = self._find_routes(path, target, self.match_all)
+        if not route_matches:
+            raise RouteError('Route "{0}" has not been registered'.format(path))
+        return self._call_routes(route_matches, kwargs)
+
+    def _call_routes(self, route_matches, kwargs, batches=None, index=None):
+        """
+        Run the action functions of resolved routes
+
+        :param route_matches: Sequence of (kwargs, route) pairs
+        :param kwargs: Additional arguments to pass to the actions
+        :param batches: :class:`~mailproc.dispatch.BatchCollector` for batch
+                        actions, if None batch actions are called at once
+        :param index: Position of the mail in the dispatched sequence
+        :return: Action function return value, or a list of return values
+                 when the application runs in `match_all` mode
         """
-        route_match = self.get_route_match(path, target)
-        if route_match:
-            route_match_function_kwargs, action_function = route_match
+        results = []
+        for route_match_function_kwargs, route in route_matches:
             # join kwargs and route_match_function_kwargs dicts
-            kwargs = kwargs.copy()
-            kwargs.update(route_match_function_kwargs)
+            action_kwargs = kwargs.copy()
+            action_kwargs.update(route_match_function_kwargs)
+            self.metrics.observe_match(route)
+            if route.batch:
+                batch = self._add_to_batch(route, action_kwargs, batches, index)
+                results.append(self._call_batch(route, batch, batches) if batch else None)
+            else:
+                results.append(self._call_action(route, kwargs=action_kwargs))
 
-            return action_function(**kwargs)
-        else:
-            raise RouteError('Route "{0}" has not been registered'.format(path))
+        return results if self.match_all else results[0]
+
+    @staticmethod
+    def _add_to_batch(route, action_kwargs, batches, index):
+        """
+        Add a mail to the batch of a route
+
+        :return: List of (index, (kwargs, mail)) pairs ready to be processed or None
+        """
+        mail = action_kwargs.pop('mail', None)
+        item = (action_kwargs, mail)
+        if batches is None:
+            return [(index, item)]
+        return batches.add(route, item, index)
+
+    def _call_action(self, route, args=(), kwargs=None):
+        """
+        Call a route action recording its duration in the application metrics
+        """
+        start = time.perf_counter()
+        try:
+            result = self.tracer.call('action', route.rule, route.action, args, kwargs)
+            if inspect.iscoroutine(result):
+                result.close()
+                raise AsyncActionError('Action of route {0} returned a coroutine, use run_async() to run it'
+                                       .format(route))
+        except Exception:
+            self.metrics.observe_action(route, time.perf_counter() - start, failed=True)
+            raise
+        self.metrics.observe_action(route, time.perf_counter() - start)
+        return result
+
+    async def _call_action_async(self, route, args=(), kwargs=None):
+        """
+        Await a coroutine route action recording its duration in the
+        application metrics
+        """
+        start = time.perf_counter()
+        try:
+            with self.tracer.span('action', route.rule):
+                result = await route.action(*args, **(kwargs or {}))
+        except Exception:
+            self.metrics.observe_action(route, time.perf_counter() - start, failed=True)
+            raise
+        self.metrics.observe_action(route, time.perf_counter() - start)
+        return result
+
+    def _call_batch(self, route, batch, batches):
+        """
+        Call a batch action
+
+        :param route: :class:`~mailproc.routing.Route` object
+        :param batch: List of (index, (kwargs, mail)) pairs
+        :param batches: :class:`~mailproc.dispatch.BatchCollector` object or None
+        :return: Action function return value
+        """
+        items = [item for _, item in batch]
+        if batches is None or not batches.capture_errors:
+            return self._call_action(route, (items,))
+        try:
+            return self._call_action(route, (items,))
+        except Exception as e:
+            logging.exception('Batch action {0} failed'.format(route))
+            batches.errors.append(([index for index, _ in batch], e))
+        return None
+
+    def flush_batches(self, batches):
+        """
+        Call batch actions for all pending batches
+
+        :param batches: :class:`~mailproc.dispatch.BatchCollector` object
+        :return: List of (mail indexes, exception) pairs for failed batch
+                 actions when errors are captured
+        """
+        for route, batch in batches.pop_all():
+            self._call_batch(route, batch, batches)
+        return batches.errors
+
+    def _flush_worker(self, batches):
+        """
+        Flush the batches of a parallel run worker
+
+        :return: Pair of batch errors and metrics raw state to be merged in
+                 the main application, or None for thread workers which
+                 share the application metrics
+        """
+        return self.flush_batches(batches), None
+
+    async def _call_routes_async(self, route_matches, kwargs, batches=None, index=None):
+        """
+        Run the action functions of resolved routes from a coroutine.
+        Coroutine functions are awaited, other functions run in the
+        event loop default executor.
+
+        :param route_matches: Sequence of (kwargs, route) pairs
+        :param kwargs: Additional arguments to pass to the actions
+        :param batches: :class:`~mailproc.dispatch.BatchCollector` for batch actions
+        :param index: Position of the mail in the dispatched sequence
+        :return: Action function return value, or a list of return values
+                 when the application runs in `match_all` mode
+        """
+        loop = asyncio.get_running_loop()
+        results = []
+        for route_match_function_kwargs, route in route_matches:
+            action_kwargs = kwargs.copy()
+            action_kwargs.update(route_match_function_kwargs)
+            self.metrics.observe_match(route)
+            if route.batch:
+                batch = self._add_to_batch(route, action_kwargs, batches, index)
+                results.append(await self._call_batch_async(route, batch, batches) if batch else None)
+            elif inspect.iscoroutinefunction(route.action):
+                results.append(await self._call_action_async(route, kwargs=action_kwargs))
+            else:
+                # the context carries the current trace to the worker thread
+                results.append(await loop.run_in_executor(
+                    None, functools.partial(contextvars.copy_context().run, self._call_action, route,
+                                            kwargs=action_kwargs)))
+
+        return results if self.match_all else results[0]
+
+    async def _call_batch_async(self, route, batch, batches):
+        """
+        Call a batch action from a coroutine, see :meth:`_call_batch`
+        """
+        if not inspect.iscoroutinefunction(route.action):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, contextvars.copy_context().run, self._call_batch, route,
+                                              batch, batches)
+        items = [item for _, item in batch]
+        try:
+            return await self._call_action_async(route, (items,))
+        except Exception as e:
+            logging.exception('Batch action {0} failed'.format(route))
+            batches.errors.append(([index for index, _ in batch], e))
+        return None
+
+    def _serve_mail_route(self, path, target, **kwargs):
+        """
+        Run action functions matching a route path, logging missing routes
+        instead of raising :class:`~mailproc.exceptions.RouteError`
+        """
+        route_matches = self._find_routes(path, target, self.match_all)
+        if not route_matches:
+            logging.info('Route "{0}" has not been registered for "{1}"'.format(path, target))
+            return None
+        return self._call_routes(route_matches, kwargs)
 
     def serve(self, path, in_routes=None, **kwargs):
         if not in_routes:
             in_routes = self.routes_actions.keys()
         for route in in_routes:
-            try:
-                self.serve_route(path, route, **kwargs)
-            except RouteError as e:
-                logging.info('{0} for "{1}"'.format(e, route))
+            self._serve_mail_route(path, route, **kwargs)
 
     @staticmethod
     def to_mailproc_email(message):
         """
-        Return a copy of Message object as a mailproc.Email instance
+        Return a Message object as a mailproc.Email instance, sharing its
+        state instead of copying it
 
         :param message: :class:`~email.message.Message` object
         :return: :class:`mailproc.Email` object
         """
-        new_message = copy.copy(message)
-        new_message.__class__ = Email
-        return new_message
+        return Email.from_message(message)
 
-    def run(self, mails):
+    def dispatch_mail(self, mail, index=None, capture_errors=False, batches=None):
+        """
+        Apply registered actions to a single Message object
+
+        :param mail: :class:`~email.message.Message` object
+        :param index: Position of the mail in the dispatched sequence
+        :param capture_errors: If True, exceptions raised by actions are
+                               returned in the result instead of raised
+        :param batches: :class:`~mailproc.dispatch.BatchCollector` collecting
+                        mails for batch actions. Default: None (call batch
+                        actions at once)
+        :return: :class:`~mailproc.dispatch.DispatchResult` object
         """
-        Apply registered actions to Message objects
+        mail = self.to_mailproc_email(mail)
+        trace_token = self.tracer.activate(mail)
+        try:
+            sender, paths = self._get_mail_paths(mail)
+            results = {}
+            error = None
+            try:
+                for target, path in paths:
+                    route_matches = self._find_mail_routes(path, target)
+                    if route_matches:
+                        results[target] = self._call_routes(route_matches, {'mail': mail}, batches, index)
+            except Exception as e:
+                if not capture_errors:
+                    raise
+                logging.exception('Action failed for mail from "{0}"'.format(sender))
+                error = e
+        finally:
+            self.tracer.deactivate(trace_token)
+        self.metrics.observe_message()
+        return DispatchResult(index, mail['Message-ID'], sender, results, error)
+
+    def would_route(self, mail):
+        """
+        Return True if a mail matches any registered route, without running
+        actions. Only the 'From' and 'Subject' headers are used, so receiver
+        transports can call it before downloading the mail body
 
-        :param mails: A list of :class:`~email.message.Message` objects
+        :param mail: :class:`~email.message.Message` object, headers only
+                     messages allowed
+        :return: True if any action would be run for the mail
         """
+        sender, paths = self._get_mail_paths(self.to_mailproc_email(mail))
+        return any(self._find_routes(path, target, False) for target, path in paths)
 
-        for mail in mails:
+    def _get_mail_paths(self, mail):
+        """
+        Return the mail 'From' address and the (target, path) pairs to route
+        """
+        with self.tracer.span('header_decode'):
+            sender = mail.get_from_address()
+            return sender, (('from', sender), ('subject', mail.get_subject()))
+
+    def _find_mail_routes(self, path, target):
+        """
+        Resolve the routes for a mail path, logging missing routes
+        """
+        with self.tracer.span('route_match', target):
+            route_matches = self._find_routes(path, target, self.match_all)
+        if not route_matches:
+            logging.info('Route "{0}" has not been registered for "{1}"'.format(path, target))
+            self.metrics.observe_miss(target)
+        return route_matches
+
+    def run(self, mails, workers=None, executor='thread', prefetch=0, ack=None):
+        """
+        Apply registered actions to Message objects. Actions get the mail
+        as a :class:`mailproc.Email` object.
+
+        When `workers` is given, actions run in a pool of threads or
+        processes. Mails from the same 'From' address are always processed
+        in order by the same worker, and exceptions raised by actions are
+        captured in the results instead of raised. Process workers require
+        picklable actions and return values.
+
+        Batch actions get the mails of the run matching their routes when a
+        batch is full and when the run ends. The results of batched mails
+        hold None for the batch route. When running in parallel each worker
+        collects its own batches.
+
+        Actions defined with ``async def`` can't be run this way, see
+        :meth:`run_async`.
+
+        Mails are consumed lazily, so iterators such as the ones returned by
+        receiver transports `iter_mails` methods are processed while
+        they are fetched. With `prefetch`, mails are fetched from a background
+        thread keeping at most that number of mails waiting in memory.
+
+        :param mails: An iterable of :class:`~email.message.Message` objects
+        :param workers: Number of parallel workers. Default: None (run
+                        actions in the calling thread)
+        :param executor: Workers type, can be 'thread' or 'process'. Default: 'thread'
+        :param prefetch: Number of mails fetched ahead in a background
+                         thread. Default: 0 (fetch mails when needed)
+        :param ack: Function called when the run ends with the list of
+                    results of the mails whose actions, batch actions
+                    included, succeeded, as receiver transports `ack`
+                    methods. Default: None
+        :return: List of :class:`~mailproc.dispatch.DispatchResult` objects,
+                 one per mail
+        """
+        self._check_sync_actions()
+        if prefetch:
+            mails = prefetch_mails(mails, prefetch)
+
+        if not workers:
+            batches = BatchCollector()
+            results = [self.dispatch_mail(mail, index, batches=batches)
+                       for index, mail in enumerate(self._check_mails(mails))]
+            self.flush_batches(batches)
+            return self._ack_results(results, ack)
+
+        with ShardedExecutor(workers, executor, **self._get_worker_options(executor)) as pool:
+            if executor == 'process':
+                dispatchers = [_process_dispatch] * workers
+                flushers = [_process_flush_batches] * workers
+            else:
+                shard_batches = [BatchCollector(capture_errors=True) for _ in range(workers)]
+                dispatchers = [functools.partial(self.dispatch_mail, capture_errors=True, batches=batches)
+                               for batches in shard_batches]
+                flushers = [functools.partial(self._flush_worker, batches) for batches in shard_batches]
+
+            futures = []
+            for index, mail in enumerate(self._check_mails(mails)):
+                mail = self.to_mailproc_email(mail)
+                shard_index = pool.get_shard_index(mail.get_from_address() or '')
+                futures.append(pool.submit_to(shard_index, dispatchers[shard_index], mail, index))
+            flush_futures = [pool.submit_to(shard_index, flushers[shard_index]) for shard_index in range(workers)]
+
+            results = [future.result() for future in futures]
+            for future in flush_futures:
+                batch_errors, metrics_state = future.result()
+                self._set_batch_errors(results, batch_errors)
+                if metrics_state:
+                    self.metrics.merge(metrics_state)
+            return self._ack_results(results, ack)
 
-            if not isinstance(mail, Message):
-                raise MessageInstanceError("run() function requires instances from email.Messge class, found: {0}"
-                                           .format(type(mail).__name__))
+    @staticmethod
+    def _ack_results(results, ack):
+        """
+        Acknowledge the results without errors
+        """
+        if ack is not None:
+            ack([result for result in results if result.error is None])
+        return results
+
+    def _get_worker_options(self, executor):
+        if executor == 'process':
+            return {'initializer': _init_process_worker, 'initargs': (self,)}
+        return {}
 
-            steroids_mail = self.to_mailproc_email(mail)
+    @staticmethod
+    def _set_batch_errors(results, batch_errors):
+        """
+        Set batch action exceptions in the results of the batched mails
+        """
+        for indexes, error in batch_errors:
+            for index in indexes:
+                results[index] = results[index]._replace(error=error)
 
+    async def dispatch_mail_async(self, mail, index=None, batches=None):
+        """
+        Apply registered actions to a single Message object from a coroutine.
+        Exceptions raised by actions are returned in the result.
+
+        :param mail: :class:`~email.message.Message` object
+        :param index: Position of the mail in the dispatched sequence
+        :param batches: :class:`~mailproc.dispatch.BatchCollector` collecting
+                        mails for batch actions
+        :return: :class:`~mailproc.dispatch.DispatchResult` object
+        """
+        mail = self.to_mailproc_email(mail)
+        trace_token = self.tracer.activate(mail)
+        try:
+            sender, paths = self._get_mail_paths(mail)
+            results = {}
+            error = None
             try:
-                self.serve_route(steroids_mail.get_from_address(), 'from', mail=mail)
-            except RouteError as e:
-                logging.info('{0} for "{1}"'.format(e, 'from'))
+                for target, path in paths:
+                    route_matches = self._find_mail_routes(path, target)
+                    if route_matches:
+                        results[target] = await self._call_routes_async(route_matches, {'mail': mail}, batches, index)
+            except Exception as e:
+                logging.exception('Action failed for mail from "{0}"'.format(sender))
+                error = e
+        finally:
+            self.tracer.deactivate(trace_token)
+        self.metrics.observe_message()
+        return DispatchResult(index, mail['Message-ID'], sender, results, error)
+
+    async def run_async(self, mails, concurrency=100, ack=None):
+        """
+        Apply registered actions to Message objects from a coroutine. Actions
+        defined with ``async def`` are awaited in the event loop and other
+        actions run in the event loop default executor. Exceptions raised by
+        actions are returned in the results instead of raised.
+
+        :param mails: An iterable or asynchronous iterable of
+                      :class:`~email.message.Message` objects
+        :param concurrency: Maximum number of mails processed at the same
+                            time. Default: 100
+        :param ack: Function called when the run ends with the list of
+                    results of the mails whose actions succeeded, see
+                    :meth:`run`. Default: None
+        :return: List of :class:`~mailproc.dispatch.DispatchResult` objects,
+                 one per mail
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        batches = BatchCollector(capture_errors=True)
 
+        async def dispatch(mail, index):
             try:
-                self.serve_route(steroids_mail.get_subject(), 'subject', mail=mail)
-            except RouteError as e:
-                logging.info('{0} for "{1}"'.format(e, 'subject'))
+                return await self.dispatch_mail_async(mail, index, batches)
+            finally:
+                semaphore.release()
+
+        if not hasattr(mails, '__aiter__'):
+            mails = self._iter_async(mails)
+
+        tasks = []
+        index = 0
+        try:
+            async for mail in mails:
+                self._check_mail(mail)
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(dispatch(mail, index)))
+                index += 1
+        except BaseException:
+            # mails already dispatched are not left running
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        results = await asyncio.gather(*tasks)
+
+        for route, batch in batches.pop_all():
+            await self._call_batch_async(route, batch, batches)
+        self._set_batch_errors(results, batches.errors)
+        return self._ack_results(results, ack)
+
+    @staticmethod
+    async def _iter_async(mails):
+        for mail in mails:
+            yield mail
+
+    def _check_sync_actions(self):
+        """
+        Raise :class:`~mailproc.exceptions.AsyncActionError` if any route
+        action is a coroutine function, which only :meth:`run_async` awaits
+        """
+        for routes in self.routes_actions.values():
+            for route in routes:
+                if inspect.iscoroutinefunction(route.action):
+                    raise AsyncActionError('Action of route {0} is a coroutine function, use run_async() to run it'
+                                           .format(route))
+
+    @staticmethod
+    def _check_mail(mail):
+        if not isinstance(mail, Message):
+            raise MessageInstanceError("run() function requires instances from email.Messge class, found: {0}"
+                                       .format(type(mail).__name__))
+
+    @staticmethod
+    def _check_mails(mails):
+        for mail in mails:
+            Mailproc._check_mail(mail)
+            yield mail
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # dispatch tables are rebuilt on first use
+        state['_route_maps'] = {}
+        return state
@@ -10,14 +10,177 @@
 
 from io import StringIO
 import sys
-import base64
-import gzip
-import json
+import codecs
 import logging
+import re
 
 from email.message import Message
 from email.header import decode_header
+from email.header import Header
+from email.feedparser import FeedParser
+from email.parser import HeaderParser
+from email.parser import Parser
 import email
+import email.policy
+import email.utils
+
+from .compression import detect_codec
+from .spool import SpooledPayload
+from .compression import get_codec
+from .streams import ENCODING_PARAM
+from .streams import iter_base64_decoded
+from .streams import iter_json_records
+from .streams import iter_text
+from .streams import iter_transfer_decoded
+from .streams import load_json
+from .streams import STREAM_CHUNK_SIZE
+
+
+# bytes of body payload decoded at once by Email.iter_body
+BODY_CHUNK_SIZE = 64 * 1024
+
+HEADERS_END_RE = re.compile(r'\r?\n\r?\n')
+HEADERS_END_BYTES_RE = re.compile(rb'\r?\n\r?\n')
+
+# policy used for parsing emails, compat32 keeps headers as raw strings
+EMAIL_POLICY = email.policy.compat32
+
+# Email attributes not replaced when the lazy body is parsed
+LAZY_KEPT_ATTRIBUTES = ('_headers', '_unixfrom', '_mailproc_raw', '_mailproc_lazy',
+                        '_mailproc_header_cache', '_mailproc_trace', '_mailproc_spool_threshold')
+
+
+# common address forms: 'addr', '<addr>', 'Name <addr>' and '"Name" <addr>'
+_ATOM = r'[^\s"<>@,;:\\()\[\]]+'
+_ADDR = r'[^\s"<>@,;:\\()\[\]]+@[^\s"<>@,;:\\()\[\]]+'
+ADDRESS_RE = re.compile(r'''
+    ^\s*(?:
+        (?:"(?P<quoted_name>[^"\\\r\n]*)" | (?P<name>(?:{atom}(?:\x20{atom})*)?))
+        \s*<(?P<angle_addr>{addr})>
+        |
+        (?P<addr>{addr})
+    )\s*$
+'''.format(atom=_ATOM, addr=_ADDR), re.VERBOSE)
+
+
+def normalize_address(address):
+    """
+    Return an email address with the domain lowercased
+
+    :param address: Email address string
+    :return: Normalized email address string
+    """
+    local, at, domain = address.rpartition('@')
+    if not at:
+        return address
+    return local + at + domain.lower()
+
+
+def parse_address(value):
+    """
+    Split an address header value in (name, address) pairs, as
+    :func:`email.utils.parseaddr` does. Common address forms are parsed
+    with a precompiled regular expression, falling back to
+    :func:`~email.utils.parseaddr` for the rest. The address domain is
+    lowercased.
+
+    :param value: Address header string, None for missing headers
+    :return: (name, address) pair, ('', '') for missing headers
+    """
+    if value is None:
+        return '', ''
+    m = ADDRESS_RE.match(value) if isinstance(value, str) else None
+    if m:
+        address = m.group('angle_addr') or m.group('addr')
+        name = m.group('quoted_name')
+        if name is None:
+            name = m.group('name') or ''
+    else:
+        name, address = email.utils.parseaddr(str(value))
+    return name, normalize_address(address)
+
+
+def _raw_to_str(raw):
+    """
+    Return a raw message as the str expected by :mod:`email` parsers,
+    escaping 8-bit bytes as :class:`~email.parser.BytesParser` does
+    """
+    if isinstance(raw, str):
+        return raw
+    if isinstance(raw, SpooledPayload):
+        return raw.get_text()
+    return str(raw, 'ascii', 'surrogateescape')
+
+
+class Attachment:
+    """
+    Attachment of an :class:`Email`. The attachment metadata is read when
+    the email attachments index is built, the payload is decoded only when
+    requested.
+
+    :param part: Attachment MIME part
+    """
+
+    def __init__(self, part):
+        self.part = part
+        self.filename = part.get_filename()
+        self.content_type = part.get_content_type()
+        self.disposition = part.get_content_disposition()
+        spool = part.__dict__.get('_mailproc_spool')
+        if spool is not None:
+            self.size = len(spool)
+        else:
+            payload = part._payload
+            self.size = len(payload) if isinstance(payload, (str, bytes)) else 0
+
+    @property
+    def is_spooled(self):
+        """
+        True if the attachment payload is spooled to a temporary file
+        """
+        return '_mailproc_spool' in self.part.__dict__
+
+    def get_payload(self):
+        """
+        Return the attachment payload, decoding its transfer encoding
+
+        :return: Attachment payload bytes
+        """
+        return self.part.get_payload(decode=True)
+
+    def iter_payload(self, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Iterate over the attachment payload, decoding its transfer encoding
+        chunk by chunk
+
+        :param chunk_size: Size of the encoded chunks to decode
+        :return: Iterator over payload bytes
+        """
+        spool = self.part.__dict__.get('_mailproc_spool')
+        return iter_transfer_decoded(self.part, chunk_size, spool.view if spool is not None else None)
+
+    def get_raw_payload(self):
+        """
+        Return the attachment payload as it is in the message, without
+        decoding its transfer encoding. Spooled payloads are returned as a
+        :class:`memoryview` of the memory-mapped temporary file, without
+        loading them in memory
+
+        :return: Payload bytes-like object
+        """
+        spool = self.part.__dict__.get('_mailproc_spool')
+        if spool is not None:
+            return spool.view
+        payload = self.part.get_payload()
+        if not isinstance(payload, str):
+            return b''
+        try:
+            return payload.encode('ascii', 'surrogateescape')
+        except UnicodeEncodeError:
+            return payload.encode('utf-8')
+
+    def __repr__(self):
+        return '<Attachment {0!r} {1} {2} bytes>'.format(self.filename, self.content_type, self.size)
 
 
 class Email(Message):
@@ -27,6 +190,231 @@ class Email(Message):
 
     """
 
+    @classmethod
+    def from_bytes(cls, data, lazy=True, spool_threshold=None):
+        """
+        Parse an Email from a raw message. Lazy emails parse only the
+        headers at first, and parse the MIME body the first time it is
+        accessed, as when calling :meth:`get_body`, :meth:`get_json_attachment`
+        or :meth:`walk`. The raw message is kept available through
+        :meth:`get_raw`
+
+        Messages larger than `spool_threshold` bytes are spooled to a
+        temporary file, as the parts payloads larger than it once parsed,
+        keeping them out of the process memory. See :meth:`Attachment.get_raw_payload`
+
+        :param data: Raw message as bytes, bytes-like object (as
+                     :class:`memoryview`), binary file object or
+                     :class:`~mailproc.spool.SpooledPayload` object
+        :param lazy: Delay the body parsing until it is accessed. Default: True
+        :param spool_threshold: Size in bytes above which the message and the
+                                parts payloads are spooled to temporary
+                                files. Default: None (never)
+        :return: :class:`Email` object
+        """
+        if hasattr(data, 'read'):
+            # copied to the spool without loading it in memory
+            data = SpooledPayload(data) if spool_threshold is not None else data.read()
+
+        raw = data
+        if isinstance(data, SpooledPayload):
+            data = raw.view
+        elif spool_threshold is not None and len(data) > spool_threshold:
+            raw = SpooledPayload(data)
+            data = raw.view
+
+        if not lazy:
+            mail = cls._parse(raw, spool_threshold)
+            mail._mailproc_raw = raw
+            return mail
+
+        headers_end = HEADERS_END_BYTES_RE.search(data)
+        headers = memoryview(data)[:headers_end.end()] if headers_end else data
+        mail = cls._from_headers(_raw_to_str(headers), raw)
+        if spool_threshold is not None:
+            mail._mailproc_spool_threshold = spool_threshold
+        return mail
+
+    @classmethod
+    def from_string(cls, text, lazy=True):
+        """
+        Parse an Email from a raw message string, see :meth:`from_bytes`
+
+        :param text: Raw message string
+        :param lazy: Delay the body parsing until it is accessed. Default: True
+        :return: :class:`Email` object
+        """
+        if not lazy:
+            mail = Parser(_class=cls, policy=EMAIL_POLICY).parsestr(text)
+            mail._mailproc_raw = text
+            return mail
+
+        headers_end = HEADERS_END_RE.search(text)
+        headers = text[:headers_end.end()] if headers_end else text
+        return cls._from_headers(headers, text)
+
+    @classmethod
+    def _parse(cls, raw, spool_threshold=None):
+        """
+        Parse a raw message. Spooled messages are fed to the parser chunk by
+        chunk instead of loading them at once. Parts payloads larger than
+        `spool_threshold` characters are moved to temporary files as soon
+        as each part is parsed, see :class:`~mailproc.spool.SpooledPayload`
+        """
+        def spooling_factory(policy=EMAIL_POLICY):
+            part = cls(policy=policy)
+            part._mailproc_parse_spool = spool_threshold
+            return part
+
+        factory = cls if spool_threshold is None else spooling_factory
+        parser = FeedParser(_factory=factory, policy=EMAIL_POLICY)
+        for chunk in raw.iter_text() if isinstance(raw, SpooledPayload) else (_raw_to_str(raw),):
+            parser.feed(chunk)
+        mail = parser.close()
+        if spool_threshold is not None:
+            for part in mail.walk():
+                part.__dict__.pop('_mailproc_parse_spool', None)
+        return mail
+
+    @classmethod
+    def _from_headers(cls, headers, raw):
+        mail = HeaderParser(_class=cls, policy=EMAIL_POLICY).parsestr(headers)
+        mail._payload = None
+        mail._mailproc_raw = raw
+        mail._mailproc_lazy = True
+        return mail
+
+    def _materialize(self):
+        """
+        Parse the body of a lazy email
+        """
+        if not self.__dict__.pop('_mailproc_lazy', False):
+            return
+        parsed = self._parse(self._mailproc_raw, self.__dict__.get('_mailproc_spool_threshold'))
+        for name, value in parsed.__dict__.items():
+            if name not in LAZY_KEPT_ATTRIBUTES:
+                self.__dict__[name] = value
+
+    def get_raw(self):
+        """
+        Return the raw message as it was received, useful for forwarding
+        it unchanged
+
+        :return: Raw message bytes or bytes-like object, None for emails
+                 not parsed by mailProc
+        """
+        raw = self.__dict__.get('_mailproc_raw')
+        if isinstance(raw, str):
+            return raw.encode('utf-8', 'surrogateescape')
+        if isinstance(raw, SpooledPayload):
+            return raw.view
+        return raw
+
+    @property
+    def is_lazy(self):
+        """
+        True if the email body has not been parsed yet
+        """
+        return self.__dict__.get('_mailproc_lazy', False)
+
+    def walk(self):
+        self._materialize()
+        return super(Email, self).walk()
+
+    def is_multipart(self):
+        self._materialize()
+        return super(Email, self).is_multipart()
+
+    def get_payload(self, i=None, decode=False):
+        self._materialize()
+        spool = self.__dict__.get('_mailproc_spool')
+        if spool is not None:
+            # load the spooled payload for this call only
+            message = Message()
+            message._headers = self._headers
+            message._payload = spool.get_text()
+            return message.get_payload(i, decode)
+        return super(Email, self).get_payload(i, decode)
+
+    def set_payload(self, payload, charset=None):
+        self.__dict__.pop('_mailproc_lazy', None)
+        self.__dict__.pop('_mailproc_spool', None)
+        self.__dict__.pop('_mailproc_attachments', None)
+        spool_threshold = self.__dict__.pop('_mailproc_parse_spool', None)
+        if spool_threshold is not None and isinstance(payload, str) and len(payload) > spool_threshold:
+            # spooled while the rest of the message is parsed
+            super(Email, self).set_payload('', charset)
+            self._mailproc_spool = SpooledPayload(payload)
+            return
+        return super(Email, self).set_payload(payload, charset)
+
+    def attach(self, payload):
+        self._materialize()
+        self.__dict__.pop('_mailproc_attachments', None)
+        return super(Email, self).attach(payload)
+
+    @classmethod
+    def from_message(cls, message):
+        """
+        Return an Email view of a :class:`~email.message.Message` object. The
+        view shares the message state instead of copying it, so changes made
+        through any of them are seen by both.
+
+        :param message: :class:`~email.message.Message` object
+        :return: :class:`Email` object
+        """
+        if isinstance(message, cls):
+            return message
+        view = cls.__new__(cls)
+        view.__dict__ = message.__dict__
+        return view
+
+    def _cached_header(self, name, key, decode):
+        """
+        Return a decoded header value, cached until the header is modified.
+        The raw value is also checked, as views of the same message can be
+        modified through the original :class:`~email.message.Message`
+
+        :param name: Header name
+        :param key: Cache key for the decoded value
+        :param decode: Function decoding the raw header value
+        :return: Decoded header value
+        """
+        raw = self[name]
+        cache = self.__dict__.setdefault('_mailproc_header_cache', {})
+        try:
+            cached_raw, value = cache[key]
+            if cached_raw is raw or cached_raw == raw:
+                return value
+        except KeyError:
+            pass
+        value = decode(raw)
+        cache[key] = (raw, value)
+        return value
+
+    def _clear_header_cache(self):
+        self.__dict__.pop('_mailproc_header_cache', None)
+
+    def __setitem__(self, name, val):
+        self._clear_header_cache()
+        super(Email, self).__setitem__(name, val)
+
+    def __delitem__(self, name):
+        self._clear_header_cache()
+        super(Email, self).__delitem__(name)
+
+    def add_header(self, _name, _value, **_params):
+        self._clear_header_cache()
+        super(Email, self).add_header(_name, _value, **_params)
+
+    def replace_header(self, _name, _value):
+        self._clear_header_cache()
+        super(Email, self).replace_header(_name, _value)
+
+    def set_raw(self, name, value):
+        self._clear_header_cache()
+        super(Email, self).set_raw(name, value)
+
     def _walk_email(self):
         for part in self.walk():
             if part.get_content_type() == "multipart/alternative":
@@ -38,13 +426,31 @@ class Email(Message):
         """
         Return a decoded mime header string
 
-        :param s: String to decode
-        :return: Decoded string
+        :param s: String to decode, None for missing headers
+        :return: Decoded string, empty for missing headers
         """
+        if s is None:
+            return ''
+        if isinstance(s, str) and '=?' not in s:
+            # no encoded words to decode
+            return s
         return u''.join(
-            word.decode(encoding or 'utf8') if isinstance(word, bytes) else word
+            Email._decode_word(word, encoding) if isinstance(word, bytes) else word
             for word, encoding in decode_header(s))
 
+    @staticmethod
+    def _decode_word(word, encoding):
+        """
+        Decode a header word, falling back to utf-8 and latin-1 for unknown
+        or wrong charsets, as in raw 8-bit headers
+        """
+        for charset in (encoding or 'utf8', 'utf8'):
+            try:
+                return word.decode(charset)
+            except (LookupError, UnicodeDecodeError):
+                continue
+        return word.decode('latin-1')
+
     def get_from(self):
         """
         Return the raw 'From' header
@@ -57,9 +463,9 @@ class Email(Message):
         """
         Return 'From' header email address
 
-        :return: From email address string
+        :return: From email address string, with the domain lowercased
         """
-        return email.utils.parseaddr(self.get_from())[1]
+        return self._cached_header('From', 'from_address', lambda raw: parse_address(raw)[1])
 
     def get_from_name(self, decode=True):
         """
@@ -68,10 +474,16 @@ class Email(Message):
         :param decode: If True, try to decode
         :return: Email From header name string
         """
-        name = email.utils.parseaddr(self.get_from())[0]
-        if decode:
-            name = self.decode_mime_words(name)
-        return name
+        def parse_name(from_header):
+            if isinstance(from_header, Header):
+                # raw 8-bit header
+                from_header = self.decode_mime_words(from_header)
+            name = parse_address(from_header)[0]
+            if decode:
+                name = self.decode_mime_words(name)
+            return name
+
+        return self._cached_header('From', ('from_name', decode), parse_name)
 
     def get_subject(self, decode=True):
         """
@@ -80,76 +492,209 @@ class Email(Message):
         :param decode: If True, try to decode
         :return: Email subject string
         """
-        subject = self['Subject']
         if decode:
-            subject = self.decode_mime_words(subject)
-        return subject
+            return self._cached_header('Subject', 'subject', self.decode_mime_words)
+        return self['Subject']
 
-    def get_body(self, html=False):
+    def iter_body(self, html=False):
         """
-        Return Email body
+        Iterate over the Email body text, decoding it part by part in
+        chunks of up to `BODY_CHUNK_SIZE` bytes, transfer encoding
+        included, so the rest of a part is not decoded when the iteration
+        stops. Parts without charset are
+        decoded as utf-8, undecodable bytes are replaced.
 
         :param html: Get Email HTML body. Default: False
-        :return: Email body
+        :return: Iterator over decoded body strings
         """
         content_type = "text/plain" if not html else "text/html"
-        body = ''
         for part in self._walk_email():
-            if part.get_content_type() == content_type:
-                body += part.get_payload(decode=True).decode(part.get_content_charset())
-        return body
+            if part.get_content_type() != content_type:
+                continue
+            if isinstance(part, Email):
+                part._materialize()
+            spool = part.__dict__.get('_mailproc_spool')
+            # the raw payload, get_payload checks the whole string for 8-bit characters
+            payload = spool.view if spool is not None else part._payload
+            payloads = iter_transfer_decoded(part, BODY_CHUNK_SIZE, payload)
+            decoder = self._get_body_decoder(part.get_content_charset())
+            for payload in payloads:
+                data = memoryview(payload)
+                for start in range(0, len(data), BODY_CHUNK_SIZE):
+                    chunk = decoder.decode(data[start:start + BODY_CHUNK_SIZE])
+                    if chunk:
+                        yield chunk
+            chunk = decoder.decode(b'', final=True)
+            if chunk:
+                yield chunk
 
-    def get_json_attachment(self, attachment_name=None, attachment_content_type=None,
-                            base64_decode=False, gzipped=False, email_encode='utf-8'):
+    @staticmethod
+    def _get_body_decoder(charset):
+        """
+        Return an incremental decoder for a body charset, falling back to
+        utf-8 for missing or unknown charsets
         """
-        Return a json object stored in attachment
+        try:
+            return codecs.getincrementaldecoder(charset or 'utf8')(errors='replace')
+        except LookupError:
+            return codecs.getincrementaldecoder('utf8')(errors='replace')
 
-        :param attachment_name: Name of attachment file to find
-        :param attachment_content_type: Content type of attachment file to find
-        :param base64_decode: If true looks for a base64 encoded json file
-        :param gzipped: If true try to unzip an attachment gzip file
-        :param email_encode: Encoding for treat body attachments. Default: 'utf-8'
-        :return: Json object stored in email attachment
+    def get_body(self, html=False, max_chars=None):
         """
-        if self.get_content_maintype() != 'multipart':
-            return False
+        Return Email body
 
-        for part in self.walk():
-            if part.get_content_maintype() == 'multipart':
-                continue
-            if part.get('Content-Disposition') is None:
-                continue
+        :param html: Get Email HTML body. Default: False
+        :param max_chars: Return at most this number of characters, the rest
+                          of the body is not decoded. Default: None (all)
+        :return: Email body
+        """
+        if max_chars is None:
+            return ''.join(self.iter_body(html))
 
-            # attachment filename
-            filename = part.get_filename()
-            if attachment_name and filename != attachment_name:
-                continue
+        chunks = []
+        for chunk in self.iter_body(html):
+            chunks.append(chunk[:max_chars])
+            max_chars -= len(chunks[-1])
+            if max_chars <= 0:
+                break
+        return ''.join(chunks)
 
-            # attachment content type
-            content_type = part.get_content_type()
-            if attachment_content_type and content_type != attachment_content_type:
-                continue
+    def _get_attachments_index(self):
+        """
+        Return the attachments index, walking the MIME tree the first time.
+        The index is reset when the payload is changed through
+        :meth:`set_payload` or :meth:`attach`
 
-            # attachment decoded body
-            body = part.get_payload(decode=True)
+        :return: (attachments, attachments by filename, attachments by
+                 content type) tuple
+        """
+        index = self.__dict__.get('_mailproc_attachments')
+        if index is not None:
+            return index
 
-            # decompress gzipped file
-            if gzipped:
-                try:
-                    body = gzip.decompress(body)
-                except ValueError as e:
-                    logging.error('get_json_attachment gzip error: {0}'.format(e))
+        attachments, by_filename, by_content_type = [], {}, {}
+        if self.get_content_maintype() == 'multipart':
+            for part in self.walk():
+                if part.get_content_maintype() == 'multipart':
                     continue
+                if part.get('Content-Disposition') is None:
+                    continue
+                attachment = Attachment(part)
+                attachments.append(attachment)
+                by_filename.setdefault(attachment.filename, []).append(attachment)
+                by_content_type.setdefault(attachment.content_type, []).append(attachment)
 
-            # decode base64
-            if base64_decode:
-                body = base64.b64decode(body)
+        index = self.__dict__['_mailproc_attachments'] = (attachments, by_filename, by_content_type)
+        return index
 
-            # check if is a json string
+    def iter_attachments(self, filename=None, content_type=None):
+        """
+        Iterate over the Email attachments, in MIME tree order
+
+        :param filename: Only attachments with this filename
+        :param content_type: Only attachments with this content type
+        :return: Iterator over :class:`Attachment` objects
+        """
+        attachments, by_filename, by_content_type = self._get_attachments_index()
+        if filename:
+            attachments = by_filename.get(filename, ())
+        elif content_type:
+            attachments = by_content_type.get(content_type, ())
+        for attachment in attachments:
+            if content_type and attachment.content_type != content_type:
+                continue
+            yield attachment
+
+    def get_attachment(self, filename=None, content_type=None):
+        """
+        Return the first Email attachment with the given filename and
+        content type
+
+        :param filename: Attachment filename
+        :param content_type: Attachment content type
+        :return: :class:`Attachment` object or None if not found
+        """
+        return next(self.iter_attachments(filename, content_type), None)
+
+    def _iter_json_attachment_text(self, attachment, base64_decode, gzipped, compression, email_encode, max_size):
+        """
+        Chain the decoding steps of a json attachment, detecting the
+        compression codec and the base64 encoding when not given
+
+        :return: Iterator over the json attachment strings
+        """
+        if compression:
+            codec = get_codec(compression)
+        elif gzipped is not None:
+            codec = get_codec('gzip') if gzipped else None
+        else:
+            codec = detect_codec(attachment.content_type, attachment.filename)
+        if base64_decode is None:
+            base64_decode = attachment.part.get_param(ENCODING_PARAM) == 'base64'
+
+        chunks = attachment.iter_payload()
+        if codec:
+            chunks = codec.iter_decompressed(chunks, max_size)
+        if base64_decode:
+            chunks = iter_base64_decoded(chunks)
+        return iter_text(chunks, email_encode)
+
+    def get_json_attachment(self, attachment_name=None, attachment_content_type=None, base64_decode=None,
+                            gzipped=None, email_encode='utf-8', max_size=None, compression=None):
+        """
+        Return a json object stored in attachment. The attachment is decoded
+        incrementally, without a full copy of it per decoding step. The
+        compression codec and the base64 encoding are detected from the
+        attachment content type and filename, unless given
+
+        :param attachment_name: Name of attachment file to find
+        :param attachment_content_type: Content type of attachment file to find
+        :param base64_decode: If true looks for a base64 encoded json file.
+                              Default: None (detect)
+        :param gzipped: If true try to unzip an attachment gzip file.
+                        Default: None (detect)
+        :param email_encode: Encoding for treat body attachments. Default: 'utf-8'
+        :param max_size: Maximum decompressed size in bytes of compressed
+                         attachments, larger ones are skipped. Default: None
+        :param compression: Compression codec name, as 'gzip', 'bz2' or
+                            'lzma', see :mod:`mailproc.compression`.
+                            Default: None (detect)
+        :return: Json object stored in email attachment
+        """
+        for attachment in self.iter_attachments(attachment_name, attachment_content_type):
+            text = self._iter_json_attachment_text(attachment, base64_decode, gzipped, compression,
+                                                   email_encode, max_size)
             try:
-                return json.loads(body.decode(email_encode))
+                return load_json(text)
             except ValueError as e:
-                logging.error('get_json_attachment json error: {0}'.format(e))
+                logging.error('get_json_attachment error: {0}'.format(e))
                 continue
 
         return False
+
+    def iter_json_records(self, attachment_name=None, attachment_content_type=None, base64_decode=None,
+                          gzipped=None, email_encode='utf-8', max_size=None, compression=None):
+        """
+        Iterate over the records of a JSON array or NDJSON attachment,
+        parsing them as the attachment is decoded, instead of loading the
+        whole document. The first attachment found is used
+
+        :param attachment_name: Name of attachment file to find
+        :param attachment_content_type: Content type of attachment file to find
+        :param base64_decode: If true looks for a base64 encoded json file.
+                              Default: None (detect)
+        :param gzipped: If true try to unzip an attachment gzip file.
+                        Default: None (detect)
+        :param email_encode: Encoding for treat body attachments. Default: 'utf-8'
+        :param max_size: Maximum decompressed size in bytes of compressed
+                         attachments, exceeding it raises
+                         :class:`~mailproc.exceptions.DecompressionSizeError`.
+                         Default: None
+        :param compression: Compression codec name. Default: None (detect)
+        :return: Iterator over json objects, empty if there is no attachment
+        """
+        attachment = self.get_attachment(attachment_name, attachment_content_type)
+        if attachment is None:
+            return iter(())
+        return iter_json_records(self._iter_json_attachment_text(
+            attachment, base64_decode, gzipped, compression, email_encode, max_size))
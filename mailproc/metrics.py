@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+    mailproc.metrics
+    ~~~~~~~~~~~~~~~~
+    This module implements the mailProc routes and actions instrumentation.
+
+    :copyright: (c) 2018 Daxslab.
+    :license: LGPL, see LICENSE for more details.
+"""
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(**labels):
+    return ','.join('{0}="{1}"'.format(name, _escape_label(value)) for name, value in sorted(labels.items()))
+
+
+class Metrics:
+    """
+    Thread safe collector of routes and actions metrics: processed
+    messages, route matches, route misses per target, action exceptions
+    and action latency histograms. Routes are identified by their target
+    and rule.
+
+    :param buckets: Latency histogram upper bounds in seconds
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Reset all metrics
+        """
+        with self._lock:
+            self.started = time.time()
+            self.messages = 0
+            self.matches = {}
+            self.misses = {}
+            self.errors = {}
+            self.latencies = {}
+
+    def observe_message(self):
+        """
+        Count a processed message
+        """
+        with self._lock:
+            self.messages += 1
+
+    def observe_match(self, route):
+        """
+        Count a route match
+
+        :param route: :class:`~mailproc.routing.Route` object
+        """
+        key = (route.target, route.rule)
+        with self._lock:
+            self.matches[key] = self.matches.get(key, 0) + 1
+
+    def observe_miss(self, target):
+        """
+        Count a path without matching routes
+
+        :param target: Routes target
+        """
+        with self._lock:
+            self.misses[target] = self.misses.get(target, 0) + 1
+
+    def observe_action(self, route, seconds, failed=False):
+        """
+        Record an action call
+
+        :param route: :class:`~mailproc.routing.Route` object
+        :param seconds: Action duration in seconds
+        :param failed: True if the action raised an exception
+        """
+        key = (route.target, route.rule)
+        with self._lock:
+            latency = self.latencies.get(key)
+            if latency is None:
+                latency = self.latencies[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    latency[0][i] += 1
+                    break
+            latency[1] += seconds
+            latency[2] += 1
+            if failed:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def dump(self):
+        """
+        Return the raw metrics state, to be merged in another collector
+
+        :return: Tuple with the raw metrics state
+        """
+        with self._lock:
+            return (self.messages, dict(self.matches), dict(self.misses), dict(self.errors),
+                    dict((key, [list(value[0]), value[1], value[2]]) for key, value in self.latencies.items()))
+
+    def merge(self, state):
+        """
+        Add the metrics of a raw state returned by :meth:`dump`, as the
+        ones collected by process workers
+
+        :param state: Raw metrics state
+        """
+        messages, matches, misses, errors, latencies = state
+        with self._lock:
+            self.messages += messages
+            for counters, values in ((self.matches, matches), (self.misses, misses), (self.errors, errors)):
+                for key, value in values.items():
+                    counters[key] = counters.get(key, 0) + value
+            for key, (bucket_counts, total, count) in latencies.items():
+                latency = self.latencies.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+                latency[0] = [a + b for a, b in zip(latency[0], bucket_counts)]
+                latency[1] += total
+                latency[2] += count
+
+    def snapshot(self):
+        """
+        Return a snapshot of all metrics
+
+        :return: Dict with 'messages', 'messages_per_second', 'uptime',
+                 'misses' (by target) and 'routes' (by target and rule) keys
+        """
+        messages, matches, misses, errors, latencies = self.dump()
+        uptime = time.time() - self.started
+        routes = {}
+        for key in set(matches) | set(errors) | set(latencies):
+            target, rule = key
+            bucket_counts, total, count = latencies.get(key, [[0] * len(self.buckets), 0.0, 0])
+            cumulative, buckets = 0, {}
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                buckets[bound] = cumulative
+            routes.setdefault(target, {})[rule] = {
+                'matches': matches.get(key, 0),
+                'errors': errors.get(key, 0),
+                'latency': {'count': count, 'sum': total, 'buckets': buckets},
+            }
+        return {
+            'messages': messages,
+            'messages_per_second': messages / uptime if uptime > 0 else 0.0,
+            'uptime': uptime,
+            'misses': misses,
+            'routes': routes,
+        }
+
+    def to_prometheus(self):
+        """
+        Return all metrics in the Prometheus text exposition format
+
+        :return: Metrics text
+        """
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP mailproc_messages_total Processed messages.',
+            '# TYPE mailproc_messages_total counter',
+            'mailproc_messages_total {0}'.format(snapshot['messages']),
+            '# HELP mailproc_messages_per_second Processed messages per second since start.',
+            '# TYPE mailproc_messages_per_second gauge',
+            'mailproc_messages_per_second {0}'.format(snapshot['messages_per_second']),
+            '# HELP mailproc_route_misses_total Messages without matching routes.',
+            '# TYPE mailproc_route_misses_total counter',
+        ]
+        for target, count in sorted(snapshot['misses'].items()):
+            lines.append('mailproc_route_misses_total{{{0}}} {1}'.format(_format_labels(target=target), count))
+
+        routes = sorted((target, rule, values) for target, rules in snapshot['routes'].items()
+                        for rule, values in rules.items())
+        for name, help_text, field in (('mailproc_route_matches_total', 'Route matches.', 'matches'),
+                                       ('mailproc_action_errors_total', 'Actions raising exceptions.', 'errors')):
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} counter'.format(name))
+            for target, rule, values in routes:
+                lines.append('{0}{{{1}}} {2}'.format(name, _format_labels(target=target, rule=rule), values[field]))
+
+        lines.append('# HELP mailproc_action_duration_seconds Action duration.')
+        lines.append('# TYPE mailproc_action_duration_seconds histogram')
+        for target, rule, values in routes:
+            latency = values['latency']
+            for bound, count in sorted(latency['buckets'].items()):
+                lines.append('mailproc_action_duration_seconds_bucket{{{0}}} {1}'.format(
+                    _format_labels(target=target, rule=rule, le=bound), count))
+            labels = _format_labels(target=target, rule=rule)
+            lines.append('mailproc_action_duration_seconds_bucket{{{0},le="+Inf"}} {1}'.format(labels, latency['count']))
+            lines.append('mailproc_action_duration_seconds_sum{{{0}}} {1}'.format(labels, latency['sum']))
+            lines.append('mailproc_action_duration_seconds_count{{{0}}} {1}'.format(labels, latency['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def start_http_server(self, port, addr=''):
+        """
+        Serve metrics in the Prometheus text format from a daemon thread
+
+        :param port: Server port
+        :param addr: Server address. Default: '' (all interfaces)
+        :return: :class:`~http.server.HTTPServer` object, call its
+                 `shutdown` method to stop it
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = _ThreadingHTTPServer((addr, port), MetricsHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return server
+
+    def __getstate__(self):
+        return {'buckets': self.buckets}
+
+    def __setstate__(self, state):
+        self.__init__(state['buckets'])
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
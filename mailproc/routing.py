@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+    mailproc.routing
+    ~~~~~~~~~~~~~~~~
+    This module implements the route rules and the compiled dispatch tables
+    used by the central application object.
+
+    :copyright: (c) 2018 Daxslab.
+    :license: LGPL, see LICENSE for more details.
+"""
+from collections import namedtuple
+from collections import OrderedDict
+import itertools
+import re
+import threading
+
+from .exceptions import RouteError
+
+
+PLACEHOLDER_RE = re.compile(r'<(?:(\w+):)?(\w+)>')
+
+# address parts free of placeholders and regular expression operators
+LITERAL_ADDRESS_PART_RE = re.compile(r'^[\w.-]+$')
+
+# unescaped dots not quantified, matched as literal dots
+LITERAL_DOT_RE = re.compile(r'(\\.)|\.(?![*+?{])')
+
+# characters ending the literal prefix of a rule
+REGEX_OPERATORS = frozenset('\\.^$*+?{}[]|()')
+
+# converter name -> (regular expression, conversion function)
+CONVERTERS = {
+    'default': (r'.+', None),
+    'int': (r'\d+', int),
+    'word': (r'\w+', None),
+    'local': (r'[^@\s]+', None),
+    'path': (r'.+', None),
+}
+
+RouteCacheInfo = namedtuple('RouteCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def lower_domains(rule):
+    """
+    Lowercase the literal text of the address domains of a rule, after
+    every '@' up to the end of the rule or of the alternative, as the
+    domains of routed addresses are lowercased. Placeholders and escaped
+    characters are kept
+
+    :param rule: 'from' match rule string
+    :return: Rule string
+    """
+    parts = []
+    in_domain = False
+    position = 0
+    for match in itertools.chain(PLACEHOLDER_RE.finditer(rule), (None,)):
+        end = match.start() if match else len(rule)
+        literal = rule[position:end]
+        chars = []
+        escaped = False
+        for char in literal:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '@':
+                in_domain = True
+            elif char == '|':
+                in_domain = False
+            elif in_domain:
+                char = char.lower()
+            chars.append(char)
+        parts.append(''.join(chars))
+        if match:
+            parts.append(match.group(0))
+            position = match.end()
+    return ''.join(parts)
+
+
+def escape_dots(rule):
+    """
+    Escape the dots of a rule, so ``'example.com'`` matches a literal dot.
+    Escaped and quantified dots, as in ``'.*'``, are kept
+
+    :param rule: Match rule string
+    :return: Rule string
+    """
+    return LITERAL_DOT_RE.sub(lambda match: match.group(1) or r'\.', rule)
+
+
+class Route:
+    """
+    A registered route. Holds the rule, the target it applies to, the
+    compiled pattern and the action function.
+
+    Rule placeholders can be typed as ``<converter:name>``. Untyped
+    placeholders use the ``default`` converter, which matches any text.
+    Dots match literal dots unless quantified, as in ``'.*'``.
+
+    :param rule: Match rule as string
+    :param target: Target the rule is applied to, can be 'from' or 'subject'
+    :param action: Action function
+    :param converters: Dict of available converters. Default: :data:`CONVERTERS`
+    :param max_length: Don't match paths longer than this number of
+                       characters. Default: None (no limit)
+    :param batch: The action gets batches of mails. Default: False
+    :param max_batch: Maximum number of mails in a batch. Default: 500
+    """
+
+    def __init__(self, rule, target, action, converters=None, max_length=None, batch=False, max_batch=500):
+        self.rule = rule
+        self.target = target
+        self.action = action
+        self.converters = converters if converters is not None else CONVERTERS
+        self.max_length = max_length
+        self.batch = batch
+        self.max_batch = max_batch
+        self.regex, self.groups = self.build_regex()
+        self.pattern = re.compile('^{0}$'.format(self.regex))
+
+    def build_regex(self, group_prefix=''):
+        """
+        Converts the route rule to a regular expression source (without anchors)
+
+        :param group_prefix: Prefix added to every named group
+        :return: Regular expression source string and list of
+                 (group name, argument name, conversion function) tuples
+        """
+        groups = []
+
+        def placeholder(match):
+            converter_name, name = match.group(1) or 'default', match.group(2)
+            try:
+                regex, to_python = self.converters[converter_name]
+            except KeyError:
+                raise RouteError('Unknown converter "{0}" in route "{1}"'.format(converter_name, self.rule))
+            group_name = group_prefix + name
+            groups.append((group_name, name, to_python))
+            return '(?P<{0}>{1})'.format(group_name, regex)
+
+        rule = lower_domains(self.rule) if self.target == 'from' else self.rule
+        regex = PLACEHOLDER_RE.sub(placeholder, escape_dots(rule))
+        if self.max_length is not None:
+            # the lookahead fails long paths before any backtracking starts
+            regex = r'(?=[\s\S]{{0,{0}}}\Z){1}'.format(self.max_length, regex)
+        return regex, groups
+
+    def get_literal_prefix(self):
+        """
+        Return the literal text every path matching this route starts with:
+        the rule up to its first placeholder or regular expression operator
+
+        :return: Literal prefix string, empty if the rule has none
+        """
+        if '|' in self.rule:
+            # alternatives may start with anything
+            return ''
+        prefix = PLACEHOLDER_RE.split(self.rule, 1)[0]
+        for position, char in enumerate(prefix):
+            if char in REGEX_OPERATORS:
+                if char in '*?{':
+                    # the quantified character is optional
+                    position = max(position - 1, 0)
+                return prefix[:position]
+        return prefix
+
+    @staticmethod
+    def convert(m, groups):
+        """
+        Return the converted route arguments of a regular expression match
+
+        :param m: Regular expression match object
+        :param groups: List of (group name, argument name, conversion function) tuples
+        :return: Dict of route arguments
+        """
+        kwargs = {}
+        for group_name, name, to_python in groups:
+            value = m.group(group_name)
+            kwargs[name] = to_python(value) if to_python else value
+        return kwargs
+
+    def match(self, path):
+        """
+        Match a path against this route
+
+        :param path: Route path string
+        :return: Dict of route arguments or None if the route does not match
+        """
+        m = self.pattern.match(path)
+        if m:
+            try:
+                return self.convert(m, self.groups)
+            except ValueError:
+                return None
+        return None
+
+    def __repr__(self):
+        return '<Route {0} "{1}" -> {2}>'.format(self.target, self.rule,
+                                                 getattr(self.action, '__name__', self.action))
+
+
+class RouteMap:
+    """
+    Compiled dispatch table for a list of routes. All routes are joined in a
+    single alternation regular expression, so a path is resolved with one
+    regex call no matter how many routes are registered. Alternatives are
+    tried in registration order, keeping the first-match-wins semantic.
+
+    :param routes: List of :class:`Route` objects in registration order
+    """
+
+    def __init__(self, routes):
+        self.routes = list(routes)
+        self._groups = {}
+        self._combined = self._compile(self.routes)
+
+    def _compile(self, routes):
+        if not routes:
+            return None
+        alternatives = []
+        for position, route in enumerate(routes):
+            route_group = '_r{0}'.format(position)
+            regex, groups = route.build_regex(group_prefix='{0}_'.format(route_group))
+            alternatives.append('(?P<{0}>{1}$)'.format(route_group, regex))
+            self._groups[route_group] = (position, route, groups)
+        try:
+            combined = re.compile('^(?:{0})'.format('|'.join(alternatives)))
+        except re.error:
+            # rules using regular expression features that can't be safely
+            # joined (backreferences, inline flags...) use a linear scan
+            return None
+        self._groups = dict((combined.groupindex[name], value) for name, value in self._groups.items())
+        return combined
+
+    def match(self, path):
+        """
+        Find the first route matching a path
+
+        :param path: Route path string
+        :return: (kwargs, route) pair or None if there is no matching route
+        """
+        if self._combined is None:
+            return self._match_from(path, 0)
+
+        m = self._combined.match(path)
+        if not m:
+            return None
+        position, route, groups = self._groups[m.lastindex]
+        try:
+            return Route.convert(m, groups), route
+        except ValueError:
+            # a converter rejected the value, keep looking in the next routes
+            return self._match_from(path, position + 1)
+
+    def _match_from(self, path, start):
+        for route in self.routes[start:]:
+            kwargs = route.match(path)
+            if kwargs is not None:
+                return kwargs, route
+        return None
+
+    def match_all(self, path):
+        """
+        Find all routes matching a path
+
+        :param path: Route path string
+        :return: List of (kwargs, route) pairs in registration order
+        """
+        matches = []
+        for route in self.routes:
+            kwargs = route.match(path)
+            if kwargs is not None:
+                matches.append((kwargs, route))
+        return matches
+
+
+class AddressRouteMap(RouteMap):
+    """
+    Dispatch table for 'from' routes. Routes whose domain or local part is a
+    literal (as in ``'<name>@example.com'`` or ``'noreply@<domain>'``) are
+    indexed by it, so an address is only checked against the routes for its
+    domain and local part plus the remaining wildcard routes. Dots in literal
+    parts are matched as literal dots.
+
+    :param routes: List of :class:`Route` objects in registration order
+    """
+
+    def __init__(self, routes):
+        self.routes = list(routes)
+        self._by_domain = {}
+        self._by_local = {}
+        self._wildcard = []
+        self._route_maps = {}
+        for position, route in enumerate(self.routes):
+            local, _, domain = route.rule.rpartition('@')
+            if '|' in route.rule:
+                # alternatives may match other domains and local parts
+                self._wildcard.append(position)
+            elif local and LITERAL_ADDRESS_PART_RE.match(domain):
+                self._by_domain.setdefault(domain.lower(), []).append(position)
+            elif domain and LITERAL_ADDRESS_PART_RE.match(local):
+                self._by_local.setdefault(local.lower(), []).append(position)
+            else:
+                self._wildcard.append(position)
+
+    def _get_route_map(self, path):
+        local, _, domain = path.partition('@')
+        domain = path.rpartition('@')[2].lower() if domain else None
+        local = local.lower()
+        key = (domain if domain in self._by_domain else None,
+               local if local in self._by_local else None)
+        route_map = self._route_maps.get(key)
+        if route_map is None:
+            positions = self._wildcard + self._by_domain.get(key[0], []) + self._by_local.get(key[1], [])
+            route_map = RouteMap(self.routes[position] for position in sorted(positions))
+            self._route_maps[key] = route_map
+        return route_map
+
+    def match(self, path):
+        """
+        Find the first route matching an address
+
+        :param path: Email address string
+        :return: (kwargs, route) pair or None if there is no matching route
+        """
+        return self._get_route_map(path).match(path)
+
+    def match_all(self, path):
+        """
+        Find all routes matching an address
+
+        :param path: Email address string
+        :return: List of (kwargs, route) pairs in registration order
+        """
+        return self._get_route_map(path).match_all(path)
+
+
+class RouteCache:
+    """
+    Bounded, thread safe LRU cache of route resolutions. Resolutions
+    without matching routes are cached too.
+
+    :param maxsize: Maximum number of cached resolutions
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, resolve):
+        """
+        Return the cached value for a key, calling `resolve` on a cache miss
+
+        :param key: Hashable cache key
+        :param resolve: Function returning the value for a missing key
+        :return: Cached value
+        """
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                pass
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = resolve()
+        if self.maxsize:
+            with self._lock:
+                self._entries[key] = value
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+    def clear(self):
+        """
+        Remove all cached resolutions and reset counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Return cache statistics
+
+        :return: :class:`RouteCacheInfo` named tuple
+        """
+        with self._lock:
+            return RouteCacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    mailproc.spool
+    ~~~~~~~~~~~~~~
+    This module implements the disk spooling of large mailProc payloads.
+
+    :copyright: (c) 2018 Daxslab.
+    :license: LGPL, see LICENSE for more details.
+"""
+import codecs
+import mmap
+import shutil
+import tempfile
+
+from .streams import iter_chunks
+from .streams import STREAM_CHUNK_SIZE
+
+
+class SpooledPayload:
+    """
+    Payload stored in an anonymous temporary file and memory-mapped, so its
+    pages are loaded from disk on access and can be dropped by the operating
+    system under memory pressure. The file is removed when the object is
+    garbage collected.
+
+    :param data: Payload as bytes, bytes-like object, binary file object or
+                 string. Strings are stored as ascii with escaped 8-bit
+                 characters, as the :mod:`email` parser produces them, or as
+                 utf-8
+    :param directory: Temporary files directory. Default: None (system
+                      temporary directory)
+    """
+
+    def __init__(self, data, directory=None):
+        self.encoding = None
+        self._file = tempfile.TemporaryFile(dir=directory)
+        if isinstance(data, str):
+            # encoded chunk by chunk, without a full encoded copy
+            try:
+                self._write_text(data, 'ascii', 'surrogateescape')
+                self.encoding = 'ascii'
+            except UnicodeEncodeError:
+                self._file.seek(0)
+                self._file.truncate()
+                self._write_text(data, 'utf-8', 'strict')
+                self.encoding = 'utf-8'
+        elif hasattr(data, 'read'):
+            shutil.copyfileobj(data, self._file, STREAM_CHUNK_SIZE)
+        else:
+            for chunk in iter_chunks(data):
+                self._file.write(chunk)
+        self._file.flush()
+        if self._file.tell():
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self._mmap)
+        else:
+            self._mmap = None
+            self.view = memoryview(b'')
+
+    def _write_text(self, text, encoding, errors):
+        for chunk in iter_chunks(text):
+            self._file.write(chunk.encode(encoding, errors))
+
+    def get_text(self):
+        """
+        Return the payload as a string, loading it in memory. Bytes payloads
+        are decoded as ascii with escaped 8-bit characters
+
+        :return: Payload string
+        """
+        return str(self.view, self.encoding or 'ascii', 'surrogateescape')
+
+    def iter_text(self, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Iterate over the payload as strings, decoded as :meth:`get_text`
+        does, without loading it at once
+
+        :param chunk_size: Size of the decoded payload slices
+        :return: Iterator over strings
+        """
+        decoder = codecs.getincrementaldecoder(self.encoding or 'ascii')('surrogateescape')
+        for chunk in iter_chunks(self.view, chunk_size):
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+
+    def __len__(self):
+        return len(self.view)
+
+    def __reduce__(self):
+        # spooled again when unpickled, as by process pool workers
+        data = self.get_text() if self.encoding else bytes(self.view)
+        return SpooledPayload, (data,)
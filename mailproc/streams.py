@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+    mailproc.streams
+    ~~~~~~~~~~~~~~~~
+    This module implements the mailProc streaming attachment codecs. Every
+    step takes and returns an iterator of chunks, so attachments are
+    decoded and encoded without holding a full copy per step.
+
+    :copyright: (c) 2018 Daxslab.
+    :license: LGPL, see LICENSE for more details.
+"""
+import base64
+import binascii
+import codecs
+import json
+import re
+
+
+# size of the chunks read from attachment payloads and encoded values
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# bytes per base64 line, as in base64.encodebytes
+BASE64_LINE_BYTES = 57
+
+# content type parameter of attachments with a base64 encoded content, set
+# besides the transfer encoding
+ENCODING_PARAM = 'x-encoding'
+
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_chunks(data, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Iterate over slices of a string or bytes-like object
+
+    :param data: String or bytes-like object
+    :param chunk_size: Slice size
+    :return: Iterator over slices of `data`
+    """
+    if not isinstance(data, str):
+        data = memoryview(data)
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+def iter_transfer_decoded(part, chunk_size=STREAM_CHUNK_SIZE, payload=None):
+    """
+    Iterate over the payload of a MIME part, decoding base64 and
+    quoted-printable transfer encoded payloads chunk by chunk. Other
+    transfer encodings are decoded at once.
+
+    :param part: :class:`~email.message.Message` object
+    :param chunk_size: Size of the payload chunks to decode
+    :param payload: Transfer encoded payload string or bytes-like object.
+                    Default: the part payload
+    :return: Iterator over payload bytes
+    """
+    if payload is None:
+        payload = part.get_payload()
+    encoding = part.get('Content-Transfer-Encoding', '').lower()
+    if isinstance(payload, list) or encoding not in ('base64', 'quoted-printable'):
+        payload = part.get_payload(decode=True)
+        if payload:
+            yield payload
+        return
+    decode = _iter_base64_payload_decoded if encoding == 'base64' else _iter_qp_decoded
+    for chunk in decode(payload, chunk_size):
+        yield chunk
+
+
+def _iter_base64_payload_decoded(payload, chunk_size):
+    # decoded as Message.get_payload does, ignoring invalid characters
+    carry = b''
+    for chunk in iter_chunks(payload, chunk_size):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('ascii', 'ignore')
+        chunk = carry + b''.join(bytes(chunk).split())
+        end = len(chunk) - len(chunk) % 4
+        carry = chunk[end:]
+        if end:
+            yield binascii.a2b_base64(chunk[:end])
+    if carry.rstrip(b'='):
+        # badly padded payload
+        try:
+            yield binascii.a2b_base64(carry + b'=' * (-len(carry) % 4))
+        except binascii.Error:
+            pass
+
+
+def _iter_qp_decoded(payload, chunk_size):
+    # decoded line by line, soft line breaks never span lines
+    carry = b''
+    for chunk in iter_chunks(payload, chunk_size):
+        if isinstance(chunk, str):
+            try:
+                chunk = chunk.encode('ascii', 'surrogateescape')
+            except UnicodeError:
+                chunk = chunk.encode('raw-unicode-escape')
+        chunk = carry + bytes(chunk)
+        end = chunk.rfind(b'\n') + 1
+        carry = chunk[end:]
+        if end:
+            yield binascii.a2b_qp(chunk[:end])
+    if carry:
+        yield binascii.a2b_qp(carry)
+
+
+def iter_base64_decoded(chunks):
+    """
+    Decode base64 data incrementally, ignoring line breaks
+
+    :param chunks: Iterator over base64 bytes
+    :return: Iterator over decoded bytes
+    """
+    carry = b''
+    for chunk in chunks:
+        chunk = carry + b''.join(bytes(chunk).split())
+        end = len(chunk) - len(chunk) % 4
+        carry = chunk[end:]
+        if end:
+            yield base64.b64decode(chunk[:end])
+    if carry:
+        yield base64.b64decode(carry)
+
+
+def iter_base64_encoded(chunks, line_breaks=True):
+    """
+    Encode data as base64 incrementally, in 76 characters lines as
+    :func:`base64.encodebytes` does
+
+    :param chunks: Iterator over bytes
+    :param line_breaks: Split the output in lines. Default: True
+    :return: Iterator over base64 bytes
+    """
+    encode = base64.encodebytes if line_breaks else base64.b64encode
+    carry = b''
+    for chunk in chunks:
+        chunk = carry + bytes(chunk)
+        end = len(chunk) - len(chunk) % BASE64_LINE_BYTES
+        carry = chunk[end:]
+        if end:
+            yield encode(chunk[:end])
+    if carry:
+        yield encode(carry)
+
+
+def iter_text(chunks, encoding='utf-8'):
+    """
+    Decode bytes incrementally
+
+    :param chunks: Iterator over bytes
+    :param encoding: Text encoding. Default: 'utf-8'
+    :return: Iterator over strings
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def iter_encoded(text, encoding='utf-8', chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Encode a string chunk by chunk
+
+    :param text: String to encode
+    :param encoding: Text encoding. Default: 'utf-8'
+    :param chunk_size: Size of the encoded string slices
+    :return: Iterator over bytes
+    """
+    encoder = codecs.getincrementalencoder(encoding)()
+    for chunk in iter_chunks(text, chunk_size):
+        yield encoder.encode(chunk)
+    data = encoder.encode('', final=True)
+    if data:
+        yield data
+
+
+def iter_json_encoded(obj, encoding='utf-8', chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Encode an object as JSON incrementally, as :func:`json.dumps` does
+
+    :param obj: JSON serializable object
+    :param encoding: Text encoding. Default: 'utf-8'
+    :param chunk_size: Minimum size of the encoded string slices
+    :return: Iterator over bytes
+    """
+    encoder = codecs.getincrementalencoder(encoding)()
+    pieces, size = [], 0
+    for piece in json.JSONEncoder().iterencode(obj):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield encoder.encode(''.join(pieces))
+            pieces, size = [], 0
+    data = encoder.encode(''.join(pieces), final=True)
+    if data:
+        yield data
+
+
+def load_json(text_chunks):
+    """
+    Parse a JSON document from string chunks
+
+    :param text_chunks: Iterator over strings
+    :return: JSON object
+    """
+    return json.loads(''.join(text_chunks))
+
+
+class _JsonStream:
+    """
+    Buffered JSON text read from string chunks, decoding values as the
+    input is read
+    """
+
+    def __init__(self, text_chunks):
+        self.text_chunks = iter(text_chunks)
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.finished = False
+
+    def read(self, wanted=0):
+        """
+        Drop the consumed input and append chunks until the pending input
+        reaches the wanted size or the input ends
+        """
+        buffer = self.buffer[self.pos:]
+        for chunk in self.text_chunks:
+            buffer += chunk
+            if len(buffer) >= wanted:
+                break
+        else:
+            self.finished = True
+        self.buffer, self.pos = buffer, 0
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, empty at the end of the input
+        """
+        pos = self.pos = WHITESPACE_RE.match(self.buffer, self.pos).end()
+        while pos == len(self.buffer) and not self.finished:
+            self.read()
+            pos = self.pos = WHITESPACE_RE.match(self.buffer).end()
+        return self.buffer[pos:pos + 1]
+
+    def decode(self):
+        """
+        Decode the JSON value at the current position, reading more input
+        for values split across chunks
+        """
+        wanted = 0
+        while True:
+            buffer, pos = self.buffer, self.pos
+            if len(buffer) - pos < wanted and not self.finished:
+                self.read(wanted)
+                continue
+            try:
+                value, end = self.decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if self.finished:
+                    raise
+                # incomplete value, read at least twice the pending input
+                wanted = 2 * (len(buffer) - pos)
+                continue
+            if end == len(buffer) and not self.finished:
+                # numbers and literals can continue in the next chunk
+                wanted = len(buffer) - pos + 1
+                continue
+            self.pos = end
+            return value
+
+
+def _iter_json_array(stream):
+    # the stream is positioned at the opening bracket
+    stream.pos += 1
+    if stream.peek() == ']':
+        stream.pos += 1
+    else:
+        while True:
+            yield stream.decode()
+            char = stream.peek()
+            if char == ']':
+                stream.pos += 1
+                break
+            if char != ',':
+                raise ValueError('expected "," or "]" in JSON array at: {0!r}'.format(
+                    stream.buffer[stream.pos:stream.pos + 20]))
+            stream.pos += 1
+            stream.peek()
+    if stream.peek():
+        raise ValueError('extra data after JSON array')
+
+
+def _iter_ndjson(stream):
+    while stream.peek():
+        yield stream.decode()
+
+
+def iter_json_records(text_chunks):
+    """
+    Iterate over the records of a JSON array or of newline delimited JSON
+    (NDJSON), parsing them as the input is read. Only one record is held
+    in memory at a time, besides the input chunks.
+
+    :param text_chunks: Iterator over strings
+    :return: Iterator over JSON objects
+    """
+    stream = _JsonStream(text_chunks)
+    records = _iter_json_array(stream) if stream.peek() == '[' else _iter_ndjson(stream)
+    for record in records:
+        yield record
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+    mailproc.tracing
+    ~~~~~~~~~~~~~~~~
+    This module implements the per message pipeline tracing for mailProc.
+
+    :copyright: (c) 2018 Daxslab.
+    :license: LGPL, see LICENSE for more details.
+"""
+import contextlib
+import contextvars
+import cProfile
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+
+
+SLOW_LOGGER_NAME = 'mailproc.slow'
+
+TRACE_ATTRIBUTE = '_mailproc_trace'
+
+_current_trace = contextvars.ContextVar('mailproc_trace', default=None)
+
+# held by the profiled call, profilers can't run concurrently since Python 3.12
+_profile_lock = threading.Lock()
+
+
+class Trace:
+    """
+    Timed spans of a message going through the mailProc pipeline
+
+    :param message_id: Message 'Message-ID' header
+    """
+
+    def __init__(self, message_id=None):
+        self.message_id = message_id
+        self.started = time.time()
+        self.spans = []
+
+    def add_span(self, name, duration, detail=None):
+        """
+        Add a timed span
+
+        :param name: Span name, as 'fetch', 'parse' or 'action'
+        :param duration: Span duration in seconds
+        :param detail: Span detail, as the route rule of an action
+        """
+        self.spans.append((name, detail, duration))
+
+    @property
+    def duration(self):
+        """
+        Time elapsed since the trace started, in seconds
+        """
+        return time.time() - self.started
+
+    def format(self):
+        """
+        Return the trace as a single line string
+        """
+        spans = ' '.join('{0}{1}={2:.3f}s'.format(name, '[{0}]'.format(detail) if detail else '', duration)
+                         for name, detail, duration in self.spans)
+        return 'message {0} took {1:.3f}s: {2}'.format(self.message_id, self.duration, spans)
+
+
+class Tracer:
+    """
+    Records the pipeline spans of every message: fetch, parse, header
+    decode, route match, action and outbound send. Traces of messages
+    taking longer than `slow_threshold` seconds are written to the
+    ``mailproc.slow`` logger. Tracing is disabled until a threshold is set.
+
+    :param slow_threshold: Log traces of messages taking longer than this
+                           number of seconds. Default: None (disabled)
+    :param profile_rate: Fraction of actions run under :mod:`cProfile`.
+                         Profiles of actions taking longer than
+                         `slow_threshold` are written to the slow log.
+                         Only one action is profiled at a time, sampled
+                         actions running meanwhile are not. Default: 0.0
+    """
+
+    def __init__(self, slow_threshold=None, profile_rate=0.0):
+        self.slow_logger = logging.getLogger(SLOW_LOGGER_NAME)
+        self.configure(slow_threshold, profile_rate)
+
+    def configure(self, slow_threshold=None, profile_rate=0.0):
+        """
+        Set the slow messages threshold and the actions profiling rate
+
+        :param slow_threshold: Slow messages threshold in seconds, None
+                               disables tracing
+        :param profile_rate: Fraction of actions run under :mod:`cProfile`
+        """
+        self.slow_threshold = slow_threshold
+        self.profile_rate = profile_rate
+
+    @property
+    def enabled(self):
+        return self.slow_threshold is not None
+
+    def start_trace(self, message_id=None):
+        """
+        Start a new trace
+
+        :param message_id: Message 'Message-ID' header
+        :return: :class:`Trace` object or None if tracing is disabled
+        """
+        if not self.enabled:
+            return None
+        return Trace(message_id)
+
+    @staticmethod
+    def attach(message, trace):
+        """
+        Attach a trace to a message, to be resumed when it is dispatched
+
+        :param message: :class:`~email.message.Message` object
+        :param trace: :class:`Trace` object or None
+        """
+        if trace is not None:
+            trace.message_id = message['Message-ID']
+            setattr(message, TRACE_ATTRIBUTE, trace)
+
+    def activate(self, message):
+        """
+        Make the trace attached to a message, or a new one, the current
+        trace of the running thread or task
+
+        :param message: :class:`~email.message.Message` object
+        :return: Token for :meth:`deactivate`
+        """
+        trace = getattr(message, TRACE_ATTRIBUTE, None)
+        if trace is None:
+            trace = self.start_trace(message['Message-ID'])
+        return _current_trace.set(trace)
+
+    def deactivate(self, token):
+        """
+        Finish the current trace, logging it if the message is slow, and
+        restore the previous one
+
+        :param token: Token returned by :meth:`activate`
+        """
+        trace = _current_trace.get()
+        _current_trace.reset(token)
+        if trace is not None and self.enabled and trace.duration > self.slow_threshold:
+            self.slow_logger.warning('SLOW %s', trace.format())
+
+    @staticmethod
+    def current_trace():
+        """
+        Return the current trace of the running thread or task
+
+        :return: :class:`Trace` object or None
+        """
+        return _current_trace.get()
+
+    @contextlib.contextmanager
+    def span(self, name, detail=None, trace=None):
+        """
+        Context manager recording a timed span in a trace
+
+        :param name: Span name
+        :param detail: Span detail
+        :param trace: :class:`Trace` object. Default: the current trace
+        """
+        trace = trace or _current_trace.get()
+        if trace is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            trace.add_span(name, time.perf_counter() - start, detail)
+
+    def call(self, name, detail, fn, args=(), kwargs=None):
+        """
+        Call a function recording a span in the current trace, running it
+        under :mod:`cProfile` for a sample of the calls
+
+        :param name: Span name
+        :param detail: Span detail
+        :param fn: Function to call
+        :param args: Function positional arguments
+        :param kwargs: Function keyword arguments
+        :return: Function return value
+        """
+        kwargs = kwargs or {}
+        trace = _current_trace.get()
+        if trace is None:
+            return fn(*args, **kwargs)
+
+        profiler = None
+        if self.profile_rate and random.random() < self.profile_rate:
+            profiler = self._start_profiler()
+
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            trace.add_span(name, duration, detail)
+            if profiler:
+                self._stop_profiler(profiler, duration, name, detail, trace)
+
+    @staticmethod
+    def _start_profiler():
+        """
+        Start profiling the running thread, unless another call or
+        profiling tool is already profiled
+
+        :return: :class:`cProfile.Profile` object or None
+        """
+        if not _profile_lock.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiling tool is active
+            _profile_lock.release()
+            return None
+        return profiler
+
+    def _stop_profiler(self, profiler, duration, name, detail, trace):
+        """
+        Stop a profiler, writing its profile to the slow log for slow calls.
+        Profiling errors are logged, never raised to the profiled call
+        """
+        try:
+            profiler.disable()
+            if duration > self.slow_threshold:
+                stream = io.StringIO()
+                pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(20)
+                self.slow_logger.warning('SLOW %s %s of message %s profile:\n%s',
+                                         name, detail, trace.message_id, stream.getvalue())
+        except Exception as e:
+            logging.warning("Can't profile {0} {1}: {2}".format(name, detail, e))
+        finally:
+            _profile_lock.release()
+
+
+# default tracer used by applications and transports
+tracer = Tracer()
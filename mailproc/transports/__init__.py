@@ -13,6 +13,7 @@ from .base_sender_transport import BaseSenderTransport
 
 from .imap_receiver_transport import ImapReceiverTransport
 from .imap_idle_receiver_transport import ImapIdleReceiverTransport
+from .imap_idle_manager import ImapIdleManager
 
 from .smtp_sender_transport import SmtpSenderTransport
 
@@ -37,3 +37,14 @@ class BaseReceiverTransport:
         Abstract get_mails function
         """
         pass
+
+    def iter_mails(self, **kwargs):
+        """
+        Returns an iterator over obtained mails. Transports able to fetch
+        mails one by one should override it to avoid loading all mails
+        in memory at once
+
+        :param kwargs: Same arguments as :meth:`get_mails`
+        :return: Iterator of :class:`~email.message.Message` objects
+        """
+        return iter(self.get_mails(**kwargs))
@@ -7,17 +7,18 @@
     :copyright: (c) 2018 Daxslab.
     :license: LGPL, see LICENSE for more details.
 """
-from io import BytesIO
-import base64
 import json
-import gzip
 from abc import abstractmethod
 from abc import ABCMeta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email import encoders
 from email.mime.base import MIMEBase
 
+from ..compression import get_codec
+from ..streams import ENCODING_PARAM
+from ..streams import iter_base64_encoded
+from ..streams import iter_json_encoded
+
 
 class BaseSenderTransport:
     """
@@ -48,7 +49,8 @@ class BaseSenderTransport:
 
     def create_message(self, email_from, email_to, email_subject, email_text, email_html=None, email_bcc=None,
                        email_encode='utf-8', json_attachment=None, json_attachment_filename='attachment.json',
-                       json_attachment_base64_encode=False, json_attachment_gzip=False):
+                       json_attachment_base64_encode=False, json_attachment_gzip=False,
+                       json_attachment_compression=None, json_attachment_compression_level=None):
         """
         Send an email message with text only or multipart HTML body
 
@@ -63,6 +65,9 @@ class BaseSenderTransport:
         :param json_attachment_filename: JSON attachment filename (default attachment.json)
         :param json_attachment_base64_encode: Apply a base64 encode to JSON file (default False)
         :param json_attachment_gzip: Send JSON attachment as gzip file (default False)
+        :param json_attachment_compression: Compression codec name for the JSON attachment, as 'gzip',
+                                            'zlib', 'bz2', 'lzma' or 'zstd' (default None)
+        :param json_attachment_compression_level: Compression level (default: the codec default)
         """
         msg_root = MIMEMultipart()
 
@@ -94,28 +99,31 @@ class BaseSenderTransport:
 
         if json_attachment:
 
-            json_string = json.dumps(json_attachment).encode(email_encode)
+            chunks = iter_json_encoded(json_attachment, email_encode)
 
             if json_attachment_base64_encode:
-                json_string = base64.encodebytes(json_string)
-            if json_attachment_gzip:
-                out = BytesIO()
-                f = gzip.GzipFile(fileobj=out, mode="w")
-                f.write(json_string)
-                f.close()
-                out.seek(0)
-                json_string = out.read()
-
-                attachment = MIMEBase('application', 'x-gzip')
-                attachment.set_payload(json_string)
-                encoders.encode_base64(attachment)
-                attachment.add_header('Content-Disposition', 'attachment',
-                                      filename=json_attachment_filename)
-                msg_root.attach(attachment)
+                chunks = iter_base64_encoded(chunks)
+            if json_attachment_gzip and not json_attachment_compression:
+                json_attachment_compression = 'gzip'
+            if json_attachment_compression:
+                codec = get_codec(json_attachment_compression)
+                chunks = iter_base64_encoded(codec.iter_compressed(chunks, json_attachment_compression_level))
+
+                attachment = MIMEBase(*codec.content_type.split('/'))
+                attachment.set_payload(b''.join(chunks).decode('ascii'))
+                attachment['Content-Transfer-Encoding'] = 'base64'
 
             else:
-                attachment = MIMEText(json_string.decode(email_encode))
-                attachment.add_header('Content-Disposition', 'attachment', filename=json_attachment_filename)
-                msg_root.attach(attachment)
+                if json_attachment_base64_encode:
+                    json_string = b''.join(chunks).decode(email_encode)
+                else:
+                    # MIMEText takes the whole document
+                    json_string = json.dumps(json_attachment)
+                attachment = MIMEText(json_string)
+
+            if json_attachment_base64_encode:
+                attachment.set_param(ENCODING_PARAM, 'base64')
+            attachment.add_header('Content-Disposition', 'attachment', filename=json_attachment_filename)
+            msg_root.attach(attachment)
 
         return msg_root
@@ -9,8 +9,9 @@
 """
 import os
 
-from email.parser import Parser
-
+from mailproc.mailproc_email import Email
+from mailproc.spool import SpooledPayload
+from mailproc.tracing import tracer
 from mailproc.transports import BaseReceiverTransport
 
 
@@ -20,10 +21,17 @@ class FileReceiverTransport(BaseReceiverTransport):
     but you are encouraged to find a different use for it :)
 
     :param directory: Directory path for obtaining raw emails in file system.
+    :param lazy: Parse only email headers, delaying the body parsing until it is
+                 accessed. Default: True
+    :param spool_threshold: Size in bytes above which mails and their parts
+                            payloads are spooled to temporary files instead
+                            of kept in memory. Default: None (never)
     """
 
-    def __init__(self, directory, **kwargs):
+    def __init__(self, directory, lazy=True, spool_threshold=None, **kwargs):
         self.directory = directory
+        self.lazy = lazy
+        self.spool_threshold = spool_threshold
 
     def connect(self, **kwargs):
         pass
@@ -37,24 +45,35 @@ class FileReceiverTransport(BaseReceiverTransport):
 
         :param extension: obtain files with extension (default: ".eml")
         :param delete: Delete obtained emails in directory (default False)
-        :return: List of :class:`~email.message.Message` objects
+        :return: List of :class:`~mailproc.Email` objects
         """
+        return list(self.iter_mails(extension=extension, delete=delete))
 
-        mails = []
-
-        files = os.listdir(self.directory)
+    def iter_mails(self, extension='.eml', delete=False, **kwargs):
+        """
+        Yields mails stored in `directory` constructor parameter, reading
+        files one by one
 
-        for filename in files:
+        :param extension: obtain files with extension (default: ".eml")
+        :param delete: Delete obtained emails in directory (default False)
+        :return: Iterator of :class:`~mailproc.Email` objects
+        """
+        for entry in os.scandir(self.directory):
             if extension:
-                if os.path.splitext(filename)[1] != extension:
+                if os.path.splitext(entry.name)[1] != extension:
                     continue
-            file_path = os.path.join(self.directory, filename)
-            with open(file_path) as email_file:
-                email_content = email_file.read()
-                email_parser = Parser()
-                email_message = email_parser.parsestr(email_content)
-                mails.append(email_message)
+            trace = tracer.start_trace()
+            with tracer.span('fetch', trace=trace):
+                with open(entry.path, 'rb') as email_file:
+                    if self.spool_threshold is not None and entry.stat().st_size > self.spool_threshold:
+                        # copied to the spool without loading it in memory
+                        email_content = SpooledPayload(email_file)
+                    else:
+                        email_content = email_file.read()
+            with tracer.span('parse', trace=trace):
+                email_message = Email.from_bytes(email_content, lazy=self.lazy,
+                                                 spool_threshold=self.spool_threshold)
+            tracer.attach(email_message, trace)
             if delete:
-                os.unlink(file_path)
-
-        return mails
+                os.unlink(entry.path)
+            yield email_message
@@ -15,6 +15,7 @@ import os
 import logging
 from email import generator
 
+from mailproc.tracing import tracer
 from mailproc.transports import BaseSenderTransport
 
 
@@ -37,7 +38,8 @@ class FileSenderTransport(BaseSenderTransport):
 
     def send_mail(self, email_from, email_to, email_subject, email_text, email_html=None, email_bcc=None,
                   email_encode='utf-8', log=None, json_attachment=None, json_attachment_filename='attachment.json',
-                  json_attachment_base64_encode=False, json_attachment_gzip=False, **kwargs):
+                  json_attachment_base64_encode=False, json_attachment_gzip=False, json_attachment_compression=None,
+                  json_attachment_compression_level=None, **kwargs):
         """
         Save an email message with text only or multipart HTML body in `directory`
         constructor parameter path
@@ -54,6 +56,9 @@ class FileSenderTransport(BaseSenderTransport):
         :param json_attachment_filename: JSON attachment filename (default attachment.json)
         :param json_attachment_base64_encode: Apply a base64 encode to JSON file (default False)
         :param json_attachment_gzip: Send JSON attachment as gzip file (default False)
+        :param json_attachment_compression: Compression codec name for the JSON attachment, as 'gzip',
+                                            'zlib', 'bz2', 'lzma' or 'zstd' (default None)
+        :param json_attachment_compression_level: Compression level (default: the codec default)
         """
         if isinstance(email_to, str):
             email_to = [email_to]
@@ -66,12 +71,14 @@ class FileSenderTransport(BaseSenderTransport):
                                            json_attachment=json_attachment,
                                            json_attachment_filename=json_attachment_filename,
                                            json_attachment_base64_encode=json_attachment_base64_encode,
-                                           json_attachment_gzip=json_attachment_gzip)
+                                           json_attachment_gzip=json_attachment_gzip,
+                                           json_attachment_compression=json_attachment_compression,
+                                           json_attachment_compression_level=json_attachment_compression_level)
 
             right_now = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")
             random_str = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(8))
             email_path = os.path.join(self.directory, right_now + "_" + random_str) + ".eml"
-            with open(email_path, 'w') as outfile:
+            with tracer.span('send'), open(email_path, 'w') as outfile:
                 gen = generator.Generator(outfile)
                 gen.flatten(msg_root)
 
@@ -0,0 +1,608 @@
+# -*- coding: utf-8 -*-
+"""
+    mailproc.transports.imap_idle_manager
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    This module implements the IMAP IDLE manager watching many mailProc IMAP
+    accounts from a single thread.
+
+    :copyright: (c) 2018 Daxslab.
+    :license: LGPL, see LICENSE for more details.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+import heapq
+import imaplib
+import itertools
+import logging
+import queue
+import random
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+
+# connection states
+DISCONNECTED = 'disconnected'
+CONNECTING = 'connecting'
+FETCHING = 'fetching'
+IDLE_SENT = 'idle sent'
+IDLING = 'idling'
+DONE_SENT = 'done sent'
+IDLE_ENDED = 'idle ended'
+
+# errors closing a connection, imaplib.IMAP4.abort included
+CONNECTION_ERRORS = (OSError, EOFError, imaplib.IMAP4.error)
+
+# untagged responses announcing new mails
+NEW_MAIL_RESPONSES = ('EXISTS', 'RECENT')
+
+# end of the queued mails, put when the manager stops
+_STOP = object()
+
+
+def get_message_id(result):
+    """
+    Return the Message-ID of a dispatch result or a mail
+    """
+    return result['Message-ID'] if isinstance(result, Message) else result.message_id
+
+
+def is_new_mail_response(line):
+    """
+    Return True for untagged EXISTS and RECENT response lines
+    """
+    return line.startswith(b'* ') and line.endswith((b' EXISTS', b' RECENT')) and line != b'* 0 RECENT'
+
+
+def check_new_mail(lines):
+    """
+    Return True if any of the untagged response lines announces new mails
+
+    :param lines: List of response lines without line breaks
+    :return: True if new mails were announced
+    :raises EOFError: for BYE responses
+    """
+    new_mail = False
+    for line in lines:
+        if line.startswith(b'* BYE'):
+            raise EOFError('connection closed by the server: {0}'.format(line.decode('ascii', 'replace')))
+        if is_new_mail_response(line):
+            new_mail = True
+    return new_mail
+
+
+class IdleConnection:
+    """
+    IDLE state of an account mailbox watched by :class:`ImapIdleManager`
+
+    :param transport: :class:`~mailproc.transports.ImapReceiverTransport` object
+    :param mailbox: IMAP mailbox name
+    :param get_msgs_type: Expression for emails to get
+    :param delete: Delete obtained emails in account
+    """
+
+    def __init__(self, transport, mailbox='INBOX', get_msgs_type='(UNSEEN)', delete=False):
+        self.transport = transport
+        self.mailbox = mailbox
+        self.get_msgs_type = get_msgs_type
+        self.delete = delete
+        self.state = DISCONNECTED
+        self.sock = None
+        # socket timeout set by the transport, restored for fetching
+        self.sock_timeout = None
+        self.tag = None
+        # partial response line read while idling
+        self.buffer = b''
+        # a new mail was announced while idling
+        self.new_mail = False
+        # Message-IDs of the fetched mails not acknowledged yet
+        self.message_ids = set()
+        # (results, failed mails) acks waiting for a worker thread to end
+        self.acks = []
+        # failed connection attempts since the last successful one
+        self.attempts = 0
+        # id of the connection active timer, older timers are ignored
+        self.timer = None
+
+    def __repr__(self):
+        return '<IdleConnection {0}@{1}/{2} {3}>'.format(self.transport.username, self.transport.server,
+                                                         self.mailbox, self.state)
+
+
+class ImapIdleManager:
+    """
+    IMAP IDLE manager. Watches the mailboxes of many IMAP receiver transports
+    from a single thread, reading all IDLE connections with a selector.
+    Connections are opened and mails fetched by a pool of worker threads,
+    so slow accounts don't delay the others.
+
+    Every connection goes through the following states: the connection is
+    opened (`connecting`), mails are fetched (`fetching`), the IDLE command
+    is sent (`idle sent`) and, once accepted by the server, the connection
+    is `idling`. When the server announces a new mail, or the connection
+    has been idling for `idle_timeout` seconds, DONE is sent (`done sent`)
+    and, once the server ends the IDLE command (`idle ended`), new mails
+    are fetched, or IDLE is sent again after a timeout. Broken connections
+    are reopened with a jittered exponential backoff.
+
+    Fetched mails from all accounts are put in a single dispatch queue, read
+    with :meth:`get_mails`. Mails are acknowledged to their transports with
+    :meth:`ack`; with UID sync, mails of a :meth:`get_mails` batch missing
+    from the acknowledged results are fetched again by a later fetch, and
+    mails waiting for their acknowledgement are never fetched twice::
+
+        manager = ImapIdleManager(transports)
+        manager.start()
+        mails = manager.get_mails()
+        while mails:
+            app.run(mails, ack=manager.ack)
+            mails = manager.get_mails()
+
+    :param transports: List of :class:`~mailproc.transports.ImapReceiverTransport`
+                       objects, watching their 'INBOX' mailbox. More
+                       mailboxes can be added with :meth:`add`
+    :param idle_timeout: Seconds before renewing IDLE commands. Default: 8 minutes (60*8)
+    :param response_timeout: Seconds to wait for the server to accept or end
+                             IDLE commands before reconnecting. Default: 60
+    :param reconnect_delay: Base reconnection delay in seconds, doubled on
+                            every failed attempt. Default: 1
+    :param max_reconnect_delay: Maximum reconnection delay in seconds. Default: 300
+    :param dispatch_queue: :class:`queue.Queue` object receiving the fetched
+                           mails. Default: None (a new unbounded queue)
+    :param workers: Number of threads opening connections and fetching
+                    mails. Default: 4
+    """
+
+    def __init__(self, transports=(), idle_timeout=60*8, response_timeout=60, reconnect_delay=1,
+                 max_reconnect_delay=300, dispatch_queue=None, workers=4):
+        self.idle_timeout = idle_timeout
+        self.response_timeout = response_timeout
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.queue = dispatch_queue if dispatch_queue is not None else queue.Queue()
+        self.connections = []
+        self.selector = selectors.DefaultSelector()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='imap-idle-worker')
+        # (deadline, timer id, connection, callback) heap
+        self._timers = []
+        self._timer_ids = itertools.count()
+        # functions called from the manager thread, as acks
+        self._calls = deque()
+        # mails returned by get_mails waiting for their ack, by call
+        self._batches = deque()
+        self._batches_lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self.selector.register(self._wakeup_reader, selectors.EVENT_READ)
+        for transport in transports:
+            self.add(transport)
+
+    def add(self, transport, mailbox='INBOX', get_msgs_type='(UNSEEN)', delete=False):
+        """
+        Watch a mailbox. The transport connection is opened by the manager
+
+        :param transport: :class:`~mailproc.transports.ImapReceiverTransport` object
+        :param mailbox: IMAP mailbox for fetching emails, default: "INBOX"
+        :param get_msgs_type: Expression for emails to get '(UNSEEN)' by default to get new emails
+        :param delete: Delete obtained emails in account (default False)
+        :return: :class:`IdleConnection` object
+        """
+        connection = IdleConnection(transport, mailbox, get_msgs_type, delete)
+        self.connections.append(connection)
+        self._call_soon(self._set_timer, connection, 0, self._connect)
+        return connection
+
+    def start(self):
+        """
+        Run the manager in a background thread
+        """
+        self._thread = threading.Thread(target=self.run, name='imap-idle-manager')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the manager, closing all connections
+
+        :param timeout: Seconds to wait for the background thread to end.
+                        Default: None (wait until it ends)
+        """
+        self._running = False
+        self._wakeup()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def get_mails(self, timeout=None):
+        """
+        Return the mails waiting in the dispatch queue, blocking until there
+        is at least one
+
+        :param timeout: Maximum seconds to wait. Default: None (no limit)
+        :return: List of :class:`~mailproc.Email` objects, empty on timeout
+                 or once the manager is stopped
+        """
+        try:
+            mail = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return []
+        mails = []
+        while mail is not _STOP:
+            mails.append(mail)
+            try:
+                mail = self.queue.get_nowait()
+            except queue.Empty:
+                break
+        if mail is _STOP:
+            # keep other consumers from blocking
+            self.queue.put(_STOP)
+        if mails:
+            with self._batches_lock:
+                self._batches.append(mails)
+        return mails
+
+    def ack(self, results):
+        """
+        Acknowledge processed mails to their transports, see
+        :meth:`mailproc.transports.ImapReceiverTransport.ack`. The
+        :meth:`get_mails` batches holding any of the results, or the oldest
+        batch if there are no results, are done: their mails missing from
+        the results are released to be fetched again. Can be called from
+        any thread
+
+        :param results: List of :class:`~mailproc.dispatch.DispatchResult`
+                        or :class:`~email.message.Message` objects
+        """
+        message_ids = set(get_message_id(result) for result in results)
+        with self._batches_lock:
+            done = [batch for batch in self._batches if any(mail['Message-ID'] in message_ids for mail in batch)]
+            if not done and self._batches:
+                done = [self._batches[0]]
+            self._batches = deque(batch for batch in self._batches if all(batch is not other for other in done))
+        self._call_soon(self._ack, results, [mail for batch in done for mail in batch])
+
+    def _ack(self, results, delivered=()):
+        acked_ids = set(get_message_id(result) for result in results)
+        for connection in self.connections:
+            # acks are passed only to the transport of the mails
+            connection_results = [result for result in results
+                                  if get_message_id(result) in connection.message_ids]
+            failed = [mail for mail in delivered
+                      if mail['Message-ID'] in connection.message_ids and mail['Message-ID'] not in acked_ids]
+            connection.message_ids.difference_update(get_message_id(result) for result in connection_results + failed)
+            if connection_results or failed:
+                connection.acks.append((connection_results, failed))
+                if connection.state not in (CONNECTING, FETCHING):
+                    self._flush_acks(connection)
+
+    @staticmethod
+    def _flush_acks(connection):
+        """
+        Pass the pending acks to the transport of a connection, which isn't
+        used by a worker thread meanwhile
+        """
+        while connection.acks:
+            results, failed = connection.acks.pop(0)
+            if results:
+                connection.transport.ack(results)
+            if failed:
+                connection.transport.release(failed)
+
+    def run(self):
+        """
+        Run the manager loop in the calling thread until :meth:`stop` is called
+        """
+        self._running = True
+        try:
+            while self._running:
+                for key, events in self.selector.select(self._get_select_timeout()):
+                    if key.fileobj is self._wakeup_reader:
+                        self._run_calls()
+                    else:
+                        self._read(key.data)
+                self._run_timers()
+        finally:
+            self._pool.shutdown(wait=False)
+            for connection in self.connections:
+                if connection.state != DISCONNECTED:
+                    self._close(connection)
+            self.queue.put(_STOP)
+
+    def _call_soon(self, function, *args):
+        self._calls.append((function, args))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_writer.send(b'\0')
+        except OSError:
+            # already woken up, or closed
+            pass
+
+    def _run_calls(self):
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._calls:
+            function, args = self._calls.popleft()
+            function(*args)
+
+    def _submit(self, connection, function, callback, *args):
+        """
+        Run `function` with the connection in a worker thread, then
+        `callback` with the connection and the future from the manager thread
+        """
+        connection.timer = None
+        future = self._pool.submit(function, connection, *args)
+        future.add_done_callback(lambda future: self._call_soon(callback, connection, future))
+
+    def _set_timer(self, connection, delay, callback):
+        """
+        Call `callback` with the connection after `delay` seconds, replacing
+        the connection active timer
+        """
+        connection.timer = next(self._timer_ids)
+        heapq.heappush(self._timers, (time.monotonic() + delay, connection.timer, connection, callback))
+
+    def _get_select_timeout(self):
+        if not self._timers:
+            return None
+        return max(self._timers[0][0] - time.monotonic(), 0)
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, timer, connection, callback = heapq.heappop(self._timers)
+            if timer == connection.timer:
+                connection.timer = None
+                callback(connection)
+
+    def _connect(self, connection):
+        connection.state = CONNECTING
+        self._submit(connection, self._open, self._on_connected)
+
+    @staticmethod
+    def _open(connection):
+        """
+        Open the connection from a worker thread
+
+        :return: (socket, socket timeout) pair
+        """
+        transport = connection.transport
+        transport.connect()
+        transport._select(connection.mailbox)
+        sock = transport.connection.socket()
+        return sock, sock.gettimeout()
+
+    def _on_connected(self, connection, future):
+        """
+        Fetch the mails received while disconnected from an opened connection
+        """
+        if connection.state != CONNECTING:
+            return
+        try:
+            connection.sock, connection.sock_timeout = future.result()
+        except Exception as e:
+            transport = connection.transport
+            logging.error('IMAP connection to {0} for {1}, {2}'.format(transport.server, transport.username, e))
+            self._flush_acks(connection)
+            self._reconnect(connection)
+            return
+        connection.attempts = 0
+        self._flush_acks(connection)
+        self._fetch(connection)
+
+    def _fetch(self, connection):
+        """
+        Fetch new mails into the dispatch queue from a worker thread, which
+        owns the connection socket until it idles again
+        """
+        connection.state = FETCHING
+        connection.new_mail = False
+        try:
+            self.selector.unregister(connection.sock)
+        except KeyError:
+            pass
+        buffer, connection.buffer = connection.buffer, b''
+        self._submit(connection, self._fetch_mails, self._on_fetched, buffer)
+
+    @staticmethod
+    def _fetch_mails(connection, buffer):
+        """
+        Fetch new mails from a worker thread, again while new mails are
+        announced meanwhile. A partial response line read while idling is
+        completed first, so imaplib reads from a line start
+
+        :param buffer: Partial response line read while idling
+        :return: (list of mails, partial response line) pair
+        """
+        transport = connection.transport
+        imap = transport.connection
+        mails = []
+        new_mail = True
+        while new_mail:
+            connection.sock.settimeout(connection.sock_timeout)
+            if buffer:
+                check_new_mail([(buffer + imap.readline()).rstrip(b'\r\n')])
+            for name in NEW_MAIL_RESPONSES:
+                imap.untagged_responses.pop(name, None)
+            mails.extend(transport._retrieve_mails(get_msgs_type=connection.get_msgs_type, delete=connection.delete))
+            new_mail, buffer = ImapIdleManager._drain(imap, connection.sock)
+        return mails, buffer
+
+    @staticmethod
+    def _drain(imap, sock):
+        """
+        Look for new mails announced while fetching, in the untagged
+        responses collected by imaplib and in the data left in its reader
+        buffer, which the selector doesn't see. The buffered data is
+        consumed, so the manager reads the connection from then on
+
+        :return: (new mails announced, partial response line) pair
+        """
+        new_mail = bool(imap.untagged_responses.pop('EXISTS', None))
+        if any(count != b'0' for count in imap.untagged_responses.pop('RECENT', None) or ()):
+            new_mail = True
+
+        sock.setblocking(False)
+        data = []
+        try:
+            chunk = imap.file.peek(1)
+            while chunk:
+                data.append(imap.file.read(len(chunk)))
+                chunk = imap.file.peek(1)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            pass
+        lines = b''.join(data).split(b'\r\n')
+        buffer = lines.pop()
+        return check_new_mail(lines) or new_mail, buffer
+
+    def _on_fetched(self, connection, future):
+        """
+        Queue the fetched mails and start idling
+        """
+        if connection.state != FETCHING:
+            return
+        try:
+            mails, connection.buffer = future.result()
+        except Exception as e:
+            logging.error('IMAP fetch for {0} failed, {1}'.format(connection, e))
+            self._flush_acks(connection)
+            self._reconnect(connection)
+            return
+        connection.message_ids.update(mail['Message-ID'] for mail in mails)
+        self._flush_acks(connection)
+        for mail in mails:
+            self.queue.put(mail)
+        self._start_idle(connection)
+
+    def _start_idle(self, connection):
+        connection.tag = connection.transport.connection._new_tag()
+        if not self._send(connection, connection.tag + b' IDLE\r\n'):
+            return
+        connection.state = IDLE_SENT
+        connection.sock.setblocking(False)
+        try:
+            self.selector.get_key(connection.sock)
+        except KeyError:
+            self.selector.register(connection.sock, selectors.EVENT_READ, connection)
+        self._set_timer(connection, self.response_timeout, self._on_timeout)
+
+    def _send_done(self, connection):
+        if self._send(connection, b'DONE\r\n'):
+            connection.state = DONE_SENT
+            self._set_timer(connection, self.response_timeout, self._on_timeout)
+
+    def _send(self, connection, data):
+        try:
+            connection.transport.connection.send(data)
+        except CONNECTION_ERRORS as e:
+            logging.error('IMAP connection {0} failed, {1}'.format(connection, e))
+            self._reconnect(connection)
+            return False
+        return True
+
+    def _on_timeout(self, connection):
+        if connection.state == IDLING:
+            logging.info('renewing IMAP IDLE for {0}'.format(connection))
+            self._send_done(connection)
+            return
+        # replies received meanwhile are read before giving up
+        self._read(connection)
+        if connection.timer is None and connection.state in (IDLE_SENT, DONE_SENT):
+            logging.error('IMAP server not responding for {0}'.format(connection))
+            self._reconnect(connection)
+
+    def _read(self, connection):
+        """
+        Read the available data of an IDLE connection without blocking
+        """
+        data = []
+        try:
+            while True:
+                chunk = connection.sock.recv(4096)
+                if not chunk:
+                    raise EOFError('connection closed by the server')
+                data.append(chunk)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            pass
+        except CONNECTION_ERRORS as e:
+            logging.error('IMAP connection {0} failed, {1}'.format(connection, e))
+            self._reconnect(connection)
+            return
+
+        lines = (connection.buffer + b''.join(data)).split(b'\r\n')
+        connection.buffer = lines.pop()
+        for line in lines:
+            self._handle_line(connection, line)
+            if connection.state == DISCONNECTED:
+                return
+        if connection.state == IDLE_ENDED:
+            if connection.new_mail:
+                logging.info('new mail for {0}'.format(connection))
+                self._fetch(connection)
+            else:
+                self._start_idle(connection)
+
+    def _handle_line(self, connection, line):
+        """
+        Advance the connection state with a server response line
+        """
+        if line.startswith(b'* BYE'):
+            logging.info('IMAP server closed {0}: {1}'.format(connection, line.decode('ascii', 'replace')))
+            self._reconnect(connection)
+        elif is_new_mail_response(line):
+            connection.new_mail = True
+            if connection.state == IDLING:
+                self._send_done(connection)
+        elif line.startswith(b'+') and connection.state == IDLE_SENT:
+            connection.state = IDLING
+            if connection.new_mail:
+                self._send_done(connection)
+            else:
+                self._set_timer(connection, self.idle_timeout, self._on_timeout)
+        elif line.startswith(connection.tag + b' ') and connection.state in (IDLE_SENT, IDLING, DONE_SENT):
+            if line.split()[1].upper() != b'OK':
+                logging.error('IMAP IDLE rejected for {0}: {1}'.format(connection, line.decode('ascii', 'replace')))
+                self._reconnect(connection)
+            else:
+                # lines after the tagged response are still read before fetching
+                connection.state = IDLE_ENDED
+                connection.timer = None
+
+    def _close(self, connection):
+        if connection.sock is not None:
+            try:
+                self.selector.unregister(connection.sock)
+            except KeyError:
+                pass
+        try:
+            connection.transport.connection.shutdown()
+        except Exception as e:
+            logging.debug('IMAP connection {0} shutdown, {1}'.format(connection, e))
+        connection.state = DISCONNECTED
+        connection.sock = None
+        connection.buffer = b''
+        connection.timer = None
+
+    def _reconnect(self, connection):
+        """
+        Close the connection and schedule a new connection attempt after an
+        exponential backoff delay, with random jitter so accounts on the
+        same server don't reconnect at once
+        """
+        if connection.sock is not None:
+            self._close(connection)
+        connection.state = DISCONNECTED
+        delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** connection.attempts)
+        delay = random.uniform(delay / 2, delay)
+        connection.attempts += 1
+        logging.info('reconnecting {0} in {1:.1f} seconds'.format(connection, delay))
+        self._set_timer(connection, delay, self._connect)
@@ -19,6 +19,8 @@ class ImapIdleReceiverTransport(ImapReceiverTransport):
     """
     IMAP Idle Receiver Transport. This class instances a receiver object for the IMAP
     protocol which uses the IMAP IDLE check for obtaining new emails
+    Every instance blocks a thread, see :class:`~mailproc.transports.ImapIdleManager`
+    for watching many accounts
 
     :param server: Server for establish the IMAP connection
     :param username: Server identifying username
@@ -28,11 +30,18 @@ class ImapIdleReceiverTransport(ImapReceiverTransport):
     :param use_ssl: Use ssl connection. Default: True
     :param idle_timeout: Timeout for idle connections (in seconds). Default: 8 minutes (60*8)
     :param idle_loop: Restart the IDLE connection when timeout. Default: True
+    :param lazy: Parse only email headers, delaying the body parsing until it is
+                 accessed. Default: True
+    :param spool_threshold: Size in bytes above which mails and their parts
+                            payloads are spooled to temporary files instead
+                            of kept in memory. Default: None (never)
     """
 
     def __init__(self, server, username, password, callback,
-                 port=None, use_ssl=True, idle_timeout=60*8, idle_loop=True, **kwargs):
-        super(ImapIdleReceiverTransport, self).__init__(server, username, password, port, use_ssl)
+                 port=None, use_ssl=True, idle_timeout=60*8, idle_loop=True, lazy=True, spool_threshold=None,
+                 **kwargs):
+        super(ImapIdleReceiverTransport, self).__init__(server, username, password, port, use_ssl, lazy,
+                                                        spool_threshold, **kwargs)
 
         self.callback = callback
         self.idle_timeout = idle_timeout
@@ -49,7 +58,7 @@ class ImapIdleReceiverTransport(ImapReceiverTransport):
         :param delete: Delete obtained emails in account (default False)
         """
 
-        self.connection.select(mailbox)
+        self._select(mailbox)
 
         self.callback(self._retrieve_mails(get_msgs_type=get_msgs_type, delete=delete))
 
@@ -7,11 +7,29 @@
     :copyright: (c) 2018 Daxslab.
     :license: LGPL, see LICENSE for more details.
 """
-import email
+from email.message import Message
 import imaplib
+from itertools import chain
 import logging
+import re
 
+from mailproc.mailproc_email import Email
+from mailproc.tracing import tracer
 from mailproc.transports import BaseReceiverTransport
+from mailproc.transports.imap_utils import build_message_set
+from mailproc.transports.imap_utils import build_route_search
+from mailproc.transports.imap_utils import iter_chunks
+from mailproc.transports.imap_utils import parse_fetch_response
+from mailproc.transports.imap_utils import UidCheckpoint
+
+
+# headers fetched for the route filter
+ROUTING_HEADERS = 'FROM SUBJECT MESSAGE-ID'
+
+MAILBOX_STATUS_RE = re.compile(rb'(UIDVALIDITY|UIDNEXT) (\d+)')
+
+# message id placeholder of polled mails not fetched yet
+_NOT_FETCHED = object()
 
 
 class ImapReceiverTransport(BaseReceiverTransport):
@@ -24,15 +42,60 @@ class ImapReceiverTransport(BaseReceiverTransport):
     :param password: Server identifying password
     :param port: Server port for establish the IMAP connection. Default: None (for standard IMAP port)
     :param use_ssl: Use ssl connection. Default: True
+    :param lazy: Parse only email headers, delaying the body parsing until it is
+                 accessed. Default: True
+    :param spool_threshold: Size in bytes above which mails and their parts
+                            payloads are spooled to temporary files instead
+                            of kept in memory. Default: None (never)
+    :param fetch_chunk_size: Number of mails fetched, and flagged once
+                             processed, with a single command. Default: 200
+    :param uid_state_file: Path of a JSON file storing the UIDVALIDITY and
+                           the highest processed UID of every mailbox. When
+                           given, only mails newer than the last processed
+                           one are fetched, see :meth:`ack`. Default: None
+    :param route_filter: Function called with a headers only
+                         :class:`~mailproc.Email` object for every mail, as
+                         :meth:`mailproc.Mailproc.would_route`. When given,
+                         the 'From', 'Subject' and 'Message-ID' headers are
+                         fetched first and only the mails it returns True
+                         for are downloaded. Default: None
+    :param unrouted_flags: Flags set on the mails skipped by `route_filter`,
+                           as '(\\Seen)'. Default: None (leave them untouched)
+    :param route_search: :class:`~mailproc.Mailproc` application whose routes
+                         narrow the SEARCH query, so the server only returns
+                         mails from the literal addresses and domains of its
+                         'from' routes or with the literal subject prefixes
+                         of its 'subject' routes. The plain query is used
+                         when any route can't be expressed or the criteria
+                         are too long for a single SEARCH. Default: None
     """
 
-    def __init__(self, server, username, password, port=None, use_ssl=True, **kwargs):
+    def __init__(self, server, username, password, port=None, use_ssl=True, lazy=True, spool_threshold=None,
+                 fetch_chunk_size=200, uid_state_file=None, route_filter=None, unrouted_flags=None,
+                 route_search=None, **kwargs):
         self.server = server
         self.username = username
         self.password = password
         self.port = port
         self.use_ssl = use_ssl
+        self.lazy = lazy
+        self.spool_threshold = spool_threshold
+        self.fetch_chunk_size = fetch_chunk_size
+        self.checkpoint = UidCheckpoint(uid_state_file) if uid_state_file else None
+        self.route_filter = route_filter
+        self.unrouted_flags = unrouted_flags
+        self.route_search = route_search
+        self.mailbox = None
         self.connection = None
+        # UID sync state: (checkpoint key, uidvalidity), the UID below which
+        # every mail was processed and the highest synced UID
+        self._sync = None
+        self._last_uid = 0
+        self._highest_uid = 0
+        # message ids of the synced mails not yet acknowledged, by UID
+        self._unacked = {}
+        # state last saved to the checkpoint
+        self._saved = None
 
     def connect(self, **kwargs):
         """
@@ -70,25 +133,303 @@ class ImapReceiverTransport(BaseReceiverTransport):
         :param delete: Delete obtained emails in account (default False)
         :return: List of email.Message objects
         """
+        return list(self._iter_retrieve_mails(get_msgs_type=get_msgs_type, delete=delete))
 
-        # get all unread messages
-        status, response = self.connection.search(None, get_msgs_type)
-        unread_msg_nums = response[0].split()
-        mails = []
-        for e_id in unread_msg_nums:
-            _, response = self.connection.fetch(e_id, '(RFC822)')
-            email_message = email.message_from_string(response[0][1].decode('utf-8'))
+    def _iter_retrieve_mails(self, get_msgs_type='(UNSEEN)', delete=False):
+        """
+        Yields new (unseen) mails from account. Mails are fetched in chunks of
+        `fetch_chunk_size` mails, and the processed mails of a chunk are
+        flagged with a single command once the next chunk is requested
 
-            mails.append(email_message)
-        # Post Process
-        for e_id in unread_msg_nums:
-            self.connection.store(e_id, '+FLAGS', r'\Seen')
+        :param get_msgs_type: Expression for emails to get '(UNSEEN)' by default to get new emails
+        :param delete: Delete obtained emails in account (default False)
+        :return: Iterator of email.Message objects
+        """
+        msg_ids = self._search(get_msgs_type)
+        try:
+            for chunk in iter_chunks(msg_ids, self.fetch_chunk_size):
+                if self.route_filter is not None:
+                    chunk = self._filter_mails(chunk)
+                    if not chunk:
+                        continue
+                processed = []
+                try:
+                    for e_id, email_message in self._fetch_mails(chunk):
+                        yield email_message
+                        processed.append(e_id)
+                finally:
+                    # Post Process
+                    if processed:
+                        self._store_flags(processed, delete)
+        finally:
             if delete:
-                self.connection.store(e_id, '+FLAGS', '\\Deleted')
-        if delete:
-            self.connection.expunge()
+                self.connection.expunge()
+
+    def _select(self, mailbox):
+        """
+        Select a mailbox
+
+        :param mailbox: IMAP mailbox name
+        """
+        self.connection.select(mailbox)
+        self.mailbox = mailbox
+
+    def _search(self, get_msgs_type):
+        """
+        Return the ids of the mails to retrieve: sequence numbers, or UIDs
+        newer than the checkpoint when a UID state file is used. The
+        `get_msgs_type` expression selects the mails to retrieve in UID mode
+        only when the mailbox is synced for the first time or its
+        UIDVALIDITY changed
+
+        :param get_msgs_type: Expression for emails to get
+        :return: List of message ids
+        """
+        route_criteria = self._get_route_criteria()
+        if self.checkpoint is None:
+            status, response = self.connection.search(None, self._join_criteria(get_msgs_type, route_criteria))
+            return response[0].split()
+
+        key = '{0}@{1}/{2}'.format(self.username, self.server, self.mailbox)
+        uidvalidity, uidnext = self._get_mailbox_uids()
+        if self._sync != (key, uidvalidity):
+            self._load_sync(key, uidvalidity)
+        if self._sync is None:
+            return self._resync(key, uidvalidity, uidnext, get_msgs_type, route_criteria)
+
+        criteria = self._join_criteria('UID {0}:*'.format(self._last_uid + 1), route_criteria)
+        status, response = self.connection.uid('SEARCH', criteria)
+        # 'n:*' includes the last mail even when its UID is lower than n
+        found = sorted(uid for uid in (int(uid) for uid in response[0].split()) if uid > self._last_uid)
+        # released mails are fetched again, unless they were removed, while
+        # fetched mails wait for their acknowledgement
+        found_uids = set(found)
+        self._unacked = dict((uid, message_id) for uid, message_id in self._unacked.items()
+                             if message_id is not _NOT_FETCHED or uid in found_uids)
+        # mails between the checkpoint and the highest synced UID were processed
+        uids = [uid for uid in found if uid > self._highest_uid or self._unacked.get(uid) is _NOT_FETCHED]
+        self._highest_uid = max([self._highest_uid] + found[-1:])
+        if route_criteria is not None:
+            # mails left out by the server are skipped too
+            self._highest_uid = max(self._highest_uid, uidnext - 1)
+        self._unacked.update((uid, _NOT_FETCHED) for uid in uids)
+        self._advance_checkpoint()
+        return uids
+
+    def _load_sync(self, key, uidvalidity):
+        """
+        Load the saved sync state of a mailbox, if its UIDVALIDITY didn't change
+        """
+        saved_uidvalidity, last_uid, highest_uid, unacked_uids = self.checkpoint.get(key)
+        self._saved = None
+        if saved_uidvalidity != uidvalidity:
+            self._sync = None
+            return
+        self._sync = (key, uidvalidity)
+        self._last_uid, self._highest_uid = last_uid, highest_uid
+        self._unacked = dict((uid, _NOT_FETCHED) for uid in unacked_uids)
+
+    def _resync(self, key, uidvalidity, uidnext, get_msgs_type, route_criteria):
+        """
+        Sync a mailbox for the first time, or after its UIDVALIDITY changed,
+        searching the mails with the `get_msgs_type` expression
+        """
+        logging.info('IMAP mailbox {0} UIDVALIDITY changed, resyncing'.format(key))
+        status, response = self.connection.uid('SEARCH', self._join_criteria(get_msgs_type, route_criteria))
+        uids = sorted(int(uid) for uid in response[0].split())
+        self._sync = (key, uidvalidity)
+        self._last_uid = uids[0] - 1 if uids else uidnext - 1
+        # mails the search didn't return, as seen mails, are skipped
+        self._highest_uid = max(uids[-1] if uids else 0, uidnext - 1)
+        self._unacked = dict((uid, _NOT_FETCHED) for uid in uids)
+        self._advance_checkpoint()
+        return uids
+
+    def _get_route_criteria(self):
+        """
+        Return the SEARCH criteria of the `route_search` application routes,
+        or None if not used or any route can't be expressed
+        """
+        if self.route_search is None:
+            return None
+        return build_route_search(chain.from_iterable(self.route_search.routes_actions.values()))
+
+    @staticmethod
+    def _join_criteria(criteria, route_criteria):
+        if route_criteria is None:
+            return criteria
+        return '{0} {1}'.format(criteria, route_criteria)
+
+    def _get_mailbox_uids(self):
+        """
+        Return the selected mailbox UIDVALIDITY and UIDNEXT values
+        """
+        uidvalidity = self.connection.response('UIDVALIDITY')[1][0]
+        uidnext = self.connection.response('UIDNEXT')[1][0]
+        if uidvalidity is None or uidnext is None:
+            status, response = self.connection.status(self.mailbox, '(UIDVALIDITY UIDNEXT)')
+            values = dict(MAILBOX_STATUS_RE.findall(response[0]))
+            uidvalidity, uidnext = values[b'UIDVALIDITY'], values[b'UIDNEXT']
+        return int(uidvalidity), int(uidnext)
+
+    def _fetch_mails(self, msg_ids):
+        """
+        Fetch a chunk of mails with a single FETCH command
+
+        :param msg_ids: List of message sequence numbers, or UIDs in UID mode
+        :return: List of (message id, email.Message object) pairs
+        """
+        trace = tracer.start_trace()
+        with tracer.span('fetch', trace=trace):
+            if self.checkpoint is None:
+                _, response = self.connection.fetch(build_message_set(msg_ids), '(RFC822)')
+            else:
+                _, response = self.connection.uid('FETCH', build_message_set(msg_ids), '(UID RFC822)')
+        email_messages = []
+        for e_id, items in parse_fetch_response(response).items():
+            if 'RFC822' not in items:
+                continue
+            # every mail gets its own trace, sharing the chunk fetch span
+            mail_trace = tracer.start_trace()
+            if trace is not None:
+                mail_trace.spans.extend(trace.spans)
+            with tracer.span('parse', trace=mail_trace):
+                email_message = Email.from_bytes(items['RFC822'], lazy=self.lazy,
+                                                 spool_threshold=self.spool_threshold)
+            tracer.attach(email_message, mail_trace)
+            if self.checkpoint is not None:
+                e_id = items['UID']
+                self._unacked[e_id] = email_message['Message-ID']
+            email_messages.append((e_id, email_message))
 
-        return mails
+        if self.checkpoint is not None:
+            # mails removed meanwhile don't hold the checkpoint back
+            for uid in msg_ids:
+                if self._unacked.get(uid) is _NOT_FETCHED:
+                    del self._unacked[uid]
+        return email_messages
+
+    def _filter_mails(self, msg_ids):
+        """
+        Fetch the routing headers of a chunk of mails with a single FETCH
+        command, returning the ids of the mails accepted by `route_filter`.
+        Skipped mails are acknowledged and flagged with `unrouted_flags`
+
+        :param msg_ids: List of message sequence numbers, or UIDs in UID mode
+        :return: List of message ids
+        """
+        headers_item = 'BODY.PEEK[HEADER.FIELDS ({0})]'.format(ROUTING_HEADERS)
+        with tracer.span('fetch_headers'):
+            if self.checkpoint is None:
+                _, response = self.connection.fetch(build_message_set(msg_ids), '({0})'.format(headers_item))
+            else:
+                _, response = self.connection.uid('FETCH', build_message_set(msg_ids),
+                                                  '(UID {0})'.format(headers_item))
+
+        routable, unrouted = [], []
+        for e_id, items in parse_fetch_response(response).items():
+            headers = next((value for name, value in items.items() if name.startswith('BODY[HEADER')), None)
+            if headers is None:
+                continue
+            if self.checkpoint is not None:
+                e_id = items['UID']
+            if self.route_filter(Email.from_bytes(headers)):
+                routable.append(e_id)
+            else:
+                unrouted.append(e_id)
+
+        if unrouted:
+            logging.info('IMAP skipped {0} mails without matching routes'.format(len(unrouted)))
+            if self.checkpoint is not None:
+                for uid in unrouted:
+                    self._unacked.pop(uid, None)
+            if self.unrouted_flags:
+                self._store(unrouted, self.unrouted_flags)
+        return routable
+
+    def _store(self, msg_ids, flags):
+        """
+        Add flags to mails with a single STORE command
+
+        :param msg_ids: List of message sequence numbers, or UIDs in UID mode
+        :param flags: Flags list, as '(\\Seen)'
+        """
+        if self.checkpoint is None:
+            self.connection.store(build_message_set(msg_ids), '+FLAGS', flags)
+        else:
+            self.connection.uid('STORE', build_message_set(msg_ids), '+FLAGS', flags)
+
+    def _store_flags(self, msg_ids, delete=False):
+        """
+        Flag processed mails as seen, and as deleted if requested, with a
+        single STORE command
+
+        :param msg_ids: List of message sequence numbers, or UIDs in UID mode
+        :param delete: Flag the mails as deleted
+        """
+        self._store(msg_ids, r'(\Seen \Deleted)' if delete else r'(\Seen)')
+
+    def ack(self, results):
+        """
+        Acknowledge the mails processed successfully. The checkpoint moves
+        up to the first unacknowledged mail, and the unacknowledged UIDs
+        above it are saved too, so the mails acknowledged after a failed one
+        are not fetched again. Unacknowledged mails, as the ones whose
+        actions failed, are fetched again by the next poll. Pass it to
+        :meth:`~mailproc.Mailproc.run` as its `ack` argument. Does nothing
+        when no UID state file is used
+
+        :param results: List of :class:`~mailproc.dispatch.DispatchResult`
+                        or :class:`~email.message.Message` objects
+        """
+        if self._sync is None:
+            return
+        uids_by_message_id = {}
+        for uid, message_id in sorted(self._unacked.items()):
+            if message_id is not _NOT_FETCHED:
+                uids_by_message_id.setdefault(message_id, []).append(uid)
+        for result in results:
+            message_id = result['Message-ID'] if isinstance(result, Message) else result.message_id
+            uids = uids_by_message_id.get(message_id)
+            if uids:
+                del self._unacked[uids.pop(0)]
+        self._advance_checkpoint()
+
+    def release(self, results=None):
+        """
+        Release fetched mails that won't be acknowledged, as the ones whose
+        actions failed, so the next poll fetches them again. Fetched mails
+        are not fetched again until they are released, which
+        :meth:`get_mails` and :meth:`iter_mails` do for all the mails of
+        previous polls. Does nothing when no UID state file is used
+
+        :param results: List of :class:`~mailproc.dispatch.DispatchResult`
+                        or :class:`~email.message.Message` objects. Default:
+                        None (release all fetched mails)
+        """
+        if results is None:
+            self._unacked = dict.fromkeys(self._unacked, _NOT_FETCHED)
+            return
+        message_ids = set(result['Message-ID'] if isinstance(result, Message) else result.message_id
+                          for result in results)
+        for uid, message_id in self._unacked.items():
+            if message_id in message_ids:
+                self._unacked[uid] = _NOT_FETCHED
+
+    def _advance_checkpoint(self):
+        """
+        Save the UID below the first unacknowledged mail, or the highest
+        synced UID if all mails were acknowledged, and the unacknowledged
+        UIDs. UIDs the search didn't return, as seen mails in a resync,
+        count as acknowledged
+        """
+        key, uidvalidity = self._sync
+        last_uid = min(self._unacked) - 1 if self._unacked else self._highest_uid
+        self._last_uid = max(self._last_uid, last_uid)
+        state = (uidvalidity, self._last_uid, self._highest_uid, sorted(self._unacked))
+        if state != self._saved:
+            self.checkpoint.set(key, *state)
+            self._saved = state
 
     def get_mails(self, get_msgs_type='(UNSEEN)', mailbox="INBOX", delete=False, **kwargs):
         """
@@ -100,6 +441,25 @@ class ImapReceiverTransport(BaseReceiverTransport):
         :return: List of email.Message objects
         """
 
-        self.connection.select(mailbox)
+        self._select(mailbox)
+        self.release()
 
         return self._retrieve_mails(get_msgs_type=get_msgs_type, delete=delete)
+
+    def iter_mails(self, get_msgs_type='(UNSEEN)', mailbox="INBOX", delete=False, **kwargs):
+        """
+        Yields new (unseen) mails from account. Mails are fetched with a
+        single FETCH command per chunk of `fetch_chunk_size` mails, and the
+        processed mails of a chunk are flagged with a single STORE command
+
+        :param get_msgs_type: Expression for emails to get '(UNSEEN)' by default to get new emails
+        :param mailbox: IMAP mailbox for fetching emails, default: "INBOX"
+        :param delete: Delete obtained emails in account (default False)
+        :return: Iterator of email.Message objects
+        """
+
+        self._select(mailbox)
+        self.release()
+
+        for email_message in self._iter_retrieve_mails(get_msgs_type=get_msgs_type, delete=delete):
+            yield email_message
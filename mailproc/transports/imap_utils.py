@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+    mailproc.transports.imap_utils
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    This module implements IMAP protocol helpers for the mailProc IMAP transports.
+
+    :copyright: (c) 2018 Daxslab.
+    :license: LGPL, see LICENSE for more details.
+"""
+from collections import OrderedDict
+import json
+import logging
+import os
+import re
+import threading
+
+from mailproc.routing import LITERAL_ADDRESS_PART_RE
+
+
+# limits of the route SEARCH criteria: servers reject deeply nested OR
+# keys and command lines longer than a few kilobytes (RFC 7162 advises
+# clients to keep them under 8192 octets)
+MAX_ROUTE_SEARCH_KEYS = 100
+MAX_ROUTE_SEARCH_LENGTH = 4000
+
+FETCH_HEADER_RE = re.compile(rb'^(\d+) \((.*)$', re.DOTALL)
+FETCH_LITERAL_RE = re.compile(rb'(?:^| )([A-Z0-9.]+(?:\[[^\]]*\])?(?:<\d+>)?) \{\d+\}$', re.IGNORECASE)
+FETCH_UID_RE = re.compile(rb'(?:^|[ (])UID (\d+)', re.IGNORECASE)
+FETCH_FLAGS_RE = re.compile(rb'(?:^|[ (])FLAGS \(([^)]*)\)', re.IGNORECASE)
+
+
+def build_message_set(ids):
+    """
+    Return an IMAP message set for a list of message sequence numbers or
+    UIDs, joining consecutive numbers in ranges, as '1:3,5,8:9'
+
+    :param ids: List of numbers, as int or bytes/str digits
+    :return: Message set string
+    """
+    numbers = sorted(set(int(i) for i in ids))
+    ranges = []
+    for number in numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join(str(start) if start == end else '{0}:{1}'.format(start, end) for start, end in ranges)
+
+
+def iter_chunks(items, size):
+    """
+    Iterate over consecutive slices of a list
+
+    :param items: List
+    :param size: Slice size
+    :return: Iterator over lists
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def quote_search_string(value):
+    """
+    Return an IMAP quoted string for a SEARCH command key
+
+    :param value: String
+    :return: Quoted string, or None for strings that can't be sent quoted,
+             as non-ascii ones
+    """
+    try:
+        value.encode('ascii')
+    except UnicodeEncodeError:
+        return None
+    if '\r' in value or '\n' in value:
+        return None
+    return '"{0}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def get_route_search_key(route):
+    """
+    Return the IMAP SEARCH key matching at least every mail routed by a
+    route: FROM with the literal address, domain ('@example.com') or local
+    part ('noreply@') of 'from' routes, SUBJECT with the literal prefix of
+    'subject' routes. IMAP searches are case insensitive substring matches,
+    so the server may return mails the route doesn't match, never the
+    other way around
+
+    :param route: :class:`~mailproc.routing.Route` object
+    :return: Search key string, or None if the route can't be expressed
+    """
+    if route.target == 'from':
+        if '|' in route.rule:
+            return None
+        local, _, domain = route.rule.rpartition('@')
+        literal_local = bool(LITERAL_ADDRESS_PART_RE.match(local))
+        literal_domain = bool(LITERAL_ADDRESS_PART_RE.match(domain))
+        if literal_local and literal_domain:
+            value = route.rule
+        elif local and literal_domain:
+            value = '@{0}'.format(domain)
+        elif literal_local and domain:
+            value = '{0}@'.format(local)
+        else:
+            return None
+        key = 'FROM'
+    elif route.target == 'subject':
+        value = route.get_literal_prefix()
+        if not value:
+            return None
+        key = 'SUBJECT'
+    else:
+        return None
+    value = quote_search_string(value)
+    return '{0} {1}'.format(key, value) if value else None
+
+
+def build_route_search(routes, max_keys=MAX_ROUTE_SEARCH_KEYS, max_length=MAX_ROUTE_SEARCH_LENGTH):
+    """
+    Return the IMAP SEARCH criteria matching the mails of any of a list of
+    routes, joined with OR keys, as 'OR FROM "@a.cu" SUBJECT "order "'
+
+    :param routes: List of :class:`~mailproc.routing.Route` objects
+    :param max_keys: Maximum number of search keys. Default: :data:`MAX_ROUTE_SEARCH_KEYS`
+    :param max_length: Maximum criteria length. Default: :data:`MAX_ROUTE_SEARCH_LENGTH`
+    :return: Search criteria string, or None if there are no routes, any
+             route can't be expressed or the criteria exceed the limits
+    """
+    keys = []
+    for route in routes:
+        key = get_route_search_key(route)
+        if key is None:
+            logging.info('Route "{0}" can\'t be expressed as an IMAP search'.format(route.rule))
+            return None
+        if key not in keys:
+            keys.append(key)
+    if not keys:
+        return None
+    if len(keys) > max_keys:
+        logging.info('Routes need {0} IMAP search keys, over the limit of {1}'.format(len(keys), max_keys))
+        return None
+    criteria = keys[-1]
+    for key in reversed(keys[:-1]):
+        criteria = 'OR {0} {1}'.format(key, criteria)
+    if len(criteria) > max_length:
+        logging.info('Routes IMAP search is {0} characters long, over the limit of {1}'.format(
+            len(criteria), max_length))
+        return None
+    return criteria
+
+
+def _parse_attributes(data, message):
+    uid = FETCH_UID_RE.search(data)
+    if uid:
+        message['UID'] = int(uid.group(1))
+    flags = FETCH_FLAGS_RE.search(data)
+    if flags:
+        message['FLAGS'] = tuple(flags.group(1).decode('ascii', 'replace').split())
+
+
+def parse_fetch_response(data):
+    """
+    Parse the response data of an IMAP FETCH command, as returned by
+    :meth:`imaplib.IMAP4.fetch` and :meth:`imaplib.IMAP4.uid`. Every
+    message may include several literal data items, as 'RFC822' or
+    'BODY[HEADER.FIELDS (FROM)]', plus 'UID' and 'FLAGS' attributes.
+    Unsolicited FETCH responses, as flag updates, are merged too.
+
+    :param data: Response data list
+    :return: OrderedDict of dicts of data items, by message sequence number
+    """
+    messages = OrderedDict()
+    message = None
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            header, literal = item
+            match = FETCH_HEADER_RE.match(header)
+            if match:
+                message = messages.setdefault(int(match.group(1)), {})
+                header = match.group(2)
+            if message is None:
+                continue
+            name = FETCH_LITERAL_RE.search(header)
+            if name:
+                message[name.group(1).decode('ascii').upper()] = literal
+            _parse_attributes(header, message)
+            continue
+
+        match = FETCH_HEADER_RE.match(item)
+        if match:
+            # response without literals
+            message = messages.setdefault(int(match.group(1)), {})
+            _parse_attributes(match.group(2), message)
+        elif message is not None:
+            # remaining attributes of the previous message
+            _parse_attributes(item, message)
+    return messages
+
+
+class UidCheckpoint:
+    """
+    Persisted IMAP sync state of every account mailbox, stored in a JSON
+    file: the UIDVALIDITY, the highest UID below which every mail was
+    processed and, when mails failed, the highest synced UID and the
+    unacknowledged UIDs up to it. Mails above the checkpoint other than
+    the unacknowledged ones were processed already
+
+    :param path: State file path, created if missing
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as state_file:
+                self.state = json.load(state_file)
+        except FileNotFoundError:
+            self.state = {}
+
+    def get(self, key):
+        """
+        Return the sync state of a mailbox
+
+        :param key: Account mailbox key
+        :return: (uidvalidity, last_uid, highest_uid, unacked_uids) tuple, or
+                 (None, 0, 0, []) if unknown
+        """
+        entry = self.state.get(key)
+        if entry is None:
+            return None, 0, 0, []
+        return (entry['uidvalidity'], entry['last_uid'], entry.get('highest_uid', entry['last_uid']),
+                entry.get('unacked_uids', []))
+
+    def set(self, key, uidvalidity, last_uid, highest_uid=None, unacked_uids=()):
+        """
+        Update and save the sync state of a mailbox. The file is replaced
+        atomically so a crash never leaves it half written
+
+        :param key: Account mailbox key
+        :param uidvalidity: Mailbox UIDVALIDITY
+        :param last_uid: Highest UID below which every mail was processed
+        :param highest_uid: Highest synced UID. Default: `last_uid`
+        :param unacked_uids: Unacknowledged UIDs above `last_uid`
+        """
+        entry = {'uidvalidity': uidvalidity, 'last_uid': last_uid}
+        if unacked_uids:
+            entry['highest_uid'] = highest_uid
+            entry['unacked_uids'] = sorted(unacked_uids)
+        with self._lock:
+            self.state[key] = entry
+            tmp_path = '{0}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as state_file:
+                json.dump(self.state, state_file, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
@@ -10,6 +10,7 @@
 import logging
 import smtplib
 
+from mailproc.tracing import tracer
 from mailproc.transports import BaseSenderTransport
 
 
@@ -60,7 +61,8 @@ class SmtpSenderTransport(BaseSenderTransport):
 
     def send_mail(self, email_from, email_to, email_subject, email_text, email_html=None, email_bcc=None,
                   email_encode='utf-8', log=None, json_attachment=None, json_attachment_filename='attachment.json',
-                  json_attachment_base64_encode=False, json_attachment_gzip=False, **kwargs):
+                  json_attachment_base64_encode=False, json_attachment_gzip=False, json_attachment_compression=None,
+                  json_attachment_compression_level=None, **kwargs):
         """
         Send an email message with text only or multipart HTML body
 
@@ -76,6 +78,9 @@ class SmtpSenderTransport(BaseSenderTransport):
         :param json_attachment_filename: JSON attachment filename (default attachment.json)
         :param json_attachment_base64_encode: Apply a base64 encode to JSON file (default False)
         :param json_attachment_gzip: Send JSON attachment as gzip file (default False)
+        :param json_attachment_compression: Compression codec name for the JSON attachment, as 'gzip',
+                                            'zlib', 'bz2', 'lzma' or 'zstd' (default None)
+        :param json_attachment_compression_level: Compression level (default: the codec default)
         """
         all_send_addresses = []
         if isinstance(email_to, str):
@@ -92,9 +97,12 @@ class SmtpSenderTransport(BaseSenderTransport):
                                            json_attachment=json_attachment,
                                            json_attachment_filename=json_attachment_filename,
                                            json_attachment_base64_encode=json_attachment_base64_encode,
-                                           json_attachment_gzip=json_attachment_gzip)
+                                           json_attachment_gzip=json_attachment_gzip,
+                                           json_attachment_compression=json_attachment_compression,
+                                           json_attachment_compression_level=json_attachment_compression_level)
 
-            self.connection.sendmail(email_from, all_send_addresses, msg_root.as_string())
+            with tracer.span('send'):
+                self.connection.sendmail(email_from, all_send_addresses, msg_root.as_string())
 
             logging.info('SEND {0}'.format(log))
             return True
@@ -23,6 +23,9 @@ setup(
                 'pytest-cov',
                 'sphinx',
                 'tox'
+            ],
+            'zstd': [
+                'zstandard'
             ]
         },
     classifiers=[
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import email
 import os
 import pytest
 
@@ -14,3 +15,10 @@ def app():
 @pytest.fixture()
 def static_dir():
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), "static")
+
+
+@pytest.fixture()
+def make_mail():
+    def make_mail(sender, subject):
+        return email.message_from_string("From: {0}\nSubject: {1}\n\nbody".format(sender, subject))
+    return make_mail
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import pytest
+
+from mailproc import Mailproc
+from mailproc.exceptions import AsyncActionError
+from mailproc.exceptions import MessageInstanceError
+
+
+def test_parallel_run(make_mail):
+    app = Mailproc("test_parallel_app")
+    processed = []
+
+    @app.route_from('<name>@test.mailproc.cu')
+    def from_action(name, mail):
+        if name == 'slow':
+            time.sleep(0.01)
+        processed.append((name, mail.get_subject()))
+        return name
+
+    @app.route_subject('fail')
+    def fail_action(mail):
+        raise ValueError('action error')
+
+    mails = [make_mail('{0}@test.mailproc.cu'.format(name), str(i))
+             for i in range(20) for name in ('slow', 'fast')]
+    mails.append(make_mail('fast@test.mailproc.cu', 'fail'))
+
+    results = app.run(mails, workers=4)
+
+    assert len(results) == len(mails)
+    assert [result.index for result in results] == list(range(len(mails)))
+    assert results[0].results == {'from': 'slow'}
+    assert isinstance(results[-1].error, ValueError)
+    for name in ('slow', 'fast'):
+        subjects = [subject for sender, subject in processed if sender == name]
+        assert subjects[:20] == [str(i) for i in range(20)]
+
+
+def test_process_run(make_mail):
+    app = Mailproc("test_process_app")
+
+    @app.route_subject('order <int:order_id>')
+    def order(order_id, mail):
+        return order_id * 2
+
+    results = app.run([make_mail('a@test.mailproc.cu', 'order 21')], workers=2, executor='process')
+    assert results[0].results == {'subject': 42}
+    assert results[0].error is None
+
+
+def test_run_async(make_mail):
+    app = Mailproc("test_async_app")
+    state = {'running': 0, 'max_running': 0}
+
+    @app.route_subject('async <int:number>')
+    async def async_action(number, mail):
+        state['running'] += 1
+        state['max_running'] = max(state['max_running'], state['running'])
+        await asyncio.sleep(0.01)
+        state['running'] -= 1
+        return number
+
+    @app.route_from('<name>@test.mailproc.cu')
+    def sync_action(name, mail):
+        return name
+
+    async def mails():
+        for i in range(20):
+            yield make_mail('user@test.mailproc.cu', 'async {0}'.format(i))
+
+    results = asyncio.run(app.run_async(mails(), concurrency=5))
+    assert [result.results for result in results] == [{'from': 'user', 'subject': i} for i in range(20)]
+    assert state['max_running'] == 5
+
+
+def test_async_actions_errors(make_mail):
+    app = Mailproc("test_async_errors_app")
+    state = {'started': 0, 'finished': 0}
+
+    @app.route_subject('async <int:number>')
+    async def async_action(number, mail):
+        state['started'] += 1
+        await asyncio.sleep(0.1)
+        state['finished'] += 1
+        return number
+
+    # sync runs can't await async actions
+    mails = [make_mail('user@test.mailproc.cu', 'async 1')]
+    with pytest.raises(AsyncActionError):
+        app.run(mails)
+    with pytest.raises(AsyncActionError):
+        app.run(mails, workers=2, executor='process')
+    with pytest.raises(AsyncActionError):
+        app.dispatch_mail(mails[0], capture_errors=False)
+
+    # dispatched mails are cancelled when a later mail is invalid
+    async def invalid_mails():
+        yield mails[0]
+        await asyncio.sleep(0.01)
+        yield 'not a mail'
+
+    async def run():
+        with pytest.raises(MessageInstanceError):
+            await app.run_async(invalid_mails())
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert state == {'started': 1, 'finished': 0}
+
+
+def test_batch_routes(make_mail):
+    app = Mailproc("test_batch_app")
+    batches = []
+    single = []
+
+    @app.route_subject('order <int:order_id>', batch=True, max_batch=3)
+    def orders(items):
+        batches.append([(kwargs['order_id'], mail.get_from_address()) for kwargs, mail in items])
+
+    @app.route_subject('<anything>')
+    def other(anything, mail):
+        single.append(anything)
+
+    mails = [make_mail('user@test.mailproc.cu', 'order {0}'.format(i)) for i in range(5)]
+    mails.append(make_mail('user@test.mailproc.cu', 'hello'))
+
+    results = app.run(mails)
+    assert batches == [[(0, 'user@test.mailproc.cu'), (1, 'user@test.mailproc.cu'), (2, 'user@test.mailproc.cu')],
+                       [(3, 'user@test.mailproc.cu'), (4, 'user@test.mailproc.cu')]]
+    assert single == ['hello']
+    assert results[0].results == {'subject': None}
+
+    del batches[:]
+    app.run(mails, workers=2)
+    assert sorted(order_id for batch in batches for order_id, _ in batch) == list(range(5))
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
+import base64
+import email
 import os
+import pickle
+import quopri
 from tempfile import mkdtemp
 
 from mailproc import Email
+from mailproc.mailproc_email import parse_address
+from mailproc.spool import SpooledPayload
 from mailproc.transports import FileSenderTransport, FileReceiverTransport
 
 TMP_DIR = mkdtemp()
@@ -95,3 +101,172 @@ def test_get_json_base64_gzip_email(app):
     mail.__class__ = Email
     json_dict = mail.get_json_attachment(base64_decode=True, gzipped=True)
     assert json_dict == TEST_JSON
+
+
+def test_email_view(static_dir):
+    msg = email.message_from_file(open(os.path.join(static_dir, 'test_email.eml')))
+    mail = Email.from_message(msg)
+
+    assert isinstance(mail, Email)
+    assert Email.from_message(mail) is mail
+    assert mail.get_subject() == "test email"
+
+    msg.replace_header('Subject', 'new subject')
+    assert mail.get_subject() == "new subject"
+    assert mail.get_from_address() == "test@test.com"
+
+
+def test_lazy_email(static_dir):
+    raw = open(os.path.join(static_dir, 'test_email.eml')).read()
+    mail = Email.from_string(raw)
+
+    assert mail.is_lazy
+    assert mail.get_subject() == "test email"
+    assert mail.get_from_address() == "test@test.com"
+    assert mail.get_content_type() == "text/plain"
+    assert mail.is_lazy
+
+    assert mail.get_body().strip() == "test email body"
+    assert not mail.is_lazy
+    assert mail.as_string() == Email.from_string(raw, lazy=False).as_string()
+
+
+def test_bytes_email_8bit():
+    raw = (u"From: Jos\xe9 <jose@test.mailproc.cu>\nSubject: caf\xe9\n"
+           u"Content-Type: text/plain; charset=latin-1\n\nol\xe1\n").encode('latin-1')
+
+    for lazy in (True, False):
+        mail = Email.from_bytes(memoryview(raw), lazy=lazy)
+        assert mail.get_from_address() == "jose@test.mailproc.cu"
+        assert mail.get_from_name() == u"Jos\xe9"
+        assert mail.get_subject() == u"caf\xe9"
+        assert mail.get_body() == u"ol\xe1\n"
+        assert bytes(mail.get_raw()) == raw
+
+
+def test_cached_headers(static_dir):
+    mail = Email.from_string(open(os.path.join(static_dir, 'test_email.eml')).read())
+
+    assert mail.get_from_name() == u"Carlos Cesar Caballero D\xedaz"
+    assert mail.get_from_name() == u"Carlos Cesar Caballero D\xedaz"
+    assert mail.get_subject() is mail.get_subject()
+
+    mail.replace_header('Subject', '=?utf-8?q?caf=C3=A9?=')
+    assert mail.get_subject() == u"caf\xe9"
+    del mail['From']
+    mail['From'] = 'other@test.com'
+    assert mail.get_from_address() == 'other@test.com'
+    assert mail.get_from_name() == ''
+
+
+def test_parse_address():
+    values = [
+        'user@test.com',
+        '<user@test.com>',
+        'John Doe <john@test.com>',
+        '"Doe, John" <john@test.com>',
+        'John (Johnny) <john@test.com>',
+        '"a\\"b" <john@test.com>',
+        '',
+    ]
+    for value in values:
+        assert parse_address(value) == email.utils.parseaddr(value)
+
+    assert parse_address('John <John.Doe@Test.COM>') == ('John', 'John.Doe@test.com')
+
+    # missing 'From' header
+    assert parse_address(None) == ('', '')
+    mail = Email.from_bytes(b'Subject: no sender\r\n\r\nbody\r\n')
+    assert mail.get_from_address() == ''
+    assert mail.get_from_name() == ''
+
+
+def test_iter_body():
+    mail = email.message_from_string(
+        'From: a@test.com\nContent-Type: multipart/mixed; boundary="b"\n\n'
+        '--b\nContent-Type: text/plain\n\nfirst line\nsecond line\n'
+        '--b\nContent-Type: text/plain; charset="latin-1"\nContent-Transfer-Encoding: base64\n\n'
+        'b2zhCg==\n'
+        '--b--\n', _class=Email)
+
+    assert list(mail.iter_body()) == [u"first line\nsecond line", u"ol\xe1\n"]
+    assert mail.get_body() == u"first line\nsecond lineol\xe1\n"
+    assert mail.get_body(max_chars=10) == u"first line"
+    assert mail.get_body(max_chars=25) == u"first line\nsecond lineol\xe1"
+    assert mail.get_body(html=True) == ''
+
+    # large transfer encoded bodies are decoded chunk by chunk
+    text = u'ol\xe1 mundo ' * 20000
+    for encoding in ('base64', 'quoted-printable'):
+        mail = Email()
+        mail['Content-Type'] = 'text/plain; charset="utf-8"'
+        mail['Content-Transfer-Encoding'] = encoding
+        if encoding == 'base64':
+            mail.set_payload(base64.encodebytes(text.encode('utf-8')).decode('ascii'))
+        else:
+            mail.set_payload(quopri.encodestring(text.encode('utf-8')).decode('ascii'))
+        assert len(next(mail.iter_body())) < len(text)
+        assert mail.get_body() == text
+        assert mail.get_body(max_chars=20) == text[:20]
+
+
+def test_attachments_index():
+    mail = email.message_from_string(
+        'From: a@test.com\nContent-Type: multipart/mixed; boundary="b"\n\n'
+        '--b\nContent-Type: text/plain\n\nthe body\n'
+        '--b\nContent-Type: application/json\nContent-Disposition: attachment; filename="a.json"\n\n'
+        '{"a": 1}\n'
+        '--b\nContent-Type: text/csv\nContent-Disposition: attachment; filename="b.csv"\n'
+        'Content-Transfer-Encoding: base64\n\n'
+        'YSxiCg==\n'
+        '--b--\n', _class=Email)
+
+    assert [a.filename for a in mail.iter_attachments()] == ['a.json', 'b.csv']
+    attachment = mail.get_attachment('b.csv')
+    assert attachment.content_type == 'text/csv'
+    assert attachment.disposition == 'attachment'
+    assert attachment.get_payload() == b'a,b\n'
+    assert mail.get_attachment(content_type='application/json').filename == 'a.json'
+    assert mail.get_attachment('a.json', 'text/csv') is None
+    assert mail.get_json_attachment('a.json') == {'a': 1}
+
+    mail.attach(email.message_from_string(
+        'Content-Type: text/plain\nContent-Disposition: attachment; filename="c.txt"\n\nc\n'))
+    assert mail.get_attachment('c.txt').get_payload() == b'c\n'
+
+
+def test_spooled_payloads(app, tmpdir):
+    records = [{'id': i, 'name': 'record {0}'.format(i)} for i in range(2000)]
+    message = FileSenderTransport(str(tmpdir)).create_message(
+        'a@test.com', 'b@test.com', 'records', 'the body', json_attachment=records,
+        json_attachment_compression='gzip', json_attachment_compression_level=1)
+    raw = message.as_bytes()
+    with open(os.path.join(str(tmpdir), 'big.eml'), 'wb') as f:
+        f.write(raw)
+
+    mail = FileReceiverTransport(str(tmpdir), spool_threshold=1000).get_mails()[0]
+    assert isinstance(mail.get_raw(), memoryview)
+    assert bytes(mail.get_raw()) == raw
+    assert mail.get_body() == 'the body'
+
+    attachment = mail.get_attachment('attachment.json')
+    assert attachment.is_spooled
+    assert isinstance(attachment.get_raw_payload(), memoryview)
+    assert attachment.size == len(attachment.get_raw_payload()) > 1000
+    assert mail.get_json_attachment() == records
+    assert attachment.get_payload() == b''.join(attachment.iter_payload())
+    assert 'Content-Disposition: attachment' in mail.as_string()
+
+    # spooled payloads are copied when pickled, as for process workers
+    assert pickle.loads(pickle.dumps(mail)).get_json_attachment() == records
+
+    # spooled messages are parsed chunk by chunk, spooling parts as parsed
+    for lazy in (True, False):
+        mail = Email.from_bytes(SpooledPayload(raw), lazy=lazy, spool_threshold=1000)
+        assert mail.get_attachment('attachment.json').is_spooled
+        assert mail.get_json_attachment() == records
+        assert all('_mailproc_parse_spool' not in part.__dict__ for part in mail.walk())
+
+    small = Email.from_bytes(raw, spool_threshold=len(raw) * 2)
+    assert not small.get_attachment('attachment.json').is_spooled
+    assert small.get_json_attachment() == records
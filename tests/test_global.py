@@ -2,7 +2,6 @@
 import os
 from tempfile import mkdtemp
 
-from mailproc import Email
 from mailproc.transports import FileSenderTransport, FileReceiverTransport
 
 TMP_DIR = mkdtemp()
@@ -46,21 +45,18 @@ def test_run(app):
     def testing_from(name, mail):
         global count_from
         count_from += 1
-        mail.__class__ = Email
         assert name == mail.get_from_address().split('@')[0]
 
     @app.route_subject('hello <part>')
     def testing_subject_hello(part, mail):
         global subject_hello
         subject_hello += 1
-        mail.__class__ = Email
         assert part == mail.get_subject().split(' ')[1]
 
     @app.route_subject('this <part> subject')
     def testing_subject_this(part, mail):
         global subject_this
         subject_this += 1
-        mail.__class__ = Email
         assert part == mail.get_subject().split(' ')[1]
 
     app.run(receiver_transport.get_mails(delete=True))
@@ -68,3 +64,17 @@ def test_run(app):
     assert count_from == 2
     assert subject_hello == 1
     assert subject_this == 1
+
+
+def test_run_streaming(app):
+    sender_transport = FileSenderTransport(TMP_DIR)
+    for i in range(10):
+        sender_transport.send_mail("stream@test.stream.cu", "noreply@test.mailproc.cu", "stream", "the body")
+
+    receiver_transport = FileReceiverTransport(TMP_DIR)
+    mails = receiver_transport.iter_mails(delete=True)
+    assert not isinstance(mails, list)
+
+    results = app.run(mails, prefetch=2)
+    assert len(results) == 10
+    assert os.listdir(TMP_DIR) == []
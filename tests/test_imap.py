@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+import itertools
+import json
+import os
+import re
+import socket
+import time
+
+from mailproc import Email
+from mailproc import Mailproc
+from mailproc.routing import Route
+from mailproc.transports import ImapIdleManager
+from mailproc.transports import ImapReceiverTransport
+from mailproc.transports.imap_utils import build_message_set
+from mailproc.transports.imap_utils import build_route_search
+from mailproc.transports.imap_utils import parse_fetch_response
+
+SEARCH_KEY_RE = re.compile(r'(FROM|SUBJECT) "([^"]*)"')
+
+
+def make_raw_mail(number):
+    return 'From: user{0}@test.com\r\nSubject: mail {0}\r\nMessage-ID: <{0}@test.com>\r\n\r\nbody {0}\r\n'.format(
+        number).encode('ascii')
+
+
+class FakeImapConnection:
+    """
+    Minimal imaplib.IMAP4 replacement serving a list of mails, recording the
+    sent commands
+    """
+
+    def __init__(self, count):
+        self.mails = {}
+        self.flags = {}
+        self.uids = {}
+        self.uidvalidity = 1
+        self.commands = []
+        self.responses = {}
+        for _ in range(count):
+            self.add_mail()
+
+    def add_mail(self):
+        number = len(self.mails) + 1
+        self.mails[number] = make_raw_mail(number)
+        self.flags[number] = set()
+        # UIDs don't match sequence numbers
+        self.uids[number] = 100 + number
+
+    def _uid_numbers(self, message_set):
+        uids = set(self._numbers(message_set))
+        return [number for number in sorted(self.uids) if self.uids[number] in uids]
+
+    def _numbers(self, message_set):
+        numbers = []
+        for part in message_set.split(','):
+            start, _, end = part.partition(':')
+            numbers.extend(range(int(start), int(end or start) + 1))
+        return numbers
+
+    def _matches(self, number, criteria):
+        # OR of the FROM and SUBJECT keys, as sent for route searches
+        keys = SEARCH_KEY_RE.findall(criteria)
+        headers = dict(line.split(': ', 1) for line in self.mails[number].decode().split('\r\n\r\n')[0].split('\r\n'))
+        return not keys or any(value.lower() in headers[key.title()].lower() for key, value in keys)
+
+    def select(self, mailbox):
+        self.commands.append(('SELECT', mailbox))
+        self.responses = {'UIDVALIDITY': self.uidvalidity, 'UIDNEXT': max(self.uids.values() or [100]) + 1}
+        return 'OK', [str(len(self.mails)).encode()]
+
+    def status(self, mailbox, names):
+        self.commands.append(('STATUS', mailbox, names))
+        return 'OK', ['{0} (UIDVALIDITY {1} UIDNEXT {2})'.format(
+            mailbox, self.uidvalidity, max(self.uids.values() or [100]) + 1).encode()]
+
+    def response(self, code):
+        value = self.responses.pop(code, None)
+        return code, [str(value).encode() if value is not None else None]
+
+    def uid(self, command, *args):
+        if command == 'SEARCH':
+            self.commands.append(('UID SEARCH',) + args)
+            if args[0].startswith('UID '):
+                start = int(args[0][4:].split(':')[0])
+                # as servers do, the last mail matches 'n:*' even if its UID is lower
+                last_uid = max(self.uids.values())
+                uids = [uid for n, uid in self.uids.items()
+                        if (uid >= start or uid == last_uid) and self._matches(n, args[0])]
+            else:
+                uids = [self.uids[n] for n in sorted(self.mails)
+                        if '\\Seen' not in self.flags[n] and self._matches(n, args[0])]
+            return 'OK', [' '.join(str(uid) for uid in uids).encode()]
+        if command == 'FETCH':
+            self.commands.append(('UID FETCH',) + args)
+            return 'OK', self._fetch_data(self._uid_numbers(args[0]), args[1], uid=True)
+        if command == 'STORE':
+            self.commands.append(('UID STORE',) + args)
+            for number in self._uid_numbers(args[0]):
+                self.flags[number].update(args[2].strip('()').split())
+            return 'OK', []
+
+    def search(self, charset, *criteria):
+        self.commands.append(('SEARCH',) + criteria)
+        numbers = [n for n in sorted(self.mails) if '\\Seen' not in self.flags[n] and self._matches(n, criteria[0])]
+        return 'OK', [' '.join(str(n) for n in numbers).encode()]
+
+    def _fetch_data(self, numbers, items, uid=False):
+        data = []
+        for number in numbers:
+            if 'HEADER.FIELDS' in items:
+                name = 'BODY[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID)]'
+                value = self.mails[number].split(b'\r\n\r\n')[0] + b'\r\n\r\n'
+            else:
+                name, value = 'RFC822', self.mails[number]
+            uid_item = 'UID {0} '.format(self.uids[number]) if uid else ''
+            data.append(('{0} ({1}{2} {{{3}}}'.format(number, uid_item, name, len(value)).encode(), value))
+            data.append(b')')
+        return data
+
+    def fetch(self, message_set, items):
+        self.commands.append(('FETCH', message_set, items))
+        return 'OK', self._fetch_data(self._numbers(message_set), items)
+
+    def store(self, message_set, command, flags):
+        self.commands.append(('STORE', message_set, command, flags))
+        for number in self._numbers(message_set):
+            self.flags[number].update(flags.strip('()').split())
+        return 'OK', []
+
+    def expunge(self):
+        self.commands.append(('EXPUNGE',))
+        for number in [n for n, flags in self.flags.items() if '\\Deleted' in flags]:
+            del self.mails[number]
+            del self.flags[number]
+        return 'OK', []
+
+
+def make_transport(connection, **kwargs):
+    transport = ImapReceiverTransport('imap.test.com', 'user', 'password', **kwargs)
+    transport.connection = connection
+    return transport
+
+
+def test_message_set():
+    assert build_message_set([b'3', b'1', b'2', b'5', b'7', b'8']) == '1:3,5,7:8'
+    assert build_message_set([4]) == '4'
+
+
+def test_parse_fetch_response():
+    messages = parse_fetch_response([
+        (b'1 (UID 11 BODY[HEADER.FIELDS (FROM SUBJECT)] {6}', b'From: '),
+        (b' RFC822 {4}', b'mail'),
+        b' FLAGS (\\Seen))',
+        b'2 (FLAGS (\\Deleted))',
+        (b'3 (UID 13 RFC822 {2}', b'ok'),
+        b')',
+    ])
+    assert list(messages) == [1, 2, 3]
+    assert messages[1] == {'UID': 11, 'BODY[HEADER.FIELDS (FROM SUBJECT)]': b'From: ', 'RFC822': b'mail',
+                           'FLAGS': ('\\Seen',)}
+    assert messages[2] == {'FLAGS': ('\\Deleted',)}
+    assert messages[3] == {'UID': 13, 'RFC822': b'ok'}
+
+
+def test_imap_chunked_fetch():
+    connection = FakeImapConnection(5)
+    transport = make_transport(connection, fetch_chunk_size=2)
+
+    mails = transport.get_mails(delete=True)
+    assert [mail.get_subject() for mail in mails] == ['mail {0}'.format(n) for n in range(1, 6)]
+    assert [command for command in connection.commands if command[0] in ('FETCH', 'STORE')] == [
+        ('FETCH', '1:2', '(RFC822)'), ('STORE', '1:2', '+FLAGS', '(\\Seen \\Deleted)'),
+        ('FETCH', '3:4', '(RFC822)'), ('STORE', '3:4', '+FLAGS', '(\\Seen \\Deleted)'),
+        ('FETCH', '5', '(RFC822)'), ('STORE', '5', '+FLAGS', '(\\Seen \\Deleted)'),
+    ]
+    assert connection.commands[-1] == ('EXPUNGE',)
+    assert connection.mails == {}
+
+
+def test_imap_flags_processed_mails():
+    connection = FakeImapConnection(5)
+    transport = make_transport(connection, fetch_chunk_size=3)
+
+    mails = transport.iter_mails()
+    next(mails)
+    next(mails)
+    mails.close()
+    # only mails whose processing finished are flagged
+    assert [n for n, flags in sorted(connection.flags.items()) if '\\Seen' in flags] == [1]
+
+
+def test_imap_uid_sync(tmpdir):
+    state_file = os.path.join(str(tmpdir), 'imap_state.json')
+    connection = FakeImapConnection(3)
+    connection.flags[1].add('\\Seen')
+
+    def poll():
+        transport = make_transport(connection, uid_state_file=state_file)
+        return transport, transport.get_mails()
+
+    def subjects(mails):
+        return [mail.get_subject() for mail in mails]
+
+    # first sync fetches unseen mails, only failed mails are fetched again
+    transport, mails = poll()
+    assert subjects(mails) == ['mail 2', 'mail 3']
+    transport.ack([mails[1]])
+    with open(state_file) as f:
+        assert json.load(f) == {'user@imap.test.com/INBOX': {
+            'uidvalidity': 1, 'last_uid': 101, 'highest_uid': 103, 'unacked_uids': [102]}}
+
+    assert subjects(transport.get_mails()) == ['mail 2']
+    transport, mails = poll()
+    assert subjects(mails) == ['mail 2']
+    transport.ack(mails)
+    with open(state_file) as f:
+        assert json.load(f) == {'user@imap.test.com/INBOX': {'uidvalidity': 1, 'last_uid': 103}}
+
+    # next polls fetch only new mails, even if other clients mark them as seen
+    connection.add_mail()
+    connection.flags[4].add('\\Seen')
+    transport, mails = poll()
+    assert subjects(mails) == ['mail 4']
+    assert connection.commands[-2] == ('UID FETCH', '104', '(UID RFC822)')
+    transport.ack(mails)
+    transport, mails = poll()
+    assert mails == []
+
+    # UIDVALIDITY changes resync the mailbox
+    connection.uidvalidity = 2
+    connection.flags[2].discard('\\Seen')
+    transport, mails = poll()
+    assert subjects(mails) == ['mail 2']
+
+
+def test_imap_uid_sync_gaps(tmpdir):
+    state_file = os.path.join(str(tmpdir), 'imap_state.json')
+    connection = FakeImapConnection(5)
+    for number in (2, 3, 4):
+        connection.flags[number].add('\\Seen')
+
+    # seen mails between unseen ones are not fetched again after a failure
+    transport = make_transport(connection, uid_state_file=state_file)
+    mails = transport.get_mails()
+    assert [mail.get_subject() for mail in mails] == ['mail 1', 'mail 5']
+    transport.ack([mails[0]])
+    with open(state_file) as f:
+        assert json.load(f)['user@imap.test.com/INBOX']['last_uid'] == 104
+
+    transport = make_transport(connection, uid_state_file=state_file)
+    assert [mail.get_subject() for mail in transport.get_mails()] == ['mail 5']
+
+
+def test_imap_uid_sync_run(tmpdir):
+    app = Mailproc("test_imap_app")
+
+    @app.route_subject('mail <int:number>')
+    def action(number, mail):
+        if number == 2:
+            raise ValueError('action error')
+
+    state_file = os.path.join(str(tmpdir), 'imap_state.json')
+    connection = FakeImapConnection(3)
+    transport = make_transport(connection, uid_state_file=state_file)
+
+    results = app.run(transport.iter_mails(), workers=2, ack=transport.ack)
+    assert [result.error is None for result in results] == [True, False, True]
+    # a failing mail doesn't run the actions of the mails after it again
+    for _ in range(2):
+        connection.add_mail()
+        transport = make_transport(connection, uid_state_file=state_file)
+        results = app.run(transport.iter_mails(), workers=1, ack=transport.ack)
+        assert [result.message_id for result in results] == ['<2@test.com>', '<{0}@test.com>'.format(
+            len(connection.mails))]
+
+
+def test_imap_route_filter(tmpdir):
+    app = Mailproc("test_imap_filter_app")
+
+    @app.route_from('user2@test.com')
+    def from_action(mail):
+        pass
+
+    @app.route_subject('mail 4')
+    def subject_action(mail):
+        pass
+
+    # mails without subject don't break the header prefetch
+    assert app.would_route(Email.from_bytes(b'From: user2@test.com\r\n\r\nbody\r\n'))
+    connection = FakeImapConnection(5)
+    connection.mails[3] = b'From: user3@test.com\r\nMessage-ID: <3@test.com>\r\n\r\nbody 3\r\n'
+    transport = make_transport(connection, route_filter=app.would_route, unrouted_flags='(\\Flagged)')
+    assert [mail.get_subject() for mail in transport.get_mails()] == ['mail 2', 'mail 4']
+    assert connection.commands[1:5] == [
+        ('SEARCH', '(UNSEEN)'),
+        ('FETCH', '1:5', '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID)])'),
+        ('STORE', '1,3,5', '+FLAGS', '(\\Flagged)'),
+        ('FETCH', '2,4', '(RFC822)'),
+    ]
+
+    # skipped mails don't hold the UID checkpoint back
+    state_file = os.path.join(str(tmpdir), 'imap_state.json')
+    connection = FakeImapConnection(5)
+    transport = make_transport(connection, route_filter=app.would_route, uid_state_file=state_file)
+    mails = transport.get_mails()
+    transport.ack(mails)
+    with open(state_file) as f:
+        assert json.load(f)['user@imap.test.com/INBOX']['last_uid'] == 105
+
+
+def test_build_route_search():
+    routes = [
+        Route('<user>@a.cu', 'from', None),
+        Route('order <int:order_id>', 'subject', None),
+        Route('noreply@<domain>', 'from', None),
+        Route('admin@test.cu', 'from', None),
+        Route('orders? <int:order_id>', 'subject', None),
+    ]
+    assert build_route_search(routes[:2]) == 'OR FROM "@a.cu" SUBJECT "order "'
+    assert build_route_search(routes) == \
+        'OR FROM "@a.cu" OR SUBJECT "order " OR FROM "noreply@" OR FROM "admin@test.cu" SUBJECT "order"'
+    assert build_route_search([Route('say "hi"', 'subject', None)]) == 'SUBJECT "say \\"hi\\""'
+    # routes that can't be expressed
+    assert build_route_search([]) is None
+    assert build_route_search(routes + [Route('<sender>', 'from', None)]) is None
+    assert build_route_search(routes + [Route('<subject>', 'subject', None)]) is None
+    assert build_route_search([Route('a|b', 'subject', None)]) is None
+    assert build_route_search([Route(u'pedido <n>', 'subject', None), Route(u'\u00f3rden <n>', 'subject', None)]) is None
+    # criteria over the limits
+    assert build_route_search(routes, max_keys=4) is None
+    assert build_route_search(routes, max_length=50) is None
+    assert build_route_search(routes, max_keys=5, max_length=100)
+
+
+def test_imap_route_search(tmpdir):
+    app = Mailproc("test_imap_search_app")
+
+    @app.route_from('user2@test.com')
+    def from_action(mail):
+        pass
+
+    @app.route_subject('mail 4')
+    def subject_action(mail):
+        pass
+
+    connection = FakeImapConnection(5)
+    transport = make_transport(connection, route_search=app)
+    assert [mail.get_subject() for mail in transport.get_mails()] == ['mail 2', 'mail 4']
+    assert connection.commands[1] == ('SEARCH', '(UNSEEN) OR FROM "user2@test.com" SUBJECT "mail 4"')
+
+    # mails left out by the server don't hold the UID checkpoint back
+    state_file = os.path.join(str(tmpdir), 'imap_state.json')
+    connection = FakeImapConnection(5)
+    transport = make_transport(connection, route_search=app, uid_state_file=state_file)
+    transport.ack(transport.get_mails())
+    connection.add_mail()
+    connection.add_mail()
+    mails = transport.get_mails()
+    assert mails == []
+    assert connection.commands[-1] == ('UID SEARCH', 'UID 106:* OR FROM "user2@test.com" SUBJECT "mail 4"')
+    transport.ack(mails)
+    with open(state_file) as f:
+        assert json.load(f)['user@imap.test.com/INBOX']['last_uid'] == 107
+
+    # fallback to the plain query
+    @app.route_subject('<subject>')
+    def any_action(mail):
+        pass
+
+    connection = FakeImapConnection(5)
+    transport = make_transport(connection, route_search=app)
+    assert len(transport.get_mails()) == 5
+    assert connection.commands[1] == ('SEARCH', '(UNSEEN)')
+
+    # too many routes for a single search
+    app = Mailproc("test_imap_search_limit_app")
+    for i in range(1000):
+        app.route_from('<name>@customer{0}.test.com'.format(i))(from_action)
+    connection = FakeImapConnection(5)
+    transport = make_transport(connection, route_search=app)
+    assert len(transport.get_mails()) == 5
+    assert connection.commands[1] == ('SEARCH', '(UNSEEN)')
+
+
+class FakeIdleImapConnection(FakeImapConnection):
+    """
+    FakeImapConnection sending the IDLE commands through a socket
+    """
+
+    def __init__(self, count, sock):
+        super(FakeIdleImapConnection, self).__init__(count)
+        self.sock = sock
+        self.file = sock.makefile('rb')
+        self.untagged_responses = {}
+        self.tags = itertools.count(1)
+        # called by the next FETCH, as for mails arriving meanwhile
+        self.fetch_hook = None
+
+    def socket(self):
+        return self.sock
+
+    def readline(self):
+        return self.file.readline()
+
+    def fetch(self, message_set, items):
+        if self.fetch_hook is not None:
+            fetch_hook, self.fetch_hook = self.fetch_hook, None
+            fetch_hook()
+        return super(FakeIdleImapConnection, self).fetch(message_set, items)
+
+    def _new_tag(self):
+        return 'A{0}'.format(next(self.tags)).encode()
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def shutdown(self):
+        self.sock.close()
+
+
+class FakeIdleTransport(ImapReceiverTransport):
+
+    def __init__(self, count, **kwargs):
+        super(FakeIdleTransport, self).__init__('imap.test.com', 'user', 'password', **kwargs)
+        self.count = count
+        self.server_socks = []
+
+    def connect(self, **kwargs):
+        client_sock, server_sock = socket.socketpair()
+        server_sock.settimeout(5)
+        self.server_socks.append(server_sock)
+        self.connection = FakeIdleImapConnection(self.count, client_sock)
+
+
+def read_line(sock):
+    data = b''
+    while not data.endswith(b'\r\n'):
+        data += sock.recv(1)
+    return data
+
+
+def test_imap_idle_manager_ack():
+    class AckTransport:
+        def __init__(self):
+            self.acked = []
+
+        def ack(self, results):
+            self.acked.extend(results)
+
+    manager = ImapIdleManager()
+    first = manager.add(AckTransport())
+    second = manager.add(AckTransport())
+    first.message_ids = {'<1@test.com>'}
+    second.message_ids = {'<2@test.com>', '<3@test.com>'}
+    mails = [Email.from_bytes(make_raw_mail(number)) for number in (1, 2, 3)]
+    manager._ack(mails)
+    assert first.transport.acked == mails[:1]
+    assert second.transport.acked == mails[1:]
+
+
+def test_imap_idle_manager():
+    transport = FakeIdleTransport(2)
+    manager = ImapIdleManager([transport], idle_timeout=0.2, response_timeout=5, reconnect_delay=0.01)
+    manager.start()
+    try:
+        assert [mail.get_subject() for mail in manager.get_mails(timeout=5)] == ['mail 1', 'mail 2']
+        server = transport.server_socks[0]
+        assert read_line(server) == b'A1 IDLE\r\n'
+        server.sendall(b'+ idling\r\n')
+
+        # new mail
+        transport.connection.add_mail()
+        server.sendall(b'* 3 EXISTS\r\n')
+        assert read_line(server) == b'DONE\r\n'
+        server.sendall(b'A1 OK IDLE terminated\r\n')
+        assert [mail.get_subject() for mail in manager.get_mails(timeout=5)] == ['mail 3']
+        assert read_line(server) == b'A2 IDLE\r\n'
+
+        # IDLE renewal without fetching
+        searches = len([command for command in transport.connection.commands if command[0] == 'SEARCH'])
+        server.sendall(b'+ idling\r\n')
+        assert read_line(server) == b'DONE\r\n'
+        server.sendall(b'A2 OK IDLE terminated\r\n')
+        assert read_line(server) == b'A3 IDLE\r\n'
+        assert len([command for command in transport.connection.commands if command[0] == 'SEARCH']) == searches
+
+        # mails announced while fetching are fetched before idling again
+        def get_subjects(count):
+            mails = manager.get_mails(timeout=5)
+            if len(mails) < count:
+                mails.extend(manager.get_mails(timeout=5))
+            return [mail.get_subject() for mail in mails]
+
+        def exists_response():
+            transport.connection.add_mail()
+            transport.connection.untagged_responses.setdefault('EXISTS', []).append(b'5')
+
+        def exists_line():
+            transport.connection.add_mail()
+            server.sendall(b'* 6 EXISTS\r\n')
+
+        for fetch_hook, subjects, tag in ((exists_response, ['mail 4', 'mail 5'], b'A3'),
+                                          (exists_line, ['mail 6', 'mail 7'], b'A4')):
+            server.sendall(b'+ idling\r\n')
+            transport.connection.add_mail()
+            transport.connection.fetch_hook = fetch_hook
+            server.sendall(b'* 4 EXISTS\r\n')
+            assert read_line(server) == b'DONE\r\n'
+            server.sendall(tag + b' OK IDLE terminated\r\n')
+            assert get_subjects(2) == subjects
+            # IDLE is sent once, after both fetches
+            assert read_line(server) == b'A%d IDLE\r\n' % (int(tag[1:]) + 1)
+
+        # reconnection
+        server.close()
+        assert len(manager.get_mails(timeout=5)) == 2
+        assert len(transport.server_socks) == 2
+        assert read_line(transport.server_socks[1]) == b'A1 IDLE\r\n'
+    finally:
+        manager.stop(timeout=5)
+    assert manager.get_mails() == []
+
+
+def test_imap_idle_manager_uid_sync(tmpdir):
+    state_file = str(tmpdir.join('uids.json'))
+    transport = FakeIdleTransport(2, uid_state_file=state_file)
+    manager = ImapIdleManager([transport], response_timeout=5, reconnect_delay=0.01)
+    manager.start()
+    try:
+        first = manager.get_mails(timeout=5)
+        assert [mail.get_subject() for mail in first] == ['mail 1', 'mail 2']
+        server = transport.server_socks[0]
+        assert read_line(server) == b'A1 IDLE\r\n'
+        server.sendall(b'+ idling\r\n')
+
+        # mails waiting for their ack are not fetched again
+        transport.connection.add_mail()
+        server.sendall(b'* 3 EXISTS\r\n')
+        assert read_line(server) == b'DONE\r\n'
+        server.sendall(b'A1 OK IDLE terminated\r\n')
+        second = manager.get_mails(timeout=5)
+        assert [mail.get_subject() for mail in second] == ['mail 3']
+        assert read_line(server) == b'A2 IDLE\r\n'
+
+        # the failed mail 2 is kept, acks after it too
+        manager.ack([first[0]])
+        manager.ack(second)
+        expected = {'uidvalidity': 1, 'last_uid': 101, 'highest_uid': 103, 'unacked_uids': [102]}
+        key = 'user@imap.test.com/INBOX'
+        for _ in range(100):
+            with open(state_file) as f:
+                if json.load(f).get(key) == expected:
+                    break
+            time.sleep(0.05)
+        with open(state_file) as f:
+            assert json.load(f)[key] == expected
+
+        # released mails are fetched again
+        server.sendall(b'+ idling\r\n')
+        transport.connection.add_mail()
+        server.sendall(b'* 4 EXISTS\r\n')
+        assert read_line(server) == b'DONE\r\n'
+        server.sendall(b'A2 OK IDLE terminated\r\n')
+        assert [mail.get_subject() for mail in manager.get_mails(timeout=5)] == ['mail 2', 'mail 4']
+    finally:
+        manager.stop(timeout=5)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+from urllib.request import urlopen
+
+from mailproc import Mailproc
+from mailproc.tracing import SLOW_LOGGER_NAME, tracer
+
+
+def test_metrics(make_mail):
+    app = Mailproc("test_metrics_app")
+
+    @app.route_subject('order <int:order_id>')
+    def order(order_id, mail):
+        if order_id == 0:
+            raise ValueError('invalid order')
+
+    mails = [make_mail('user@test.mailproc.cu', 'order {0}'.format(i)) for i in range(3)]
+    app.run(mails, workers=2, executor='process')
+
+    snapshot = app.metrics.snapshot()
+    assert snapshot['messages'] == 3
+    assert snapshot['misses'] == {'from': 3}
+    route = snapshot['routes']['subject']['order <int:order_id>']
+    assert route['matches'] == 3
+    assert route['errors'] == 1
+    assert route['latency']['count'] == 3
+
+    server = app.metrics.start_http_server(0, '127.0.0.1')
+    try:
+        text = urlopen('http://127.0.0.1:{0}/metrics'.format(server.server_port)).read().decode('utf-8')
+    finally:
+        server.shutdown()
+    assert 'mailproc_messages_total 3' in text
+    assert 'mailproc_route_matches_total{rule="order <int:order_id>",target="subject"} 3' in text
+    assert 'mailproc_action_duration_seconds_count{rule="order <int:order_id>",target="subject"} 3' in text
+
+
+def test_slow_message_tracing(make_mail, caplog):
+    app = Mailproc("test_tracing_app")
+
+    @app.route_subject('slow <word:command>')
+    def slow(command, mail):
+        return command
+
+    def run_async(mails):
+        return asyncio.run(app.run_async(mails))
+
+    # sync actions of async runs get the trace through the executor thread context
+    for run in (app.run, run_async):
+        caplog.clear()
+        tracer.configure(slow_threshold=0, profile_rate=1.0)
+        try:
+            with caplog.at_level(logging.WARNING, logger=SLOW_LOGGER_NAME):
+                run([make_mail('user@test.mailproc.cu', 'slow command')])
+        finally:
+            tracer.configure()
+
+        slow_logs = [record.getMessage() for record in caplog.records if record.name == SLOW_LOGGER_NAME]
+        assert any('profile' in message for message in slow_logs)
+        trace_log = [message for message in slow_logs if message.startswith('SLOW message')][0]
+        for span in ('header_decode', 'route_match[subject]', 'action[slow <word:command>]'):
+            assert span in trace_log
+
+
+def test_concurrent_profiling(make_mail, caplog):
+    app = Mailproc("test_profiling_app")
+
+    @app.route_subject('slow <int:number>')
+    def slow(number, mail):
+        time.sleep(0.01)
+        return number
+
+    mails = [make_mail('user{0}@test.mailproc.cu'.format(i), 'slow {0}'.format(i)) for i in range(8)]
+    tracer.configure(slow_threshold=0, profile_rate=1.0)
+    try:
+        with caplog.at_level(logging.WARNING, logger=SLOW_LOGGER_NAME):
+            results = app.run(mails, workers=4)
+    finally:
+        tracer.configure()
+
+    # a single action is profiled at a time, profiling never fails actions
+    assert [result.results for result in results] == [{'subject': i} for i in range(8)]
+    assert any('profile' in record.getMessage() for record in caplog.records)
@@ -2,7 +2,8 @@
 import email
 import os
 
-from mailproc import Email
+from mailproc import Mailproc
+from mailproc.routing import AddressRouteMap, Route, RouteMap
 
 
 def test_from_routes(app, static_dir):
@@ -10,7 +11,6 @@ def test_from_routes(app, static_dir):
     count_from = 0
 
     msg = email.message_from_file(open(os.path.join(static_dir, 'test_email.eml')))
-    msg.__class__ = Email
 
     @app.route_from('<name>@test.com')
     def from_trigger(name, mail):
@@ -28,7 +28,6 @@ def test_subject_routes(app, static_dir):
     count_subject = 0
 
     msg = email.message_from_file(open(os.path.join(static_dir, 'test_email.eml')))
-    msg.__class__ = Email
 
     @app.route_subject('<name> email')
     def from_trigger(name, mail):
@@ -39,3 +38,117 @@ def test_subject_routes(app, static_dir):
 
     app.run([msg])
     assert count_subject == 1
+
+
+def test_route_map_first_match_wins():
+    routes = [Route('order <id>', 'subject', 'first'),
+              Route('<anything>', 'subject', 'second')]
+    routes += [Route('command{0} <arg>'.format(i), 'subject', i) for i in range(500)]
+    route_map = RouteMap(routes)
+
+    kwargs, route = route_map.match('order 12')
+    assert kwargs == {'id': '12'}
+    assert route.action == 'first'
+
+    kwargs, route = route_map.match('command499 test')
+    assert kwargs == {'anything': 'command499 test'}
+    assert route.action == 'second'
+
+    matches = route_map.match_all('command499 test')
+    assert [route.action for _, route in matches] == ['second', 499]
+    assert matches[1][0] == {'arg': 'test'}
+
+    assert route_map.match('') is None
+
+
+def test_address_route_map_domain_index():
+    routes = [Route('<name>@customer{0}.cu'.format(i), 'from', i) for i in range(1000)]
+    routes.insert(10, Route('noreply@<domain>', 'from', 'noreply'))
+    routes.append(Route('<name>@<domain>', 'from', 'wildcard'))
+    route_map = AddressRouteMap(routes)
+
+    kwargs, route = route_map.match('x@customer500.cu')
+    assert kwargs == {'name': 'x'}
+    assert route.action == 500
+    assert len(route_map._get_route_map('x@customer500.cu').routes) == 2
+
+    # registration order is kept between indexed and wildcard routes
+    kwargs, route = route_map.match('noreply@customer500.cu')
+    assert route.action == 'noreply'
+    kwargs, route = route_map.match('noreply@customer5.cu')
+    assert route.action == 5
+
+    kwargs, route = route_map.match('x@unknown.cu')
+    assert kwargs == {'name': 'x', 'domain': 'unknown.cu'}
+    assert route.action == 'wildcard'
+    assert route_map.match('unknown') is None
+
+    # rules with alternatives are not indexed
+    route_map = AddressRouteMap([Route('<a>@example.com|<b>@foo.com', 'from', 'alternatives')])
+    assert route_map.match('x@example.com')[1].action == 'alternatives'
+    assert route_map.match('x@foo.com')[1].action == 'alternatives'
+
+
+def test_route_literal_dots():
+    routes = [Route('<name>@a.cu', 'from', 'literal'), Route('<name>@any.*', 'from', 'any')]
+    route_map = AddressRouteMap(routes)
+    for path, action in (('x@a.cu', 'literal'), ('x@aXcu', None), ('x@any.cu', 'any'), ('x@anything', 'any')):
+        matched = route_map.match(path)
+        assert (matched[1].action if matched else None) == action
+        matched = RouteMap(routes).match(path)
+        assert (matched[1].action if matched else None) == action
+    assert Mailproc.build_route_pattern('<name>@a.cu').match('x@aXcu') is None
+    assert Mailproc.build_route_pattern(r'<name>@a\.cu').match('x@a.cu')
+
+
+def test_address_route_mixed_case_domain():
+    app = Mailproc("test_mixed_case_domain_app")
+
+    @app.route_from('<name>@Example.com')
+    def action(name, mail):
+        return name
+
+    mail = email.message_from_string('From: X@Example.com\nSubject: test\n\nbody\n')
+    assert app.dispatch_mail(mail).results == {'from': 'X'}
+
+
+def test_typed_route_converters():
+    routes = [Route('order <int:order_id> <word:command>', 'subject', 'order'),
+              Route('user <local:name>@<path:rest>', 'subject', 'user'),
+              Route('<long>', 'subject', 'long', max_length=10)]
+    route_map = RouteMap(routes)
+
+    kwargs, route = route_map.match('order 42 cancel')
+    assert kwargs == {'order_id': 42, 'command': 'cancel'}
+    assert route.action == 'order'
+
+    kwargs, route = route_map.match('user someone@example.com/x y')
+    assert kwargs == {'name': 'someone', 'rest': 'example.com/x y'}
+
+    assert route_map.match('order 4x2')[1].action == 'long'
+    assert route_map.match('order 4x2 cancel') is None
+    assert route_map.match('this is a very ' + 'long ' * 10000 + 'subject') is None
+
+
+def test_route_cache():
+    app = Mailproc("test_route_cache_app", route_cache_size=2)
+
+    @app.route_subject('balance')
+    def balance(mail):
+        return 'balance'
+
+    assert app.serve_route('balance', 'subject', mail=None) == 'balance'
+    assert app.serve_route('balance', 'subject', mail=None) == 'balance'
+    assert app.get_route_match('help', 'subject') is None
+    assert app.get_route_match('help', 'subject') is None
+    assert app.route_cache_info() == (2, 2, 2, 2)
+
+    app.get_route_match('other', 'subject')
+    assert app.route_cache_info().currsize == 2
+
+    @app.route_subject('help')
+    def help_action(mail):
+        return 'help'
+
+    assert app.route_cache_info() == (0, 0, 2, 0)
+    assert app.serve_route('help', 'subject', mail=None) == 'help'
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+
+import pytest
+
+from mailproc import Email
+from mailproc.compression import CODECS
+from mailproc.compression import detect_codec
+from mailproc.compression import get_codec
+from mailproc.exceptions import DecompressionSizeError
+from mailproc.streams import iter_base64_decoded
+from mailproc.streams import iter_base64_encoded
+from mailproc.streams import iter_chunks
+from mailproc.streams import iter_json_encoded
+from mailproc.streams import iter_json_records
+from mailproc.transports import FileSenderTransport
+
+
+def test_codecs_roundtrip():
+    data = json.dumps(list(range(10000))).encode('utf-8')
+    for codec in CODECS.values():
+        compressed = b''.join(codec.iter_compressed(iter_chunks(data, 1000)))
+        assert len(compressed) < len(data)
+
+        # concatenated streams, decompressed in small chunks
+        compressed += b''.join(codec.iter_compressed([b'tail'], 1))
+        chunks = list(codec.iter_decompressed(iter_chunks(compressed, 100), chunk_size=512))
+        assert b''.join(chunks) == data + b'tail'
+        assert max(len(chunk) for chunk in chunks) <= 512
+
+        with pytest.raises(DecompressionSizeError):
+            list(codec.iter_decompressed(codec.iter_compressed([b'0' * 100000]), max_size=1000))
+        with pytest.raises(ValueError):
+            list(codec.iter_decompressed([compressed[:-10]]))
+
+    assert gzip.decompress(b''.join(get_codec('gzip').iter_compressed([data]))) == data
+    assert detect_codec('application/gzip') is get_codec('gzip')
+    assert detect_codec('application/octet-stream', 'data.json.XZ') is get_codec('lzma')
+    assert detect_codec('application/json', 'data.json') is None
+    with pytest.raises(ValueError):
+        get_codec('rar')
+
+
+def test_base64_roundtrip():
+    data = bytes(range(256)) * 10
+    encoded = b''.join(iter_base64_encoded(iter_chunks(data, 100)))
+    assert b''.join(iter_base64_decoded(iter_chunks(encoded, 7))) == data
+
+
+def test_json_records():
+    records = [{'id': i, 'name': u'caf\xe9 {0}'.format(i)} for i in range(100)] + [12345, 'a', None]
+
+    array = json.dumps(records, indent=1)
+    assert list(iter_json_records(iter_chunks(array, 3))) == records
+    assert list(iter_json_records([' [ ] '])) == []
+
+    ndjson = '\n'.join(json.dumps(record) for record in records)
+    assert list(iter_json_records(iter_chunks(ndjson, 5))) == records
+
+    assert list(iter_json_records(['  '])) == []
+    for invalid in ('[1, 2', '[1 2]', '[1,]', '[1] 2', '{"a": ', '[', '[1,'):
+        with pytest.raises(ValueError):
+            list(iter_json_records(iter_chunks(invalid, 2)))
+
+
+def test_json_encoded():
+    records = [{'id': i, 'name': u'caf\xe9 {0}'.format(i)} for i in range(100)]
+    chunks = list(iter_json_encoded(records, chunk_size=100))
+    assert len(chunks) > 1
+    assert b''.join(chunks) == json.dumps(records).encode('utf-8')
+    assert list(iter_json_encoded([])) == [b'[]']
+
+
+def test_json_attachment_records(app, tmpdir):
+    records = [{'id': i} for i in range(1000)]
+    message = FileSenderTransport(str(tmpdir)).create_message(
+        'a@test.com', 'b@test.com', 'records', 'the body', json_attachment=records,
+        json_attachment_base64_encode=True, json_attachment_gzip=True)
+    mail = Email.from_bytes(message.as_bytes())
+
+    options = dict(base64_decode=True, gzipped=True)
+    assert mail.get_json_attachment(**options) == records
+    assert list(mail.iter_json_records('attachment.json', **options)) == records
+    assert mail.get_json_attachment(max_size=100, **options) is False
+    assert list(mail.iter_json_records('missing.json')) == []
+
+    # codec and base64 encoding detected from the content type
+    assert mail.get_json_attachment() == records
+    for compression in CODECS:
+        message = FileSenderTransport(str(tmpdir)).create_message(
+            'a@test.com', 'b@test.com', 'records', 'the body', json_attachment=records,
+            json_attachment_compression=compression, json_attachment_compression_level=1)
+        mail = Email.from_bytes(message.as_bytes())
+        assert mail.get_attachment().content_type == get_codec(compression).content_type
+        assert list(mail.iter_json_records()) == records